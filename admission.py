@@ -0,0 +1,91 @@
+import math
+import time
+from typing import Optional
+
+from metadata_cache import normalize_url
+from metrics import metrics
+
+_REJECTIONS = metrics.counter(
+    "karaoke_admission_rejections_total", "Song requests turned away before resolution, by reason"
+)
+
+
+class TokenBucket:
+    """Allows bursts of up to capacity, refilled at rate tokens per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count: float = 1) -> bool:
+        """Takes count tokens if there are enough of them"""
+        self._refill(time.monotonic())
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def wait_time(self, count: float = 1) -> float:
+        """Seconds until count tokens will be available"""
+        self._refill(time.monotonic())
+        return max(0.0, (count - self.tokens) / self.rate)
+
+
+class AdmissionControl:
+    """
+    Turns away song requests before they reach the metadata resolver.
+    Each user gets a token bucket of resolution attempts, and urls which recently failed to
+    resolve are remembered for failure_ttl seconds so they aren't looked up again.
+    """
+
+    def __init__(self, rate: float, burst: float, failure_ttl: float, max_failures: int = 1000):
+        self.rate = rate
+        self.burst = burst
+        self.failure_ttl = failure_ttl
+        self.max_failures = max_failures
+        self._buckets: dict[int, TokenBucket] = {}
+        # normalized url -> when the failure expires, oldest first
+        self._failures: dict[str, float] = {}
+
+    def recently_failed(self, song_url: str) -> bool:
+        key = normalize_url(song_url)
+        expires = self._failures.get(key)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._failures[key]
+            return False
+        return True
+
+    def record_failure(self, song_url: str):
+        key = normalize_url(song_url)
+        self._failures.pop(key, None)
+        self._failures[key] = time.monotonic() + self.failure_ttl
+        while len(self._failures) > self.max_failures:
+            del self._failures[next(iter(self._failures))]
+
+    def admit(self, user_id: int, song_urls: list[str], exempt: bool = False) -> Optional[str]:
+        """
+        Charges a user for resolving song_urls, or returns why the request is rejected.
+        Exempt users (operators) are not rate limited.
+        """
+        failed = [song_url for song_url in song_urls if self.recently_failed(song_url)]
+        if failed and len(failed) == len(song_urls):
+            _REJECTIONS.inc(reason="recently_failed")
+            return f"Fetching the metadata of {failed[0]} failed recently. Check the URL."
+        if exempt:
+            return None
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        attempts = min(len(song_urls) - len(failed), self.burst)
+        if not bucket.take(attempts):
+            _REJECTIONS.inc(reason="rate_limited")
+            return f"You are adding songs too quickly, try again in {math.ceil(bucket.wait_time(attempts))} seconds"
+        return None
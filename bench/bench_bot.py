@@ -0,0 +1,329 @@
+"""
+Load-tests the bot's command handlers and playback loop offline.
+
+    python -m bench.bench_bot [--users N] [--rows N ...] [--latency S] [--songs N] [--duration S]
+                              [--queues N]
+
+Commands are invoked directly with fake interactions, yt-dlp and ffprobe are replaced by stub
+scripts which sleep for --latency seconds, and fake_mpv.py stands in for mpv. Everything runs
+in a temporary directory with its own database. Reported are p50/p99 command latency, how
+long the event loop was blocked while commands ran, query times against song tables and song
+libraries of each --rows size, and the gap between one song ending and the next starting in the player, for one
+queue and for --queues queues playing at once.
+"""
+import os
+import sys
+import math
+import time
+import asyncio
+import argparse
+import datetime
+import tempfile
+import statistics
+import contextlib
+from pathlib import Path
+from typing import Iterator
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from metrics import Metrics, LoopLagMonitor
+from bench.fakes import (
+    FakeChannel,
+    FakeGuild,
+    FakeInteraction,
+    install_stub_programs,
+    write_config,
+)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name: str, latencies: list[float]):
+    if not latencies:
+        print(f"{name:>28}: no samples")
+        return
+    print(
+        f"{name:>28}: n={len(latencies)} p50={statistics.median(latencies) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 0.99) * 1000:.1f}ms max={max(latencies) * 1000:.1f}ms"
+    )
+
+
+@contextlib.contextmanager
+def loop_lag() -> Iterator[list[float]]:
+    """Collects how late the event loop ran a timer, which is time it spent blocked, during a with statement"""
+    lags: list[float] = []
+    monitor = LoopLagMonitor(Metrics(), math.inf, interval=0.01, on_lag=lags.append)
+    monitor.start()
+    try:
+        yield lags
+    finally:
+        monitor.stop()
+
+
+def report_lag(name: str, lags: list[float]):
+    if not lags:
+        print(f"{name:>28}: no samples")
+        return
+    print(
+        f"{name:>28}: blocked={sum(lags) * 1000:.0f}ms "
+        f"p99 lag={percentile(lags, 0.99) * 1000:.1f}ms max lag={max(lags) * 1000:.1f}ms"
+    )
+
+
+async def timed(coroutine) -> float:
+    start = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - start
+
+
+def make_song(index: int, user_id: int) -> dict:
+    return {
+        "url": f"https://bench.invalid/song{index}",
+        "title": f"Song {index}",
+        "duration": 180,
+        "added_time": datetime.datetime.now(),
+        "lyrics_url": None,
+        "notes": None,
+        "collaborators": None,
+        "discord_user_id": user_id,
+        "discord_guild_id": "1",
+        "song_key": f"Generic:song{index}",
+    }
+
+
+async def bench_commands(bot, users: int):
+    """Many users adding songs at once, then all of them listing the queue"""
+    guild = FakeGuild()
+    await bot.initialize.callback(FakeInteraction(0, operator=True, guild=guild), "commands")
+    with loop_lag() as lags:
+        latencies = await asyncio.gather(
+            *(
+                timed(
+                    bot.addsong.callback(
+                        FakeInteraction(user_id, guild=guild),
+                        f"https://bench.invalid/user{user_id}",
+                        None,
+                        None,
+                        None,
+                    )
+                )
+                for user_id in range(1, users + 1)
+            )
+        )
+    report("addsong", latencies)
+    report_lag("addsong event loop", lags)
+    with loop_lag() as lags:
+        latencies = await asyncio.gather(
+            *(
+                timed(bot.listsongs.callback(FakeInteraction(user_id, guild=guild), True))
+                for user_id in range(1, users + 1)
+            )
+        )
+    report("listsongs", latencies)
+    report_lag("listsongs event loop", lags)
+
+
+async def bench_database(bot, rows: int, samples: int = 20):
+    """Query times against a queue with rows songs in it"""
+    from store import Store
+    from queue_state import QueueState
+
+    import db
+
+    store = Store(Path(f"bench-{rows}.db"))
+    name = f"rows{rows}"
+    await store.run(db.create_queue, name, "1", datetime.datetime.now())
+    for first in range(0, rows, 1000):
+        batch = [make_song(index, index % 500) for index in range(first, min(rows, first + 1000))]
+        await store.run(db.append_songs, name, batch)
+    print(f"{rows} rows:")
+
+    load = [await timed(store.run(QueueState.load, name)) for _ in range(3)]
+    report("QueueState.load", load)
+    report(
+        "db.get_queue_positions",
+        [await timed(store.run(db.get_queue_positions, name)) for _ in range(samples)],
+    )
+    report(
+        "db.append_song",
+        [
+            await timed(store.run(db.append_song, name, make_song(rows + index, 1000)))
+            for index in range(samples)
+        ],
+    )
+    report(
+        "db.advance_position",
+        [
+            await timed(
+                store.run(db.advance_position, name, position, datetime.datetime.now())
+            )
+            for position in range(samples)
+        ],
+    )
+    report(
+        "db.revoke_song",
+        [
+            await timed(store.run(db.revoke_song, name, rows - position - 1))
+            for position in range(samples)
+        ],
+    )
+
+    # autocomplete has to answer within Discord's 3 seconds, however big the library is
+    from library import Library
+
+    for first in range(0, rows, 1000):
+        await store.run(
+            db.replace_library_sources,
+            [
+                (
+                    f"/library/{index}.mp4",
+                    0.0,
+                    0,
+                    [{**make_song(index, 0), "artist": f"Artist {index % 500}"}],
+                )
+                for index in range(first, min(rows, first + 1000))
+            ],
+        )
+    library = Library(store, [])
+    report(
+        "library search",
+        [
+            await timed(library.search(query, 25))
+            for query in ["so", "song 1", "artist 4", "song 99 artist", "nothing"] * (samples // 5)
+        ],
+    )
+
+    # listsongs works from the in-memory state, so point the active queue's worker at this one
+    worker = bot.workers[1]
+    previous_state = worker.state
+    worker.state = await store.run(QueueState.load, name)
+    guild = FakeGuild()
+    report(
+        "listsongs (pending)",
+        [await timed(bot.listsongs.callback(FakeInteraction(1, guild=guild), False)) for _ in range(3)],
+    )
+    report(
+        "listsongs (include_old)",
+        [await timed(bot.listsongs.callback(FakeInteraction(1, guild=guild), True)) for _ in range(3)],
+    )
+    worker.state = previous_state
+    store.close()
+
+
+async def bench_transitions(bot, songs: int, duration: float):
+    """Plays songs back to back and measures the gap between one ending and the next starting"""
+    import db
+
+    ended_at = None
+    gaps = []
+
+    def on_event(event: dict):
+        nonlocal ended_at
+        if event.get("event") == "end-file" and event.get("reason") == "eof":
+            ended_at = time.perf_counter()
+        elif event.get("event") == "start-file" and ended_at is not None:
+            gaps.append(time.perf_counter() - ended_at)
+            ended_at = None
+
+    guild = FakeGuild()
+    await bot.store.run(db.create_queue, "transitions", "1", datetime.datetime.now())
+    await bot.store.run(
+        db.append_songs, "transitions", [make_song(index, index) for index in range(songs)]
+    )
+    # replaces the queue the command benchmark left playing in the same channel
+    await bot.initialize.callback(FakeInteraction(0, operator=True, guild=guild), "transitions")
+    worker = bot.workers[1]
+    worker.player.add_listener(on_event)
+    state = worker.state
+    deadline = time.monotonic() + songs * (duration + 5) + 10
+    with loop_lag() as lags:
+        while state.currentpos < state.maxpos and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+    report("song transition gap", gaps)
+    report_lag("playback event loop", lags)
+
+
+async def bench_queues(bot, queues: int, songs: int, duration: float):
+    """Plays songs in many queues at once, each in its own channel and mpv, across two guilds"""
+    import db
+
+    gaps = []
+
+    def gap_recorder():
+        ended_at = None
+
+        def on_event(event: dict):
+            nonlocal ended_at
+            if event.get("event") == "end-file" and event.get("reason") == "eof":
+                ended_at = time.perf_counter()
+            elif event.get("event") == "start-file" and ended_at is not None:
+                gaps.append(time.perf_counter() - ended_at)
+                ended_at = None
+
+        return on_event
+
+    guilds = [FakeGuild(1), FakeGuild(2)]
+    workers = []
+    for index in range(queues):
+        guild = guilds[index % len(guilds)]
+        name = f"room{index}"
+        await bot.store.run(db.create_queue, name, guild.id, datetime.datetime.now())
+        await bot.store.run(
+            db.append_songs, name, [make_song(song, song) for song in range(songs)]
+        )
+        interaction = FakeInteraction(
+            0, operator=True, guild=guild, channel=FakeChannel(100 + index)
+        )
+        await bot.initialize.callback(interaction, name)
+        worker = bot.workers[interaction.channel_id]
+        worker.player.add_listener(gap_recorder())
+        workers.append(worker)
+    deadline = time.monotonic() + songs * (duration + 5) + 10
+    with loop_lag() as lags:
+        while (
+            any(worker.state.currentpos < worker.state.maxpos for worker in workers)
+            and time.monotonic() < deadline
+        ):
+            await asyncio.sleep(0.1)
+    report(f"transition gap, {queues} queues", gaps)
+    report_lag(f"{queues} queues event loop", lags)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=50, help="concurrent users issuing commands")
+    parser.add_argument("--rows", type=int, nargs="*", default=[10000, 100000])
+    parser.add_argument("--latency", type=float, default=0.5, help="stub yt-dlp/ffprobe latency")
+    parser.add_argument("--songs", type=int, default=5, help="songs to play back to back")
+    parser.add_argument("--duration", type=float, default=1.0, help="length of each fake song")
+    parser.add_argument("--queues", type=int, default=12, help="queues playing at once")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        os.chdir(directory)
+        install_stub_programs(directory.joinpath("bin"))
+        os.environ["STUB_YTDLP_LATENCY"] = str(args.latency)
+        os.environ["STUB_FFPROBE_LATENCY"] = str(args.latency)
+        os.environ["FAKE_MPV_DURATION"] = str(args.duration)
+        write_config(directory.joinpath("config.json"), {})
+        # the bot sets itself up on import, so it has to come after the environment
+        import bot
+
+        try:
+            await bench_commands(bot, args.users)
+            for rows in args.rows:
+                await bench_database(bot, rows)
+            await bench_transitions(bot, args.songs, args.duration)
+            await bench_queues(bot, args.queues, args.songs, args.duration)
+        finally:
+            for worker in list(bot.workers.values()):
+                await worker.stop()
+            bot.prefetcher.cancel_all()
+            bot.store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+"""
+Compares the yt-dlp resolver backends against a local HTTP server serving test media.
+
+    python -m bench.bench_resolver [--media FILE] [--runs N] [--concurrency N]
+
+Without --media a short clip is generated with ffmpeg. Each backend resolves the same
+urls with a fresh MetadataResolver (so nothing is coalesced or cached between runs), and
+the latency of the yt-dlp stage is reported. Lookups yt-dlp can't get a duration for still
+count, since the point is the cost of running yt-dlp, not whether ffprobe is needed after.
+"""
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+import threading
+import subprocess
+from pathlib import Path
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from resolver import MetadataResolver, ResolverError
+
+_PAGE = """<!DOCTYPE html>
+<html><head><title>Benchmark song {index}</title>
+<meta property="og:title" content="Benchmark song {index}"></head>
+<body><video src="/{media}"></video></body></html>
+"""
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def make_media(directory: Path) -> Path:
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg is not installed, pass an existing media file with --media")
+    media = directory.joinpath("song.mp4")
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "quiet", "-f", "lavfi", "-i", "testsrc=duration=5:size=320x240",
+            "-f", "lavfi", "-i", "sine=duration=5", "-metadata", "title=Benchmark song",
+            "-shortest", str(media),
+        ],
+        check=True,
+    )
+    return media
+
+
+def serve(directory: Path) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(QuietHandler, directory=str(directory))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def bench_backend(backend: str, urls: list[str], concurrency: int) -> list[float]:
+    resolver = MetadataResolver(concurrency, 60, backend)
+    if backend == "api" and resolver.api is None:
+        return []
+    extract = resolver.resolve_ytdlp_api if backend == "api" else resolver.resolve_ytdlp
+    gate = asyncio.Semaphore(concurrency)
+
+    async def timed(url: str) -> float:
+        async with gate:
+            start = time.perf_counter()
+            try:
+                await extract(url)
+            except ResolverError:
+                pass
+            return time.perf_counter() - start
+
+    # warm up the api backend's YoutubeDL instances so the steady state is measured
+    if backend == "api":
+        await asyncio.gather(*(timed(url) for url in urls[:concurrency]))
+    return await asyncio.gather(*(timed(url) for url in urls))
+
+
+def report(backend: str, latencies: list[float], wall: float):
+    if not latencies:
+        print(f"{backend:>4}: unavailable")
+        return
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{backend:>4}: n={len(latencies)} mean={statistics.mean(latencies) * 1000:.0f}ms "
+        f"p50={statistics.median(latencies) * 1000:.0f}ms p95={p95 * 1000:.0f}ms "
+        f"wall={wall:.2f}s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--media", type=Path, help="media file to serve")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        if args.media:
+            media = directory.joinpath(args.media.name)
+            shutil.copy(args.media, media)
+        else:
+            media = make_media(directory)
+        for index in range(args.runs):
+            directory.joinpath(f"song{index}.html").write_text(
+                _PAGE.format(index=index, media=media.name)
+            )
+        server = serve(directory)
+        host, port = server.server_address
+        urls = [f"http://{host}:{port}/song{index}.html" for index in range(args.runs)]
+        for backend in ("cli", "api"):
+            start = time.perf_counter()
+            latencies = await bench_backend(backend, urls, args.concurrency)
+            report(backend, latencies, time.perf_counter() - start)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
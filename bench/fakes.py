@@ -0,0 +1,160 @@
+"""
+Stand-ins for the Discord objects and external programs the bot talks to, so command handlers
+and the playback loop can be driven offline by the benchmarks.
+"""
+import os
+import sys
+import json
+import types
+import stat
+from pathlib import Path
+
+REPO = Path(__file__).parent.parent
+
+# Prints metadata like yt-dlp's --print, lists a single format for -J, or "downloads" a small
+# file for -o, after a delay.
+_YTDLP_STUB = """#!{python}
+import os, sys, json, time
+time.sleep(float(os.environ.get("STUB_YTDLP_LATENCY", "0")))
+args = sys.argv[1:]
+url = args[-1]
+if "fail" in url:
+    sys.exit(1)
+if "-J" in args:
+    print(json.dumps({{"formats": [{{"format_id": "18", "protocol": "https", "url": url, "height": 360,
+                                      "tbr": 500, "vcodec": "avc1", "acodec": "mp4a"}}]}}))
+    sys.exit(0)
+if "-o" in args:
+    path = args[args.index("-o") + 1].replace("%(ext)s", "mp4")
+    with open(path, "wb") as f:
+        f.write(os.urandom(int(os.environ.get("STUB_DOWNLOAD_BYTES", "65536"))))
+    sys.exit(0)
+print(json.dumps({{"url": url, "title": "Song " + url.rsplit("/", 1)[-1], "duration": "180",
+                  "extractor": "Generic", "id": url.rsplit("/", 1)[-1]}}))
+"""
+
+_FFPROBE_STUB = """#!{python}
+import os, sys, json, time
+time.sleep(float(os.environ.get("STUB_FFPROBE_LATENCY", "0")))
+url = sys.argv[-1]
+if "fail" in url:
+    sys.exit(1)
+print(json.dumps({{"format": {{"duration": "180", "tags": {{"title": "Song " + url}}}}, "streams": [{{}}]}}))
+"""
+
+# Prints an ebur128 summary to stderr like ffmpeg measuring a file's loudness, after a delay.
+_FFMPEG_STUB = """#!{python}
+import os, sys, time
+time.sleep(float(os.environ.get("STUB_FFMPEG_LATENCY", "0")))
+path = sys.argv[sys.argv.index("-i") + 1]
+if "fail" in path or not os.path.exists(path):
+    sys.exit(1)
+print("[Parsed_ebur128_0 @ 0x0] Summary:\\n\\n  Integrated loudness:\\n    I:         -11.0 LUFS\\n"
+      "    Threshold: -21.0 LUFS", file=sys.stderr)
+"""
+
+
+def install_stub_programs(bin_dir: Path):
+    """Writes fake yt-dlp, ffprobe and ffmpeg executables to bin_dir and puts it first on PATH"""
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, source in (("yt-dlp", _YTDLP_STUB), ("ffprobe", _FFPROBE_STUB), ("ffmpeg", _FFMPEG_STUB)):
+        path = bin_dir.joinpath(name)
+        path.write_text(source.format(python=sys.executable))
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+
+def write_config(path: Path, overrides: dict):
+    """Writes a config file for the bot and points $KARAOKE_CONFIG at it"""
+    config = {
+        "guild_id": "1",
+        "operator_roles": ["1"],
+        "mpv_path": str(REPO.joinpath("fake_mpv.py")),
+        "mpv_ipc_socket": str(path.parent.joinpath("mpv.sock")),
+        "prefetch_dir": str(path.parent.joinpath("prefetch")),
+    }
+    config.update(overrides)
+    path.write_text(json.dumps(config))
+    os.environ["KARAOKE_CONFIG"] = str(path)
+
+
+class FakeMessage:
+    def __init__(self, content: str = None):
+        self.content = content
+
+    async def edit(self, content: str = None, **kwargs):
+        self.content = content
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, content: str = None, **kwargs):
+        self.messages.append(content)
+
+    async def defer(self, **kwargs):
+        pass
+
+    async def edit_message(self, **kwargs):
+        pass
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content: str = None, **kwargs):
+        self.messages.append(content)
+        return FakeMessage(content)
+
+
+class FakeMember:
+    def __init__(self, user_id: int, operator: bool = False, guild: "FakeGuild" = None):
+        self.id = user_id
+        self.guild = guild
+        self.roles = [types.SimpleNamespace(id=1)] if operator else []
+        self.nick = None
+        self.name = f"user{user_id}"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = 1):
+        self.id = guild_id
+        self.api_calls = 0
+
+    def get_member(self, user_id: int):
+        return None
+
+    async def query_members(self, user_ids: list[int] = None, **kwargs):
+        self.api_calls += 1
+        return [FakeMember(user_id, guild=self) for user_id in user_ids or []]
+
+
+class FakeInteraction:
+    """Just enough of discord.Interaction for the bot's command handlers"""
+
+    def __init__(
+        self,
+        user_id: int,
+        operator: bool = False,
+        guild: FakeGuild = None,
+        channel: "FakeChannel" = None,
+    ):
+        self.guild = guild or FakeGuild()
+        self.user = FakeMember(user_id, operator, self.guild)
+        self.guild_id = self.guild.id
+        self.channel = channel or FakeChannel()
+        self.channel_id = self.channel.id
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int = 1):
+        self.id = channel_id
+        self.messages = []
+
+    async def send(self, content: str = None, **kwargs):
+        self.messages.append(content)
+        return FakeMessage(content)
@@ -1,14 +1,32 @@
+import os
 import json
 import datetime
 import asyncio
+import time
+import hashlib
+import functools
+import contextlib
+import tempfile
 from pathlib import Path
-from typing import TypedDict, Optional
-import subprocess
+from typing import Literal, TypedDict, Optional
 
 import discord
 from discord import app_commands
-from discord.ext import tasks
 import db
+from resolver import MetadataResolver
+from metadata_cache import MetadataCache, song_key
+from prefetch import Prefetcher
+from player import MpvPlayer
+from store import Store
+from queue_state import QueueState, Song
+from metrics import metrics, discord_api_seconds, LoopLagMonitor
+from nickname_cache import NicknameCache
+from admission import AdmissionControl
+from loudness import LoudnessAnalyzer
+from queue_worker import QueueWorker
+from library import Library, choice_value
+from source_planner import SourcePlanner
+from history import write_export
 
 class Config(TypedDict):
     guild_id: str
@@ -18,10 +36,12 @@ class Config(TypedDict):
 
 def get_config() -> Config:
     """
-    Reads configuration from config file
+    Reads configuration from config file (config.json, or the file named by $KARAOKE_CONFIG)
     """
     default_config_path = Path(__file__).parent.joinpath("default_config.json")
-    user_config_path = Path(__file__).parent.joinpath("config.json")
+    user_config_path = Path(
+        os.environ.get("KARAOKE_CONFIG", Path(__file__).parent.joinpath("config.json"))
+    )
     with open(default_config_path) as f:
         global_config = json.load(f)
     if user_config_path.is_file():
@@ -34,101 +54,153 @@ def get_config() -> Config:
 
 # read the config file and initialize the db
 config = get_config()
-conn = db.set_up_database()
-current_queue = ""
+store = Store()
+resolver = MetadataResolver(
+    int(config["resolver_workers"]),
+    float(config["resolver_timeout"]),
+    config["resolver_backend"],
+)
+# songs are measured in the background once they are downloaded, unless loudness_workers is 0
+loudness = (
+    LoudnessAnalyzer(
+        store,
+        float(config["loudness_target_lufs"]),
+        float(config["loudness_max_gain_db"]),
+        int(config["loudness_workers"]),
+    )
+    if int(config["loudness_workers"]) > 0
+    else None
+)
+prefetcher = Prefetcher(
+    Path(config["prefetch_dir"]),
+    int(float(config["prefetch_max_gb"]) * 1024**3),
+    int(config["prefetch_workers"]),
+    on_downloaded=loudness.analyze if loudness else None,
+    max_height=int(config["stream_max_height"]),
+)
+library = Library(
+    store,
+    [Path(directory) for directory in config["library_dirs"]],
+    int(config["library_probe_workers"]),
+    float(config["resolver_timeout"]),
+)
+planner = SourcePlanner(
+    int(config["stream_max_height"]),
+    float(config["stream_headroom"]),
+    int(config["source_planner_workers"]),
+    float(config["resolver_timeout"]),
+)
+metadata_cache = MetadataCache(
+    float(config["metadata_cache_ttl_hours"]) * 3600,
+    int(config["metadata_cache_max_entries"]),
+)
+nickname_cache = NicknameCache(store, float(config["nickname_cache_ttl_hours"]) * 3600)
+admission = AdmissionControl(
+    float(config["resolve_rate_per_minute"]) / 60,
+    float(config["resolve_burst"]),
+    float(config["failed_url_ttl_minutes"]) * 60,
+)
+loop_lag_monitor = LoopLagMonitor(metrics, float(config["loop_lag_threshold_ms"]) / 1000)
+command_seconds = metrics.histogram(
+    "karaoke_command_seconds", "Time taken to handle each slash command"
+)
+# the active queues, by the id of the channel each one plays in
+workers: dict[int, QueueWorker] = {}
+# (queue, user id) -> the songs a user is in the middle of adding to a queue
+songs_being_added: dict[tuple[str, int], int] = {}
 
 
-def get_song_metadata(song_url: str) -> Optional[dict]:
+async def get_song_metadata(song_url: str, queuename: str) -> Optional[dict]:
     """
     This obtains a dictionary containing, currently, the title and duration of a queued song.
-    It first tries yt-dlp, and upon failure to find the title and duration, tries ffmpeg (for direct links to media files)
+    Resolution runs in subprocesses managed by the resolver so the event loop is never blocked.
+    Songs in the library and previously resolved urls are served without spawning anything,
+    and urls which recently failed to resolve aren't tried again. Lookups take the slots of the
+    queue the song is added to.
     """
-    try:
-        downloader = subprocess.run(
-            [
-                "yt-dlp",
-                "--no-playlist",
-                "--print",
-                '{"title":%(title)j,"duration":"%(duration)j"}',
-                song_url,
-            ],
-            text=True,
-            capture_output=True,
-            encoding="utf8",
-            check=True,
-        )
-        dl_output = downloader.stdout
-        video_metadata = json.loads(dl_output)
-        if video_metadata["duration"] == "NA" or video_metadata["title"] == "NA":
-            # aise Exception("Could not fetch video duration from yt-dlp")
-            raise Exception("yt-dlp failure", downloader.stderr)
-        print(video_metadata)
-        video_metadata["duration"] = int(
-            float(video_metadata["duration"])
-        )  # some sties like niconico return decimal durations
+    video_metadata = await library.metadata(song_url)
+    if video_metadata:
         return video_metadata
-    except Exception as ytdlp_failure:  # try with ffprobe (if file directly)
-        try:
-            ffprober = subprocess.run(
-                [
-                    "ffprobe",
-                    "-v",
-                    "quiet",
-                    "-print_format",
-                    "json",
-                    "-show_format",
-                    "-show_streams",
-                    song_url,
-                ],
-                text=True,
-                capture_output=True,
-                encoding="utf8",
-                check=True,
-            )
-            ffprobe_output = json.loads(str(ffprober.stdout))
-            print(ffprober.stdout)
-            # sometimes, the tags are part of the stream block and sometimes part of the format block. Here we check both and merge the result
-            tags = {
-                tag.lower(): v
-                for d in [
-                    ffprobe_output.get("format", {}).get("tags", {}),
-                    ffprobe_output.get("streams", [{}])[0].get("tags", {}),
-                ]
-                for tag, v in d.items()
-            }
-            video_metadata = {
-                "title": tags["title"],
-                "duration": int(float(ffprobe_output.get("format", {})["duration"])),
-            }
-            return video_metadata
-
-        except Exception as ffprobe_failure:
-            # await interaction.followup.send("There was an error parsing the specified URL. Please double-check it")
-            print(
-                f"Error fetching metadata of song {song_url}:",
-                ytdlp_failure,
-                ffprobe_failure,
-            )
-            return None
+    video_metadata = await store.run(metadata_cache.get, song_url)
+    if video_metadata:
+        return video_metadata
+    if admission.recently_failed(song_url):
+        return None
+    video_metadata = await resolver.resolve(song_url, queuename)
+    if video_metadata:
+        await store.run(metadata_cache.put, song_url, video_metadata)
+    else:
+        admission.record_failure(song_url)
+    return video_metadata
+
+
+async def duplicate_rejection(
+    worker: QueueWorker,
+    interaction: discord.Interaction,
+    key: str,
+    replacing: Optional[int] = None,
+) -> Optional[str]:
+    """
+    Explains why a song can't be queued under duplicate_policy and recently_sung_hours,
+    or returns None if it can. The song being swapped out at position replacing doesn't count.
+    Operators can queue anything.
+    """
+    if is_karaoke_operator(interaction.user):
+        return None
+    queued = [song for song in worker.state.queued_with_key(key) if song.position != replacing]
+    if config["duplicate_policy"] == "queue" and queued:
+        return f"That song is already queued at position {queued[0].position}"
+    if config["duplicate_policy"] == "user":
+        for song in queued:
+            if song.discord_user_id == interaction.user.id:
+                return f"You already have that song queued at position {song.position}"
+    recent_hours = float(config["recently_sung_hours"])
+    if recent_hours > 0:
+        since = datetime.datetime.now() - datetime.timedelta(hours=recent_hours)
+        if await store.run(db.last_sung, interaction.guild_id, key, since):
+            return f"That song was already sung in the last {config['recently_sung_hours']} hours"
+    return None
+
+
+def queued_by_user(state: QueueState, user_id: int) -> int:
+    """The number of songs a user has queued, counting the ones still being added"""
+    return state.queued_count(user_id) + songs_being_added.get((state.name, user_id), 0)
+
+
+@contextlib.contextmanager
+def adding_songs(state: QueueState, user_id: int, count: int):
+    """Counts songs a user is adding toward their quota until they are in the queue"""
+    key = (state.name, user_id)
+    songs_being_added[key] = songs_being_added.get(key, 0) + count
+    try:
+        yield
+    finally:
+        songs_being_added[key] -= count
+        if not songs_being_added[key]:
+            del songs_being_added[key]
 
 
-def get_current_and_max_position(queuename: str) -> (int, int):
-    """Finds the current and max position of the active queue"""
-    query = "SELECT currentpos, maxpos FROM queues WHERE name = ?;"
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute(query, (queuename,))
-        return cursor.fetchone()
+def format_duration(seconds: int) -> str:
+    return str(datetime.timedelta(seconds=seconds))
 
 
-def increment_cur_pos(queuename: str):
-    """Increment the current position of the active queue"""
-    query = "UPDATE queues SET currentpos = ? WHERE name = ?;"
-    curpos, _ = get_current_and_max_position(queuename)
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute(query, (curpos + 1, current_queue))
-        cursor.close()
+def library_choice(entry: dict) -> app_commands.Choice[str]:
+    """An autocomplete choice for a library entry"""
+    name = f"{entry['artist']} - {entry['title']}" if entry["artist"] else entry["title"]
+    if entry["duration"] is not None:
+        name += f" ({format_duration(entry['duration'])})"
+    return app_commands.Choice(name=name[:100], value=choice_value(entry))
+
+
+def timed_command(command):
+    """Records how long a slash command handler takes in the command_seconds histogram"""
+
+    @functools.wraps(command)
+    async def timed(interaction: discord.Interaction, *args, **kwargs):
+        with command_seconds.timer(command=command.__name__):
+            return await command(interaction, *args, **kwargs)
+
+    return timed
 
 
 def is_karaoke_operator(user):
@@ -144,114 +216,294 @@ def is_karaoke_operator(user):
 # setting up the bot
 class aclient(discord.Client):
     def __init__(self):
-        super().__init__(intents=discord.Intents.default())
+        intents = discord.Intents.default()
+        # needed for on_member_update, and has to be enabled for the bot in the developer portal
+        intents.members = config["members_intent"].lower() == "true"
+        super().__init__(intents=intents)
         self.synced = False
+        self.restored = False
+        self.warming: Optional[asyncio.Task] = None
+        self.library_scan: Optional[asyncio.Task] = None
+
+    async def setup_hook(self):
+        loop_lag_monitor.start()
+        if config["library_dirs"]:
+            self.library_scan = asyncio.create_task(
+                library.run(float(config["library_rescan_minutes"]) * 60)
+            )
+        if config["metrics_port"]:
+            await metrics.start_http_server(config["metrics_host"], int(config["metrics_port"]))
 
     async def on_ready(self):
         await self.wait_until_ready()
-        self.botchannel = client.get_channel(int(config["channel_id"]))
+        if not self.restored:
+            self.restored = True
+            # get the queues playing again first, then warm up their caches while commands sync
+            restored = await restore_queues()
+            if restored:
+                self.warming = asyncio.create_task(warm_caches(restored))
         if not self.synced:
-            tree.copy_global_to(guild=discord.Object(id=config["guild_id"]))
-            await tree.sync(guild=discord.Object(id=config["guild_id"]))
+            await sync_commands()
             self.synced = True
 
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.nick != after.nick or before.name != after.name:
+            await nickname_cache.remember([after])
+
 
 client = aclient()
 tree = app_commands.CommandTree(client)
 
 
-@tasks.loop(seconds=5)
-async def playback_loop():
-    """The main loop to check for a new song and play it"""
-    # There is no active queue
-    if current_queue == "":
-        return
+def configured_guild_ids() -> list[int]:
+    """The guilds the bot serves: every one in guild_ids, or just guild_id if that is empty"""
+    return [int(guild_id) for guild_id in config["guild_ids"] or [config["guild_id"]]]
 
-    # There are no more songs in the queue
-    curr_index, max_index = get_current_and_max_position(current_queue)
-    if max_index <= curr_index:
-        return
 
-    # Fetch the current song and play it
-    with conn:
-        cursor = conn.cursor()
-        query = "SELECT * FROM songs WHERE position = ?;"
-        cursor.execute(query, (curr_index,))
-        row = cursor.fetchone()
-        column_names = [description[0] for description in cursor.description]
-        if row:
-            # Create a dictionary using column names and row values
-            current_song = {column_names[i]: row[i] for i in range(len(column_names))}
-        else:
-            print("Some kind of error ocurred fetching the next song")
+def make_player(queue_name: str) -> MpvPlayer:
+    """An mpv instance for a queue, with its own IPC socket and the queue's mpv_queue_args"""
+    socket_suffix = hashlib.sha1(queue_name.encode("utf8")).hexdigest()[:12]
+    return MpvPlayer(
+        config["mpv_path"],
+        Path(f"{config['mpv_ipc_socket']}.{socket_suffix}"),
+        [
+            "-fs",
+            f"--ytdl-raw-options=format-sort=res:{config['stream_max_height']}",
+            *config["mpv_queue_args"].get(queue_name, []),
+        ],
+    )
 
-        # If the song was revoked, skip it
-        if current_song["is_revoked"]:
-            increment_cur_pos(current_queue)
-            return
-        notification_message = f"<@{str(current_song['discord_user_id'])}>, it is now your turn to sing {current_song['title']}"
-        if current_song["collaborators"]:
-            notification_message += f" with {current_song['collaborators']}"
-        if current_song["lyrics_url"]:
-            notification_message += f"\nLyrics: {current_song['lyrics_url']}"
-        await client.botchannel.send(notification_message)
-        # Now try to play it
-        try:
-            process = subprocess.Popen(
-                [
-                    "mpv",
-                    "-fs",
-                    "-pause",
-                    "--ytdl-raw-options=format-sort=res:1080",
-                    current_song["url"],
-                ]
-            )
-            while process.poll() is None:
-                await asyncio.sleep(1)
-        except Exception as mpv_error:
-            print("Unable to launch mpv and play current song", mpv_error)
-        finished_at = datetime.datetime.now()
-
-        # Now update the db such that the song is completed
-        query = "UPDATE songs SET completed_time = ? WHERE position = ?;"
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute(query, (finished_at, current_song["position"]))
-            cursor.close()
-        increment_cur_pos(current_queue)
 
-class EmbedPages():
-    def __init__(self, fields: list[tuple[str, str]], max_page_chars: int, max_fields: int = 15):
-        self.embed_pages = []
-        curr_chars = 0
-        curr_embed = discord.Embed(title="Currently queued songs")
+async def activate_queue(
+    queue_name: str, guild_id: int, channel: discord.abc.Messageable
+) -> QueueWorker:
+    """
+    Makes a queue play in a channel, and returns its worker (which still has to be started).
+    Whatever queue the channel was playing is stopped, and so is this queue in any other channel.
+    """
+    worker = workers.get(channel.id)
+    if worker is not None and worker.name == queue_name:
+        return worker
+    for channel_id, worker in list(workers.items()):
+        if channel_id == channel.id or worker.name == queue_name:
+            await deactivate_queue(channel_id)
+    state = await store.run(QueueState.load, queue_name)
+    worker = QueueWorker(
+        state,
+        guild_id,
+        channel,
+        make_player(queue_name),
+        store,
+        prefetcher,
+        loudness,
+        planner,
+        int(config["prefetch_lookahead"]),
+        int(config["download_lookahead"]),
+        float(config["download_wait_minutes"]) * 60,
+        float(config["checkpoint_interval_seconds"]),
+        float(config["resume_rewind_seconds"]),
+    )
+    workers[channel.id] = worker
+    await store.run(db.set_queue_channel, queue_name, channel.id)
+    return worker
 
-        for [name, value] in fields:
-            # start a new page if we are over the character limit or field limit
-            if curr_chars + len(name) + len(value) > max_page_chars or len(curr_embed.fields) >= max_fields:
-                self.embed_pages.append(curr_embed)
-                curr_embed = discord.Embed(title="Currently queued songs")
-                curr_chars = 0
-            curr_embed.add_field(name=name, value=value, inline=False)
-            curr_chars += len(name) + len(value)
 
-        if curr_chars > 0:
-            self.embed_pages.append(curr_embed)
+async def deactivate_queue(channel_id: int):
+    """Stops the queue playing in a channel"""
+    worker = workers.pop(channel_id)
+    await store.run(db.set_queue_channel, worker.name, None)
+    await worker.stop()
+
+
+def worker_for(interaction: discord.Interaction) -> Optional[QueueWorker]:
+    """
+    The queue a command applies to: the one playing in the channel it was used in,
+    or the only queue playing in the guild
+    """
+    worker = workers.get(interaction.channel_id)
+    if worker is None:
+        guild_workers = [
+            worker for worker in workers.values() if worker.guild_id == interaction.guild_id
+        ]
+        if len(guild_workers) == 1:
+            worker = guild_workers[0]
+    return worker
+
 
+async def restore_queues() -> list[QueueWorker]:
+    """
+    Starts every queue that was playing before the bot restarted in its channel again,
+    picking the songs that were playing back up where they were checkpointed
+    """
+    restored = []
+    for queue_name, guild_id, channel_id in await store.run(db.get_active_queues):
+        channel = client.get_channel(channel_id)
+        if channel is None:
+            print(f"Unable to find channel {channel_id} to restore queue {queue_name} in")
+            continue
+        worker = await activate_queue(queue_name, guild_id, channel)
+        await worker.resume()
+        worker.start()
+        restored.append(worker)
+        print(f"Restored queue {queue_name}")
+    return restored
+
+
+async def warm_caches(restored: list[QueueWorker]):
+    """
+    Loads everything the next songs and the first /listsongs pages of the restored queues need,
+    all at the same time: display names of the users queued next, measured loudness and
+    prefetched downloads. Song titles and durations are already in memory once a queue is loaded.
+    """
+    warmups = []
+    for worker in restored:
+        state = worker.state
+        warmups.append(worker.refresh_prefetch())
+        guild = client.get_guild(worker.guild_id)
+        if guild is not None:
+            songs = state.songs_page(state.currentpos, 200)
+            warmups.append(nickname_cache.lookup(guild, {song.discord_user_id for song in songs}))
+        warmups.extend(
+            worker.song_volume(song.url)
+            for song in state.order.upcoming(worker.prefetch_lookahead)
+        )
+    for result in await asyncio.gather(*warmups, return_exceptions=True):
+        if isinstance(result, Exception):
+            print("Unable to warm up a cache", result)
+
+
+async def sync_guild_commands(guild_id: int):
+    """Syncs the slash commands with a guild, unless they haven't changed since the last sync"""
+    guild = discord.Object(id=guild_id)
+    tree.copy_global_to(guild=guild)
+    commands = [command.to_dict() for command in tree.get_commands(guild=guild)]
+    command_hash = hashlib.sha256(
+        json.dumps(commands, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+    state_key = f"command_hash:{guild_id}"
+    if await store.run(db.get_bot_state, state_key) == command_hash:
+        return
+    with discord_api_seconds.timer(call="tree_sync"):
+        await tree.sync(guild=guild)
+    await store.run(db.set_bot_state, state_key, command_hash)
+
+
+async def sync_commands():
+    """Syncs the slash commands with every guild the bot serves"""
+    await asyncio.gather(*(sync_guild_commands(guild_id) for guild_id in configured_guild_ids()))
+
+
+class EmbedPages():
+    """
+    Pages of queued songs which are built when they are first shown.
+    Each page starts at the position after the last song of the page before it, so showing
+    a page only reads the songs on that page, however long the queue is. Users are looked up
+    through the nickname cache, which fetches the users of the next few pages in the same request.
+    The most recently shown pages are kept so flipping back and forth doesn't rebuild them.
+    """
+
+    def __init__(
+        self,
+        worker: QueueWorker,
+        guild: discord.Guild,
+        first_position: int,
+        include_sung: bool = False,
+        max_page_chars: int = 500,
+        max_fields: int = 15,
+        cache_size: int = 8,
+        lookahead: int = 200,
+    ):
+        self.worker = worker
+        self.state = worker.state
+        self.guild = guild
+        self.include_sung = include_sung
+        self.max_page_chars = max_page_chars
+        self.max_fields = max_fields
+        self.cache_size = cache_size
+        self.lookahead = lookahead
+        # the first position of every page found so far
+        self.page_starts = [first_position]
+        # the page after this one doesn't exist, once it is known
+        self.last_page: Optional[int] = None
         self.current_page = 0
-        self.num_pages = len(self.embed_pages)
+        self._cache: dict[int, discord.Embed] = {}
 
-        for i in range(self.num_pages):
-            self.embed_pages[i].set_footer(text=f"Page {i+1}/{self.num_pages}")
+    async def _build_page(self, page: int) -> discord.Embed:
+        # one extra song shows whether there is a next page
+        songs = self.state.songs_page(
+            self.page_starts[page], self.max_fields + 1, self.include_sung
+        )
+        # the users of the songs after this page are worth fetching along with it
+        following = self.state.songs_page(
+            self.page_starts[page], self.lookahead, self.include_sung
+        )
+        nicknames = await nickname_cache.lookup(
+            self.guild,
+            set(song.discord_user_id for song in songs[: self.max_fields]),
+            set(song.discord_user_id for song in following),
+        )
+        embed = discord.Embed(title="Currently queued songs")
+        curr_chars = 0
+        next_song = None
+        for song in songs:
+            user_id = song.discord_user_id
+            # if the user is not in the guild, use their id instead
+            nickname = nicknames[user_id] if user_id in nicknames else "<@{0}>".format(user_id)
+            name = f"{song.position:0>2}. {nickname}"
+            if song.is_pending and song.position == self.state.next_position():
+                name += " (up now)"
+            elif song.is_pending and song.position >= self.state.currentpos:
+                name += f" (in {format_duration(self.worker.estimate_wait(song)[0])})"
+            value = f"{song.title} with {song.collaborators}" if song.collaborators else song.title
+            # start a new page if we are over the character limit or field limit
+            if embed.fields and (
+                curr_chars + len(name) + len(value) > self.max_page_chars
+                or len(embed.fields) >= self.max_fields
+            ):
+                next_song = song
+                break
+            embed.add_field(name=name, value=value, inline=False)
+            curr_chars += len(name) + len(value)
 
-    def get_current_page(self) -> discord.Embed:
-        return self.embed_pages[self.current_page]
-    
-    def next_page(self) -> discord.Embed:
-        self.current_page = (self.current_page + 1) % self.num_pages
+        if next_song is None:
+            self.last_page = page
+        elif page + 1 == len(self.page_starts):
+            self.page_starts.append(next_song.position)
+        embed.set_footer(
+            text=f"Page {page + 1}" + (f"/{page + 1}" if self.last_page == page else "")
+        )
+        return embed
+
+    async def get_current_page(self) -> discord.Embed:
+        embed = self._cache.pop(self.current_page, None)
+        if embed is None:
+            embed = await self._build_page(self.current_page)
+        # keep the most recently shown pages last, and drop the oldest
+        self._cache[self.current_page] = embed
+        while len(self._cache) > self.cache_size:
+            del self._cache[next(iter(self._cache))]
+        return embed
+
+    async def is_empty(self) -> bool:
+        return not (await self.get_current_page()).fields
+
+    async def next_page(self) -> discord.Embed:
+        if self.current_page + 1 == len(self.page_starts) and self.last_page is None:
+            # where the next page starts is only known once this one has been built
+            await self.get_current_page()
+        if self.current_page == self.last_page:
+            self.current_page = 0
+        else:
+            self.current_page += 1
+        return await self.get_current_page()
 
-    def previous_page(self) -> discord.Embed:
-        self.current_page = (self.current_page - 1) % self.num_pages
+    async def previous_page(self) -> discord.Embed:
+        # the number of pages isn't known until the last one is reached, so only wrap around then
+        if self.current_page > 0:
+            self.current_page -= 1
+        elif self.last_page is not None:
+            self.current_page = self.last_page
+        return await self.get_current_page()
 
 
 class PaginatedOutput(discord.ui.View):
@@ -270,56 +522,50 @@ class PaginatedOutput(discord.ui.View):
     
     @discord.ui.button(label="Previous", style=discord.ButtonStyle.blurple)
     async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.pages.previous_page()
-        await interaction.response.edit_message(embed=self.pages.get_current_page())
+        await interaction.response.edit_message(embed=await self.pages.previous_page())
 
     @discord.ui.button(label="Next", style=discord.ButtonStyle.blurple)
     async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.pages.next_page()
-        await interaction.response.edit_message(embed=self.pages.get_current_page())
+        await interaction.response.edit_message(embed=await self.pages.next_page())
 
 
 # command to initialize a queue
 @tree.command(
     name="initialize",
-    description="Creates a new empty karaoke queue or switches to queue of specified name",
+    description="Creates a new empty karaoke queue or switches this channel to queue of specified name",
 )
+@timed_command
 async def initialize(interaction: discord.Interaction, queue_name: str):
-    """Creates or switches to specific karaoke queue by name"""
-    global current_queue
+    """Creates or switches to specific karaoke queue by name, playing it in this channel"""
     if not is_karaoke_operator(interaction.user):
         await interaction.response.send_message("Cannot set queue, permission denied")
         return
-    writequery = "INSERT INTO queues (name, currentpos, maxpos, discord_guild_id, time_created) VALUES (?,?,?,?,?)"
     created_at = datetime.datetime.now()
     # check if queue exists
-    result = get_current_and_max_position(queue_name)
+    result = await store.run(db.get_queue_positions, queue_name)
     if result:
+        queue_guild_id = await store.run(db.get_queue_guild, queue_name)
+        if queue_guild_id is not None and int(queue_guild_id) != interaction.guild_id:
+            await interaction.response.send_message(
+                f"Queue {queue_name} belongs to another server"
+            )
+            return
         current_position, max_position = result
         await interaction.response.send_message(
             f"Fetched queue {queue_name} with current current_position {current_position} and max current_position {max_position}"
         )
     else:
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                writequery, (queue_name, 0, 0, config["guild_id"], created_at)
-            )
-            await interaction.response.send_message(f"New queue {queue_name} created!")
-    current_queue = queue_name
-    if not playback_loop.is_running():
-        playback_loop.start()
+        await store.run(db.create_queue, queue_name, interaction.guild_id, created_at)
+        await interaction.response.send_message(f"New queue {queue_name} created!")
+    worker = await activate_queue(queue_name, interaction.guild_id, interaction.channel)
+    worker.start()
 
 
 @tree.command(name="listqueues", description="Lists existing queues")
+@timed_command
 async def listqueues(interaction: discord.Interaction):
-    """Lists all existing queues"""
-    query = "SELECT name, time_created FROM queues"
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        cursor.close()
+    """Lists all existing queues of this server"""
+    rows = await store.run(db.list_queues, interaction.guild_id)
     await interaction.response.send_message(
         "Current queues: \n"
         + "\n".join(["{0}, created on {1}".format(row[0], row[1]) for row in rows])
@@ -327,6 +573,7 @@ async def listqueues(interaction: discord.Interaction):
 
 
 @tree.command(name="addsong", description="Add a song to the queue")
+@timed_command
 async def addsong(
     interaction: discord.Interaction,
     song_url: str,
@@ -335,75 +582,209 @@ async def addsong(
     notes: Optional[str],
 ):
     """Adds a song to the queue"""
-    if current_queue == "":
+    worker = worker_for(interaction)
+    if worker is None:
         await interaction.response.send_message("No queues are currently active.")
         return
-    with conn:
-        cursor = conn.cursor()
-
-        # First, ensure the user is allowed to queue
-        if not is_karaoke_operator(interaction.user):
-            cursor.execute(
-                "SELECT COUNT(*) FROM songs WHERE is_revoked = FALSE AND completed_time IS NULL and discord_user_id = ?;",
-                (interaction.user.id,),
+    state = worker.state
+    song_url = await library.expand(song_url)
+    # First, ensure the user is allowed to queue
+    if not is_karaoke_operator(interaction.user):
+        currently_queued_by_user = queued_by_user(state, interaction.user.id)
+        if currently_queued_by_user >= int(config["max_queued_per_user"]):
+            await interaction.response.send_message(
+                f"You currently already have {currently_queued_by_user} songs queued. Either swap an existing one or wait until you go next before queuing again"
             )
+            return
+    rejection = admission.admit(
+        interaction.user.id, [song_url], is_karaoke_operator(interaction.user)
+    )
+    if rejection:
+        await interaction.response.send_message(rejection)
+        return
 
-            currently_queued_by_user = cursor.fetchone()[0]
-            if currently_queued_by_user >= int(config["max_queued_per_user"]):
-                await interaction.response.send_message(
-                    f"You currently already have {currently_queued_by_user} songs queued. Either swap an existing one or wait until you go next before queuing again"
-                )
-                cursor.close()
-                return
-        # Try getting metadata with yt-dlp (for video sites)
-        await interaction.response.defer()  # sometimes takes more than 3 seconds
-        video_metadata = get_song_metadata(song_url)
-        if not video_metadata:
+    # Try getting metadata with yt-dlp (for video sites)
+    await interaction.response.defer()  # sometimes takes more than 3 seconds
+    video_metadata = await get_song_metadata(song_url, state.name)
+    if not video_metadata:
+        await interaction.followup.send(
+            "There was an error fetching the song's metadata. Check the URL."
+        )
+        return
+
+    key = song_key(song_url, video_metadata)
+    rejection = await duplicate_rejection(worker, interaction, key)
+    if rejection:
+        await interaction.followup.send(rejection)
+        return
+
+    song = {
+        "url": song_url,
+        "title": video_metadata["title"],
+        "duration": int(video_metadata["duration"]),
+        "added_time": datetime.datetime.now(),
+        "lyrics_url": lyrics_url,
+        "notes": notes,
+        "collaborators": collaborators,
+        "discord_user_id": interaction.user.id,
+        "discord_guild_id": interaction.guild_id,
+        "song_key": key,
+    }
+    # the user's other songs may have been added while this one was resolved
+    if not is_karaoke_operator(interaction.user):
+        currently_queued_by_user = queued_by_user(state, interaction.user.id)
+        if currently_queued_by_user >= int(config["max_queued_per_user"]):
             await interaction.followup.send(
-                "There was an error fetching the song's metadata. Check the URL."
+                f"You currently already have {currently_queued_by_user} songs queued. Either swap an existing one or wait until you go next before queuing again"
             )
             return
-
-        query = "INSERT INTO songs (url, title, duration, added_time, lyrics_url, notes, position, collaborators, completed_time, is_revoked, discord_user_id, discord_guild_id) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"
-        created_at = datetime.datetime.now()
+    with adding_songs(state, interaction.user.id, 1):
         try:
-            _, max_position = get_current_and_max_position(current_queue)
-            cursor.execute(
-                query,
-                (
-                    song_url,
-                    video_metadata["title"],
-                    int(video_metadata["duration"]),
-                    created_at,
-                    lyrics_url,
-                    notes,
-                    max_position,
-                    collaborators,
-                    None,
-                    False,
-                    interaction.user.id,
-                    config["guild_id"],
-                ),
-            )
-
+            song["position"] = await store.run(db.append_song, state.name, song)
         except Exception as database_error:
             await interaction.followup.send(
                 "There was an error adding the song to the database. Is it a duplicate?"
             )
             print(f"Error adding song {song_url} to database", database_error)
             return
-        max_position += 1
-        # save the new position
-        updatequery = "UPDATE queues SET maxpos = ? WHERE name = ?;"
-        cursor.execute(updatequery, (max_position, current_queue))
-        cursor.close()
+        state.append(Song.from_row(song))
+    worker.plan(state.get_song(song["position"]))
+    worker.notify()
+    await worker.refresh_prefetch()
+    await nickname_cache.remember([interaction.user])
     await interaction.followup.send(f"Added song {video_metadata['title']}\n{song_url}")
 
 
+@tree.command(
+    name="addsongs",
+    description="Add several songs (separated by spaces) or every song in a playlist to the queue",
+)
+@timed_command
+async def addsongs(interaction: discord.Interaction, song_urls: str):
+    """Adds several songs, or the songs of a playlist, to the queue at once"""
+    worker = worker_for(interaction)
+    if worker is None:
+        await interaction.response.send_message("No queues are currently active.")
+        return
+    state = worker.state
+    urls = song_urls.split()
+    limit = int(config["max_bulk_songs"])
+    # non-operators may only fill up their remaining quota
+    if not is_karaoke_operator(interaction.user):
+        currently_queued_by_user = queued_by_user(state, interaction.user.id)
+        limit = min(limit, int(config["max_queued_per_user"]) - currently_queued_by_user)
+        if limit <= 0:
+            await interaction.response.send_message(
+                f"You currently already have {currently_queued_by_user} songs queued. Either swap an existing one or wait until you go next before queuing again"
+            )
+            return
+    rejection = admission.admit(
+        interaction.user.id, urls[:limit], is_karaoke_operator(interaction.user)
+    )
+    if rejection:
+        await interaction.response.send_message(rejection)
+        return
+    await interaction.response.defer()
+    progress = await interaction.followup.send(
+        f"Resolving {len(urls)} song(s)...", wait=True
+    )
+
+    # a single url may be a playlist, which one flat yt-dlp run can list in full
+    entries = [(url, None) for url in urls[:limit]]
+    if len(urls) == 1:
+        try:
+            entries = await resolver.resolve_playlist(urls[0], limit, state.name) or entries
+        except Exception as playlist_error:
+            print(f"Error listing playlist {urls[0]}", playlist_error)
+
+    # resolve whatever the playlist listing didn't cover concurrently, reporting progress as we go
+    resolved = 0
+    last_edit = time.monotonic()
+
+    async def resolve_entry(song_url: str, video_metadata: Optional[dict]):
+        nonlocal resolved, last_edit
+        if video_metadata is None:
+            video_metadata = await get_song_metadata(song_url, state.name)
+        else:
+            await store.run(metadata_cache.put, song_url, video_metadata)
+        resolved += 1
+        if time.monotonic() - last_edit > 2 and resolved < len(entries):
+            last_edit = time.monotonic()
+            await progress.edit(content=f"Resolved {resolved}/{len(entries)} song(s)...")
+        return song_url, video_metadata
+
+    results = await asyncio.gather(*(resolve_entry(*entry) for entry in entries))
+    added_at = datetime.datetime.now()
+    songs = []
+    rejected = 0
+    batch_keys = set()
+    for song_url, video_metadata in results:
+        if not video_metadata:
+            continue
+        key = song_key(song_url, video_metadata)
+        # the same song twice in one batch is a duplicate too, unless duplicates are allowed
+        if (
+            key in batch_keys and config["duplicate_policy"] != "allow"
+        ) or await duplicate_rejection(worker, interaction, key):
+            rejected += 1
+            continue
+        batch_keys.add(key)
+        songs.append(
+            {
+                "url": song_url,
+                "title": video_metadata["title"],
+                "duration": int(video_metadata["duration"]),
+                "added_time": added_at,
+                "lyrics_url": None,
+                "notes": None,
+                "collaborators": None,
+                "discord_user_id": interaction.user.id,
+                "discord_guild_id": interaction.guild_id,
+                "song_key": key,
+            }
+        )
+    failed = [song_url for song_url, video_metadata in results if not video_metadata]
+
+    # the user's other songs may have been added while these were resolved
+    over_quota = 0
+    if not is_karaoke_operator(interaction.user):
+        remaining = int(config["max_queued_per_user"]) - queued_by_user(state, interaction.user.id)
+        over_quota = max(len(songs) - max(remaining, 0), 0)
+        songs = songs[: len(songs) - over_quota]
+    with adding_songs(state, interaction.user.id, len(songs)):
+        try:
+            added = await store.run(db.append_songs, state.name, songs) if songs else []
+        except Exception as database_error:
+            await progress.edit(content="There was an error adding the songs to the database.")
+            print("Error adding songs to database", database_error)
+            return
+        for song in added:
+            state.append(Song.from_row(song))
+    for song in added:
+        worker.plan(state.get_song(song["position"]))
+    worker.notify()
+    await worker.refresh_prefetch()
+    await nickname_cache.remember([interaction.user])
+
+    summary = f"Added {len(added)} song(s)"
+    if added:
+        summary += f" at positions {added[0]['position']}-{added[-1]['position']}"
+    if len(songs) - len(added) + rejected:
+        summary += f"\nSkipped {len(songs) - len(added) + rejected} duplicate or recently sung song(s)"
+    if failed:
+        summary += "\nCould not fetch metadata for: " + " ".join(failed)
+    if over_quota:
+        summary += f"\nSkipped {over_quota} song(s) past your limit of {config['max_queued_per_user']} queued songs"
+    if len(urls) > limit:
+        summary += f"\nOnly the first {limit} url(s) were added"
+    await progress.edit(content=summary[:2000])
+
+
 @tree.command(
     name="swapsong",
     description="Swap your song with a specified index with a new one while keeping place in the queue",
 )
+@timed_command
 async def swapsong(
     interaction: discord.Interaction,
     position: int,
@@ -413,179 +794,302 @@ async def swapsong(
     notes: Optional[str],
 ):
     """Swap your song with a specified index with a new one while keeping place in the queue"""
-    if current_queue == "":
+    worker = worker_for(interaction)
+    if worker is None:
         await interaction.response.send_message("No queues are currently active.")
         return
+    state = worker.state
+    song_url = await library.expand(song_url)
     # ensure user was the creator of the entry
-    query = "SELECT discord_user_id FROM songs WHERE position = ?;"
-    with conn:
-        cursor = conn.cursor()
-        cursor.execute(query, (position,))
-        userofsong = cursor.fetchone()[0]
-        if not interaction.user.id == userofsong:
-            await interaction.response.send_message(
-                "You only have permission to remove your own songs"
-            )
-            return
-        # Try getting metadata with yt-dlp (for video sites)
-        await interaction.response.defer()  # sometimes takes more than 3 seconds
-        video_metadata = get_song_metadata(song_url)
-        if not video_metadata:
-            await interaction.followup.send(
-                "There was an error fetching the song's metadata. Check the URL."
-            )
-            return
-        query = "UPDATE songs SET url = ?, title = ?, duration = ?, lyrics_url = ?, notes = ?, collaborators = ?, is_revoked = ?, discord_user_id = ?, discord_guild_id = ? WHERE position = ?;"
-        try:
-            cursor.execute(
-                query,
-                (
-                    song_url,
-                    video_metadata["title"],
-                    int(video_metadata["duration"]),
-                    lyrics_url,
-                    notes,
-                    collaborators,
-                    False,
-                    interaction.user.id,
-                    config["guild_id"],
-                    position,
-                ),
-            )
-        except Exception as database_error:
-            await interaction.followup.send(
-                "There was an error adding the song to the database. Is it a duplicate?"
-            )
-            print(f"Error adding song {song_url} to database", database_error)
-            return
+    song = state.get_song(position)
+    userofsong = song.discord_user_id if song else None
+    if not interaction.user.id == userofsong:
+        await interaction.response.send_message(
+            "You only have permission to remove your own songs"
+        )
+        return
+    rejection = admission.admit(
+        interaction.user.id, [song_url], is_karaoke_operator(interaction.user)
+    )
+    if rejection:
+        await interaction.response.send_message(rejection)
+        return
+    # Try getting metadata with yt-dlp (for video sites)
+    await interaction.response.defer()  # sometimes takes more than 3 seconds
+    video_metadata = await get_song_metadata(song_url, state.name)
+    if not video_metadata:
+        await interaction.followup.send(
+            "There was an error fetching the song's metadata. Check the URL."
+        )
+        return
+    key = song_key(song_url, video_metadata)
+    rejection = await duplicate_rejection(worker, interaction, key, replacing=position)
+    if rejection:
+        await interaction.followup.send(rejection)
+        return
+    song = {
+        "url": song_url,
+        "title": video_metadata["title"],
+        "duration": int(video_metadata["duration"]),
+        "lyrics_url": lyrics_url,
+        "notes": notes,
+        "collaborators": collaborators,
+        "discord_user_id": interaction.user.id,
+        "discord_guild_id": interaction.guild_id,
+        "song_key": key,
+    }
+    try:
+        await store.run(db.swap_song, state.name, position, song)
+    except Exception as database_error:
+        await interaction.followup.send(
+            "There was an error adding the song to the database. Is it a duplicate?"
+        )
+        print(f"Error adding song {song_url} to database", database_error)
+        return
+    song["position"] = position
+    state.swap(position, Song.from_row(song))
+    worker.plan(state.get_song(position))
 
+    await worker.refresh_prefetch()
     await interaction.followup.send(
         f"Swapped position {position} with {video_metadata['title']}\n{song_url}"
     )
 
 
+@addsong.autocomplete("song_url")
+@swapsong.autocomplete("song_url")
+async def song_url_autocomplete(
+    interaction: discord.Interaction, current: str
+) -> list[app_commands.Choice[str]]:
+    """Suggests songs from the library matching what has been typed so far"""
+    entries = await library.search(current, 25, caller="autocomplete")
+    return [library_choice(entry) for entry in entries]
+
+
+@tree.command(name="search", description="Searches the song library")
+@timed_command
+async def search(interaction: discord.Interaction, query: str):
+    """Lists the library songs best matching a search, to queue with /addsong"""
+    entries = await library.search(query, 10)
+    if not entries:
+        await interaction.response.send_message(
+            f"No songs in the library match {query}", ephemeral=True
+        )
+        return
+    lines = []
+    for entry in entries:
+        lines.append(library_choice(entry).name)
+        lines.append(entry["url"])
+    await interaction.response.send_message("\n".join(lines)[:2000], ephemeral=True)
+
+
 # command to manually set the current position
 @tree.command(
     name="setposition",
     description="Stops the current playback and sets the current position to a specified value",
 )
+@timed_command
 async def setposition(interaction: discord.Interaction, new_position: int):
     """Stops the current playback and sets the current position to a specified value"""
-    if current_queue == "":
+    worker = worker_for(interaction)
+    if worker is None:
         await interaction.response.send_message("No queues are currently active.")
         return
+    state = worker.state
     if not is_karaoke_operator(interaction.user):
         await interaction.response.send_message(
             "Cannot set position, permission denied"
         )
         return
-    _, max_position = get_current_and_max_position(current_queue)
+    max_position = state.maxpos
     if new_position > max_position:
         await interaction.response.send_message(
             f"Cannot set position to {new_position}, it exceeds max position of {max_position}"
         )
         return
-    # terminate the current playback loop and restart it at new position
-    playback_loop.cancel()
-    with conn:
-        cursor = conn.cursor()
-        updatequery = "UPDATE queues SET currentpos = ? WHERE name = ?;"
-        cursor.execute(updatequery, (new_position, current_queue))
-        cursor.close()
-    while playback_loop.is_running():
-        await asyncio.sleep(1)
-    playback_loop.start()
+    await store.run(db.set_position, state.name, new_position)
+    state.set_position(new_position)
+    # stop the current song, and the playback loop picks up at the new position
+    worker.notify(interrupt=True)
     await interaction.response.send_message(f"Set position to {new_position}")
 
 
+@tree.command(
+    name="setordering",
+    description="Sets the order songs are played in: as queued, or taking turns between users",
+)
+@timed_command
+async def setordering(
+    interaction: discord.Interaction, ordering: Literal["fifo", "round_robin"]
+):
+    """Sets the order songs are played in: as queued, or taking turns between users"""
+    worker = worker_for(interaction)
+    if worker is None:
+        await interaction.response.send_message("No queues are currently active.")
+        return
+    state = worker.state
+    if not is_karaoke_operator(interaction.user):
+        await interaction.response.send_message(
+            "Cannot set ordering, permission denied"
+        )
+        return
+    await store.run(db.set_queue_ordering, state.name, ordering)
+    state.set_ordering(ordering)
+    worker.notify()
+    await worker.refresh_prefetch()
+    await interaction.response.send_message(f"Queue {state.name} now plays songs in {ordering} order")
+
+
 @tree.command(name="listsongs", description="Lists currently queued songs")
+@timed_command
 async def listsongs(interaction: discord.Interaction, include_old: Optional[bool]):
     """Lists queued songs"""
-    if current_queue == "":
+    worker = worker_for(interaction)
+    if worker is None:
         await interaction.response.send_message("No queues are currently active.")
         return
-    curpos, _ = get_current_and_max_position(current_queue)
-    with conn:
-        cursor = conn.cursor()
-        if include_old:
-            query = "SELECT * FROM songs WHERE is_revoked = FALSE ORDER BY position;"
-            cursor.execute(query)
-        else:
-            query = "SELECT * FROM songs WHERE position >= ? AND is_revoked = FALSE ORDER BY position;"
-            cursor.execute(query, (curpos,))
-        rows = cursor.fetchall()
-        column_names = [description[0] for description in cursor.description]
-        # Create a list of dictionaries
-        result_list = []
-        for row in rows:
-            song_dict = {column_names[i]: row[i] for i in range(len(column_names))}
-            result_list.append(song_dict)
-        cursor.close()
-
-    discord_user_ids = set(int(song["discord_user_id"]) for song in result_list)
-    missing_members = []
-    nicknames = {}
-
-    # get members from cache if possible or add to missing_members
-    for user_id in discord_user_ids:
-        member = interaction.guild.get_member(user_id)
-        if member is not None:
-            nicknames[user_id] = member.nick if member.nick is not None else member.name
-        else:
-            missing_members.append(user_id)
-
-    # query missing members
-    if len(missing_members) > 0:
-        for member in await interaction.guild.query_members(user_ids=missing_members):
-            nicknames[member.id] = (
-                member.nick if member.nick is not None else member.name
-            )
-
-    if not result_list:
+    state = worker.state
+    pages = EmbedPages(
+        worker,
+        interaction.guild,
+        0 if include_old else state.currentpos,
+        include_sung=bool(include_old),
+    )
+    if await pages.is_empty():
         await interaction.response.send_message("There are no songs currently queued")
         return
-    
-    fields = []
-    for song in result_list:
-        user_id = int(song["discord_user_id"])
-        # if the user is not in the guild, use their id instead
-        nickname = nicknames[user_id] if user_id in nicknames else "<@{0}>".format(user_id)
-        field_title = f"{song['position']:0>2}. {nickname}"
-        field_value = f"{song['title']} with {song['collaborators']}" if song["collaborators"] else song['title']
-        fields.append((field_title, field_value))
 
-    pages = EmbedPages(fields, 500)
-    await interaction.response.send_message(embed=pages.get_current_page(), view=PaginatedOutput(pages, interaction.user))
+    with discord_api_seconds.timer(call="send_message"):
+        await interaction.response.send_message(embed=await pages.get_current_page(), view=PaginatedOutput(pages, interaction.user))
+
+
+@tree.command(
+    name="eta",
+    description="Estimates when your next song, or the song at a position, will be up",
+)
+@timed_command
+async def eta(interaction: discord.Interaction, position: Optional[int]):
+    """Estimates when your next song, or the song at a position, will be up"""
+    worker = worker_for(interaction)
+    if worker is None:
+        await interaction.response.send_message("No queues are currently active.")
+        return
+    state = worker.state
+    if position is None:
+        song = state.next_song_of(interaction.user.id)
+    else:
+        song = state.get_song(position)
+    if song is None or not song.is_pending or song.position < state.currentpos:
+        if position is None:
+            await interaction.response.send_message("You have no songs waiting in the queue")
+        else:
+            await interaction.response.send_message(f"There is no song waiting at position {position}")
+        return
+    if song.position == state.next_position():
+        await interaction.response.send_message(f"{song.title} (position {song.position}) is up now")
+        return
+    wait, songs_ahead = worker.estimate_wait(song)
+    await interaction.response.send_message(
+        f"{song.title} (position {song.position}) is up in about {format_duration(wait)}, after {songs_ahead} song(s)"
+    )
 
 
 # command to mark a song as revoked
 @tree.command(name="removesong", description="Removes song at specified index")
+@timed_command
 async def removesong(interaction: discord.Interaction, position: int):
     """Removes song at specified index"""
-    if current_queue == "":
+    worker = worker_for(interaction)
+    if worker is None:
         await interaction.response.send_message("No queues are currently active.")
         return
+    state = worker.state
 
     # ensure user is either admin or was the creator of the entry
     if not is_karaoke_operator(interaction.user):
-        query = "SELECT discord_user_id FROM songs WHERE position = ?;"
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute(query, (position,))
-            userofsong = cursor.fetchone()[0]
-            cursor.close()
+        song = state.get_song(position)
+        userofsong = song.discord_user_id if song else None
         if not interaction.user.id == userofsong:
             await interaction.response.send_message(
                 "You only have permission to remove your own songs"
             )
             return
 
-    with conn:
-        cursor = conn.cursor()
-        updatequery = "UPDATE songs SET is_revoked = TRUE WHERE position = ?;"
-        cursor.execute(updatequery, (position,))
-        cursor.close()
+    await store.run(db.revoke_song, state.name, position)
+    state.revoke(position)
+    worker.notify()
+    await worker.refresh_prefetch()
     await interaction.response.send_message(f"Removed song at {position}")
 
 
-client.run(config["token"])
+@tree.command(
+    name="history",
+    description="Shows who and what has been sung the most, or exports every song sung",
+)
+@timed_command
+async def history(interaction: discord.Interaction, export: Optional[Literal["csv", "jsonl"]]):
+    """Shows the singing history of this server from its running totals, or exports it as a file"""
+    if not is_karaoke_operator(interaction.user):
+        await interaction.response.send_message("Cannot show history, permission denied")
+        return
+    if export:
+        await interaction.response.defer(ephemeral=True)
+        with tempfile.TemporaryDirectory() as export_dir:
+            path = Path(export_dir).joinpath(f"history.{export}")
+            count = await write_export(store, interaction.guild_id, export, path)
+            if path.stat().st_size > interaction.guild.filesize_limit:
+                await interaction.followup.send(
+                    f"The history of {count} songs is too large to upload", ephemeral=True
+                )
+                return
+            await interaction.followup.send(
+                f"Exported {count} songs", file=discord.File(path), ephemeral=True
+            )
+        return
+
+    summary = await store.run(db.get_history_summary, interaction.guild_id, 10)
+    if not summary["queues"]:
+        await interaction.response.send_message("Nothing has been sung yet", ephemeral=True)
+        return
+    names = await nickname_cache.lookup(
+        interaction.guild, {user["discord_user_id"] for user in summary["users"]}
+    )
+    lines = ["Queues:"]
+    for queue in summary["queues"]:
+        lines.append(
+            f"  {queue['queue']}: {queue['songs_sung']} songs, {format_duration(queue['seconds_sung'])} sung, last on {str(queue['last_sung_time'])[:16]}"
+        )
+    lines.append("Top singers:")
+    for rank, user in enumerate(summary["users"], start=1):
+        name = names.get(user["discord_user_id"], f"user {user['discord_user_id']}")
+        lines.append(
+            f"  {rank}. {name}: {user['songs_sung']} songs ({format_duration(user['seconds_sung'])})"
+        )
+    lines.append("Most sung songs:")
+    for rank, song in enumerate(summary["songs"], start=1):
+        lines.append(f"  {rank}. {song['title']}: {song['play_count']} times")
+    output = "\n".join(lines)
+    if len(output) > 1900:
+        output = output[:1900] + "\n..."
+    await interaction.response.send_message(f"```\n{output}\n```", ephemeral=True)
+
+
+@tree.command(name="stats", description="Shows timing and cache statistics for the bot")
+@timed_command
+async def stats(interaction: discord.Interaction):
+    """Shows timing and cache statistics for the bot"""
+    if not is_karaoke_operator(interaction.user):
+        await interaction.response.send_message("Cannot show stats, permission denied")
+        return
+    cache_stats = await store.run(metadata_cache.stats)
+    lines = [
+        "metadata cache: {hits} hits, {misses} misses, {entries} entries".format(**cache_stats)
+    ] + metrics.summary()
+    output = "\n".join(lines)
+    if len(output) > 1900:
+        output = output[:1900] + "\n..."
+    await interaction.response.send_message(f"```\n{output}\n```", ephemeral=True)
+
+
+if __name__ == "__main__":
+    client.run(config["token"])
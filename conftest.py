@@ -0,0 +1,2 @@
+# pytest puts the directory of this file on sys.path, so the tests can import the bot's
+# modules when they are run with plain `pytest`
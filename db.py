@@ -1,5 +1,9 @@
 import sqlite3
+import datetime
 from pathlib import Path
+from typing import Optional
+
+from metadata_cache import normalize_url, song_key
 
 _CREATE_QUEUES_TABLE = """
 CREATE TABLE IF NOT EXISTS queues (
@@ -38,13 +42,732 @@ CREATE TABLE IF NOT EXISTS songs (
 )
 """
 
-def set_up_database():
+_CREATE_METADATA_CACHE_TABLE = """
+CREATE TABLE IF NOT EXISTS metadata_cache (
+    normalized_url TEXT PRIMARY KEY,
+    title TEXT,
+    duration INTEGER,
+    extractor_id TEXT,
+    resolved_time REAL,
+    last_used_time REAL
+)
+"""
+
+_CREATE_METADATA_CACHE_INDEX = """
+CREATE INDEX IF NOT EXISTS metadata_cache_last_used ON metadata_cache (last_used_time)
+"""
+
+_CREATE_SCHEMA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER
+)
+"""
+
+
+def _backfill_song_keys(conn: sqlite3.Connection):
+    """
+    Gives every song the key metadata_cache.song_key would give it when it is added, using the
+    extractor id cached for its normalized url if there is one
+    """
+    extractor_ids = dict(
+        conn.execute(
+            "SELECT normalized_url, extractor_id FROM metadata_cache WHERE extractor_id IS NOT NULL;"
+        )
+    )
+    conn.executemany(
+        "UPDATE songs SET song_key = ? WHERE rowid = ?;",
+        [
+            (song_key(url, {"extractor_id": extractor_ids.get(normalize_url(url))}), rowid)
+            for rowid, url in conn.execute("SELECT rowid, url FROM songs;").fetchall()
+        ],
+    )
+
+
+# Forward migrations from the original schema. Each entry upgrades the database by one
+# version, and is applied in a single transaction. A step is either an SQL statement, or a
+# function of the connection for data changes that need Python. Only ever append to this list.
+_MIGRATIONS = [
+    # 1: scope songs to a queue, and index the queue position and per-user lookups.
+    # Songs from before queues were tracked are assigned to the most recently created queue.
+    [
+        """
+        CREATE TABLE songs_new (
+            url TEXT,
+            title TEXT,
+            duration INTEGER,
+            added_time TIMESTAMP,
+            lyrics_url TEXT,
+            notes TEXT,
+            position INTEGER,
+            collaborators TEXT,
+            completed_time TIMESTAMP,
+            is_revoked BOOLEAN,
+            discord_user_id INTEGER,
+            discord_guild_id INTEGER,
+            queue TEXT,
+            FOREIGN KEY(discord_user_id) REFERENCES users(discord_user_id),
+            FOREIGN KEY(queue) REFERENCES queues(name),
+            PRIMARY KEY (queue, url, discord_user_id)
+        )
+        """,
+        """
+        INSERT INTO songs_new SELECT *, (SELECT name FROM queues ORDER BY time_created DESC LIMIT 1) FROM songs
+        """,
+        "DROP TABLE songs",
+        "ALTER TABLE songs_new RENAME TO songs",
+        "CREATE INDEX songs_queue_position ON songs (queue, position)",
+        "CREATE INDEX songs_user_pending ON songs (discord_user_id, completed_time, is_revoked)",
+    ],
+    # 2: record when a user's display name was last seen, so the users table can back the nickname cache
+    [
+        "ALTER TABLE users ADD COLUMN updated_time REAL",
+    ],
+    # 3: let each queue choose the order its songs are played in
+    [
+        "ALTER TABLE queues ADD COLUMN ordering TEXT NOT NULL DEFAULT 'fifo'",
+    ],
+    # 4: remember the measured loudness of each song, so it is only analyzed once
+    [
+        """
+        CREATE TABLE loudness (
+            normalized_url TEXT PRIMARY KEY,
+            integrated_lufs REAL,
+            measured_time REAL
+        )
+        """,
+    ],
+    # 5: keep what the bot was doing across restarts, like the active queue and playback progress
+    [
+        """
+        CREATE TABLE bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """,
+    ],
+    # 6: serve several guilds at once. Each active queue plays in the channel it was started from,
+    # and display names are kept per guild, since members have a nickname in each one.
+    [
+        "ALTER TABLE queues ADD COLUMN channel_id INTEGER",
+        """
+        CREATE TABLE member_names (
+            discord_guild_id INTEGER,
+            discord_user_id INTEGER,
+            username TEXT,
+            updated_time REAL,
+            PRIMARY KEY (discord_guild_id, discord_user_id)
+        )
+        """,
+        """
+        INSERT OR IGNORE INTO member_names
+        SELECT DISTINCT songs.discord_guild_id, users.discord_user_id, users.username, users.updated_time
+        FROM users JOIN songs ON songs.discord_user_id = users.discord_user_id
+        WHERE users.updated_time IS NOT NULL
+        """,
+    ],
+    # 7: index the song library for /search and song autocomplete. Every scanned file is a source,
+    # kept even if it had nothing playable so it isn't probed again until its mtime or size changes.
+    # A source adds one entry per song (a media file is its own entry, a playlist lists several),
+    # and the full text index follows the entries through triggers.
+    [
+        """
+        CREATE TABLE library_sources (
+            path TEXT PRIMARY KEY,
+            mtime REAL,
+            size INTEGER
+        )
+        """,
+        """
+        CREATE TABLE library (
+            id INTEGER PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE,
+            source TEXT NOT NULL REFERENCES library_sources(path),
+            title TEXT,
+            artist TEXT,
+            duration INTEGER
+        )
+        """,
+        "CREATE INDEX library_source ON library (source)",
+        """
+        CREATE VIRTUAL TABLE library_search USING fts5(
+            title, artist, url,
+            content='library', content_rowid='id',
+            prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER library_insert AFTER INSERT ON library BEGIN
+            INSERT INTO library_search (rowid, title, artist, url) VALUES (new.id, new.title, new.artist, new.url);
+        END
+        """,
+        """
+        CREATE TRIGGER library_delete AFTER DELETE ON library BEGIN
+            INSERT INTO library_search (library_search, rowid, title, artist, url) VALUES ('delete', old.id, old.title, old.artist, old.url);
+        END
+        """,
+        """
+        CREATE TRIGGER library_update AFTER UPDATE ON library BEGIN
+            INSERT INTO library_search (library_search, rowid, title, artist, url) VALUES ('delete', old.id, old.title, old.artist, old.url);
+            INSERT INTO library_search (rowid, title, artist, url) VALUES (new.id, new.title, new.artist, new.url);
+        END
+        """,
+    ],
+    # 8: identify songs by what they are rather than the exact url they were added with
+    # (see metadata_cache.song_key), so duplicates and recently sung songs can be looked up.
+    # Existing songs are given their key in Python, the same way new songs are.
+    [
+        "ALTER TABLE songs ADD COLUMN song_key TEXT",
+        _backfill_song_keys,
+        "CREATE INDEX songs_song_key_completed ON songs (song_key, completed_time)",
+    ],
+    # 9: remember how each song was planned to be played (see source_planner.py)
+    [
+        "ALTER TABLE songs ADD COLUMN source_plan TEXT",
+        "ALTER TABLE songs ADD COLUMN stream_height INTEGER",
+    ],
+    # 10: keep running totals of what has been sung, per user, per song and per queue, so /history
+    # doesn't scan the songs table. They are built from the songs already sung, and from then on
+    # updated by advance_position as each song is completed.
+    [
+        """
+        CREATE TABLE user_stats (
+            discord_guild_id INTEGER,
+            discord_user_id INTEGER,
+            songs_sung INTEGER NOT NULL,
+            seconds_sung INTEGER NOT NULL,
+            last_sung_time TIMESTAMP,
+            PRIMARY KEY (discord_guild_id, discord_user_id)
+        )
+        """,
+        """
+        CREATE TABLE song_stats (
+            discord_guild_id INTEGER,
+            song_key TEXT,
+            title TEXT,
+            url TEXT,
+            play_count INTEGER NOT NULL,
+            last_sung_time TIMESTAMP,
+            PRIMARY KEY (discord_guild_id, song_key)
+        )
+        """,
+        """
+        CREATE TABLE queue_stats (
+            queue TEXT PRIMARY KEY REFERENCES queues(name),
+            songs_sung INTEGER NOT NULL,
+            seconds_sung INTEGER NOT NULL,
+            last_sung_time TIMESTAMP
+        )
+        """,
+        "CREATE INDEX user_stats_songs_sung ON user_stats (discord_guild_id, songs_sung)",
+        "CREATE INDEX song_stats_play_count ON song_stats (discord_guild_id, play_count)",
+        """
+        INSERT INTO user_stats
+        SELECT discord_guild_id, discord_user_id, COUNT(*), COALESCE(SUM(duration), 0), MAX(completed_time)
+        FROM songs WHERE completed_time IS NOT NULL
+        GROUP BY discord_guild_id, discord_user_id
+        """,
+        """
+        INSERT INTO song_stats
+        SELECT discord_guild_id, song_key, title, url, COUNT(*), MAX(completed_time)
+        FROM songs WHERE completed_time IS NOT NULL
+        GROUP BY discord_guild_id, song_key
+        """,
+        """
+        INSERT INTO queue_stats
+        SELECT queue, COUNT(*), COALESCE(SUM(duration), 0), MAX(completed_time)
+        FROM songs WHERE completed_time IS NOT NULL AND queue IS NOT NULL
+        GROUP BY queue
+        """,
+    ],
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    """
+    Applies any migrations newer than the database's schema version
+    """
+    with conn:
+        conn.execute(_CREATE_SCHEMA_VERSION_TABLE)
+        row = conn.execute("SELECT version FROM schema_version").fetchone()
+        if row is None:
+            conn.execute("INSERT INTO schema_version (version) VALUES (0)")
+            version = 0
+        else:
+            version = row[0]
+    for new_version, statements in enumerate(_MIGRATIONS[version:], start=version + 1):
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute("UPDATE schema_version SET version = ?", (new_version,))
+        print(f"Migrated database to schema version {new_version}")
+
+
+def set_up_database(path: Path = Path("karaoke.db")):
     """
-    Create the database file if it doesn't already exist
+    Create the database file if it doesn't already exist, and bring its schema up to date.
+    The connection uses WAL so readers don't wait on writers, and caches prepared statements,
+    so the queries below are only compiled once.
     """
-    conn = sqlite3.connect(Path("karaoke.db"))
+    conn = sqlite3.connect(path, cached_statements=256)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -16000")
+    conn.execute("PRAGMA busy_timeout = 5000")
     with conn:
         conn.execute(_CREATE_QUEUES_TABLE)
         conn.execute(_CREATE_USERS_TABLE)
         conn.execute(_CREATE_SONGS_TABLE)
-    return conn
\ No newline at end of file
+        conn.execute(_CREATE_METADATA_CACHE_TABLE)
+        conn.execute(_CREATE_METADATA_CACHE_INDEX)
+    migrate(conn)
+    return conn
+
+
+def _row_to_dict(cursor: sqlite3.Cursor, row: tuple) -> dict:
+    """Create a dictionary using column names and row values"""
+    return {description[0]: row[i] for i, description in enumerate(cursor.description)}
+
+
+def get_usernames(
+    conn: sqlite3.Connection, guild_id: int, user_ids: list[int]
+) -> dict[int, tuple[str, float]]:
+    """Finds the stored display name of each user in a guild, and when it was stored"""
+    names = {}
+    # stay under sqlite's limit on the number of query parameters
+    for first in range(0, len(user_ids), 500):
+        chunk = user_ids[first : first + 500]
+        names.update(
+            (user_id, (username, updated_time))
+            for user_id, username, updated_time in conn.execute(
+                f"SELECT discord_user_id, username, updated_time FROM member_names WHERE discord_guild_id = ? AND discord_user_id IN ({','.join('?' * len(chunk))});",
+                [guild_id, *chunk],
+            )
+        )
+    return names
+
+
+def set_usernames(
+    conn: sqlite3.Connection, guild_id: int, usernames: dict[int, str], updated_time: float
+):
+    """Stores the display names of users in a guild"""
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO member_names (discord_guild_id, discord_user_id, username, updated_time) VALUES (?,?,?,?);",
+            [(guild_id, user_id, username, updated_time) for user_id, username in usernames.items()],
+        )
+
+
+def get_bot_state(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    """Finds a value the bot saved for after a restart"""
+    row = conn.execute("SELECT value FROM bot_state WHERE key = ?;", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_bot_state(conn: sqlite3.Connection, key: str, value: Optional[str]):
+    """Saves a value for after a restart, or forgets it if value is None"""
+    with conn:
+        if value is None:
+            conn.execute("DELETE FROM bot_state WHERE key = ?;", (key,))
+        else:
+            conn.execute(
+                "INSERT OR REPLACE INTO bot_state (key, value) VALUES (?,?);", (key, value)
+            )
+
+
+def get_loudness(conn: sqlite3.Connection, normalized_url: str) -> Optional[tuple[Optional[float], float]]:
+    """Finds the measured loudness of a song and when it was measured, or None if it hasn't been"""
+    return conn.execute(
+        "SELECT integrated_lufs, measured_time FROM loudness WHERE normalized_url = ?;",
+        (normalized_url,),
+    ).fetchone()
+
+
+def set_loudness(
+    conn: sqlite3.Connection, normalized_url: str, integrated_lufs: Optional[float], measured_time: float
+):
+    """Stores the measured loudness of a song, with no loudness if it has no audio"""
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO loudness (normalized_url, integrated_lufs, measured_time) VALUES (?,?,?);",
+            (normalized_url, integrated_lufs, measured_time),
+        )
+
+
+def get_library_sources(conn: sqlite3.Connection) -> dict[str, tuple[float, int]]:
+    """Finds the modification time and size of every library file as of when it was last scanned"""
+    return {
+        path: (mtime, size)
+        for path, mtime, size in conn.execute("SELECT path, mtime, size FROM library_sources;")
+    }
+
+
+def replace_library_sources(
+    conn: sqlite3.Connection, sources: list[tuple[str, float, int, list[dict]]]
+):
+    """
+    Stores the entries found in a batch of (path, mtime, size, entries) library files,
+    in place of the ones previously found in them. A url listed by several files belongs to
+    whichever was scanned last.
+    """
+    with conn:
+        for path, mtime, size, entries in sources:
+            conn.execute(
+                "INSERT OR REPLACE INTO library_sources (path, mtime, size) VALUES (?,?,?);",
+                (path, mtime, size),
+            )
+            conn.execute("DELETE FROM library WHERE source = ?;", (path,))
+            # an upsert rather than INSERT OR REPLACE, whose implicit delete wouldn't fire the fts trigger
+            conn.executemany(
+                "INSERT INTO library (url, source, title, artist, duration) VALUES (?,?,?,?,?) ON CONFLICT (url) DO UPDATE SET source = excluded.source, title = excluded.title, artist = excluded.artist, duration = excluded.duration;",
+                [
+                    (entry["url"], path, entry["title"], entry["artist"], entry["duration"])
+                    for entry in entries
+                ],
+            )
+
+
+def remove_library_sources(conn: sqlite3.Connection, paths: list[str]):
+    """Forgets library files that no longer exist, along with their entries"""
+    with conn:
+        conn.executemany("DELETE FROM library WHERE source = ?;", [(path,) for path in paths])
+        conn.executemany("DELETE FROM library_sources WHERE path = ?;", [(path,) for path in paths])
+
+
+def search_library(conn: sqlite3.Connection, match: str, limit: int) -> list[dict]:
+    """Finds the library entries best matching a full text query, titles counting the most"""
+    cursor = conn.execute(
+        "SELECT library.id, library.url, library.title, library.artist, library.duration FROM library_search JOIN library ON library.id = library_search.rowid WHERE library_search MATCH ? ORDER BY bm25(library_search, 10.0, 5.0, 1.0) LIMIT ?;",
+        (match, limit),
+    )
+    return [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+
+
+def get_library_entry(conn: sqlite3.Connection, url: str) -> Optional[dict]:
+    """Finds the library entry for a url"""
+    cursor = conn.execute(
+        "SELECT id, url, title, artist, duration FROM library WHERE url = ?;", (url,)
+    )
+    row = cursor.fetchone()
+    return _row_to_dict(cursor, row) if row else None
+
+
+def get_library_entry_by_id(conn: sqlite3.Connection, entry_id: int) -> Optional[dict]:
+    """Finds a library entry by its id"""
+    cursor = conn.execute(
+        "SELECT id, url, title, artist, duration FROM library WHERE id = ?;", (entry_id,)
+    )
+    row = cursor.fetchone()
+    return _row_to_dict(cursor, row) if row else None
+
+
+def get_queue_positions(conn: sqlite3.Connection, queuename: str) -> Optional[tuple[int, int]]:
+    """Finds the current and max position of a queue, or None if it doesn't exist"""
+    return conn.execute(
+        "SELECT currentpos, maxpos FROM queues WHERE name = ?;", (queuename,)
+    ).fetchone()
+
+
+def create_queue(
+    conn: sqlite3.Connection, queuename: str, guild_id: int, created_at: datetime.datetime
+):
+    """Creates a new empty queue"""
+    with conn:
+        conn.execute(
+            "INSERT INTO queues (name, currentpos, maxpos, discord_guild_id, time_created) VALUES (?,?,?,?,?)",
+            (queuename, 0, 0, guild_id, created_at),
+        )
+
+
+def get_queue_ordering(conn: sqlite3.Connection, queuename: str) -> str:
+    """Finds the name of the ordering a queue plays its songs in"""
+    return conn.execute(
+        "SELECT ordering FROM queues WHERE name = ?;", (queuename,)
+    ).fetchone()[0]
+
+
+def set_queue_ordering(conn: sqlite3.Connection, queuename: str, ordering: str):
+    """Sets the ordering a queue plays its songs in"""
+    with conn:
+        conn.execute(
+            "UPDATE queues SET ordering = ? WHERE name = ?;", (ordering, queuename)
+        )
+
+
+def list_queues(conn: sqlite3.Connection, guild_id: int) -> list[tuple[str, str]]:
+    """Lists the name and creation time of every queue of a guild"""
+    return conn.execute(
+        "SELECT name, time_created FROM queues WHERE discord_guild_id = ?;", (guild_id,)
+    ).fetchall()
+
+
+def get_queue_guild(conn: sqlite3.Connection, queuename: str) -> Optional[int]:
+    """Finds the guild a queue belongs to"""
+    row = conn.execute(
+        "SELECT discord_guild_id FROM queues WHERE name = ?;", (queuename,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def set_queue_channel(conn: sqlite3.Connection, queuename: str, channel_id: Optional[int]):
+    """Marks a queue as playing in a channel, or as inactive if channel_id is None"""
+    with conn:
+        conn.execute(
+            "UPDATE queues SET channel_id = ? WHERE name = ?;", (channel_id, queuename)
+        )
+
+
+def get_active_queues(conn: sqlite3.Connection) -> list[tuple[str, int, int]]:
+    """Lists the name, guild and channel of every queue which is playing somewhere"""
+    return conn.execute(
+        "SELECT name, discord_guild_id, channel_id FROM queues WHERE channel_id IS NOT NULL;"
+    ).fetchall()
+
+
+def set_position(conn: sqlite3.Connection, queuename: str, position: int):
+    """Sets the current position of a queue"""
+    with conn:
+        conn.execute(
+            "UPDATE queues SET currentpos = ? WHERE name = ?;", (position, queuename)
+        )
+
+
+def advance_position(
+    conn: sqlite3.Connection,
+    queuename: str,
+    position: int,
+    completed_time: Optional[datetime.datetime] = None,
+):
+    """
+    Moves a queue past the song at position, marking the song completed if completed_time is given.
+    Both happen in one transaction, and the queue is only advanced if it is still at position,
+    so a concurrent /setposition isn't overwritten.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if completed_time is not None:
+            completed = conn.execute(
+                "UPDATE songs SET completed_time = ? WHERE queue = ? AND position = ? AND completed_time IS NULL;",
+                (completed_time, queuename, position),
+            ).rowcount
+            if completed:
+                _record_sung(conn, queuename, position, completed_time)
+        conn.execute(
+            "UPDATE queues SET currentpos = ? WHERE name = ? AND currentpos = ?;",
+            (position + 1, queuename, position),
+        )
+
+
+def _record_sung(
+    conn: sqlite3.Connection, queuename: str, position: int, completed_time: datetime.datetime
+):
+    """Adds a song that was just completed to the history totals"""
+    guild_id, user_id, key, title, url, duration = conn.execute(
+        "SELECT discord_guild_id, discord_user_id, song_key, title, url, duration FROM songs WHERE queue = ? AND position = ?;",
+        (queuename, position),
+    ).fetchone()
+    duration = duration or 0
+    conn.execute(
+        "INSERT INTO user_stats (discord_guild_id, discord_user_id, songs_sung, seconds_sung, last_sung_time) VALUES (?,?,1,?,?) ON CONFLICT (discord_guild_id, discord_user_id) DO UPDATE SET songs_sung = songs_sung + 1, seconds_sung = seconds_sung + excluded.seconds_sung, last_sung_time = excluded.last_sung_time;",
+        (guild_id, user_id, duration, completed_time),
+    )
+    conn.execute(
+        "INSERT INTO song_stats (discord_guild_id, song_key, title, url, play_count, last_sung_time) VALUES (?,?,?,?,1,?) ON CONFLICT (discord_guild_id, song_key) DO UPDATE SET title = excluded.title, url = excluded.url, play_count = play_count + 1, last_sung_time = excluded.last_sung_time;",
+        (guild_id, key, title, url, completed_time),
+    )
+    conn.execute(
+        "INSERT INTO queue_stats (queue, songs_sung, seconds_sung, last_sung_time) VALUES (?,1,?,?) ON CONFLICT (queue) DO UPDATE SET songs_sung = songs_sung + 1, seconds_sung = seconds_sung + excluded.seconds_sung, last_sung_time = excluded.last_sung_time;",
+        (queuename, duration, completed_time),
+    )
+
+
+def get_history_summary(conn: sqlite3.Connection, guild_id: int, limit: int) -> dict:
+    """The history totals of a guild: every queue, and its top singers and songs"""
+    cursor = conn.execute(
+        "SELECT queue_stats.queue, songs_sung, seconds_sung, last_sung_time FROM queue_stats JOIN queues ON queues.name = queue_stats.queue WHERE queues.discord_guild_id = ? ORDER BY last_sung_time DESC;",
+        (guild_id,),
+    )
+    queues = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+    cursor = conn.execute(
+        "SELECT discord_user_id, songs_sung, seconds_sung, last_sung_time FROM user_stats WHERE discord_guild_id = ? ORDER BY songs_sung DESC LIMIT ?;",
+        (guild_id, limit),
+    )
+    users = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+    cursor = conn.execute(
+        "SELECT song_key, title, url, play_count, last_sung_time FROM song_stats WHERE discord_guild_id = ? ORDER BY play_count DESC LIMIT ?;",
+        (guild_id, limit),
+    )
+    songs = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+    return {"queues": queues, "users": users, "songs": songs}
+
+
+HISTORY_COLUMNS = [
+    "queue",
+    "position",
+    "url",
+    "title",
+    "duration",
+    "added_time",
+    "completed_time",
+    "discord_user_id",
+    "song_key",
+]
+
+
+def get_history_batch(
+    conn: sqlite3.Connection, guild_id: int, after_rowid: int, limit: int
+) -> list[tuple]:
+    """
+    Reads up to limit songs sung in a guild, in the order they were added, starting after the
+    song with rowid after_rowid. Each is a row of the rowid followed by HISTORY_COLUMNS.
+    """
+    return conn.execute(
+        f"SELECT rowid, {', '.join(HISTORY_COLUMNS)} FROM songs WHERE rowid > ? AND discord_guild_id = ? AND completed_time IS NOT NULL ORDER BY rowid LIMIT ?;",
+        (after_rowid, guild_id, limit),
+    ).fetchall()
+
+
+def get_queue_songs(conn: sqlite3.Connection, queuename: str) -> list[dict]:
+    """Lists every song of a queue, including revoked and completed ones"""
+    cursor = conn.execute(
+        "SELECT * FROM songs WHERE queue = ? ORDER BY position;", (queuename,)
+    )
+    return [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+
+
+_INSERT_SONG = "INSERT INTO songs (url, title, duration, added_time, lyrics_url, notes, position, collaborators, completed_time, is_revoked, discord_user_id, discord_guild_id, queue, song_key) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+
+
+def _song_params(queuename: str, position: int, song: dict) -> tuple:
+    return (
+        song["url"],
+        song["title"],
+        song["duration"],
+        song["added_time"],
+        song["lyrics_url"],
+        song["notes"],
+        position,
+        song["collaborators"],
+        None,
+        False,
+        song["discord_user_id"],
+        song["discord_guild_id"],
+        queuename,
+        song["song_key"],
+    )
+
+
+def append_song(conn: sqlite3.Connection, queuename: str, song: dict) -> int:
+    """
+    Adds a song at the end of a queue and bumps its max position in a single transaction.
+    Returns the position the song was added at.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        position = conn.execute(
+            "SELECT maxpos FROM queues WHERE name = ?;", (queuename,)
+        ).fetchone()[0]
+        conn.execute(_INSERT_SONG, _song_params(queuename, position, song))
+        conn.execute(
+            "UPDATE queues SET maxpos = ? WHERE name = ?;", (position + 1, queuename)
+        )
+    return position
+
+
+def append_songs(conn: sqlite3.Connection, queuename: str, songs: list[dict]) -> list[dict]:
+    """
+    Adds several songs at the end of a queue with one bulk insert in a single transaction.
+    Songs the same user already has in the queue are skipped rather than failing the batch.
+    Returns the songs that were added, with their positions set.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        position = conn.execute(
+            "SELECT maxpos FROM queues WHERE name = ?;", (queuename,)
+        ).fetchone()[0]
+        existing = set()
+        for user_id in set(song["discord_user_id"] for song in songs):
+            existing.update(
+                conn.execute(
+                    "SELECT url, discord_user_id FROM songs WHERE discord_user_id = ? AND queue = ?;",
+                    (user_id, queuename),
+                ).fetchall()
+            )
+        added = []
+        for song in songs:
+            if (song["url"], song["discord_user_id"]) in existing:
+                continue
+            existing.add((song["url"], song["discord_user_id"]))
+            added.append(
+                dict(song, position=position, completed_time=None, is_revoked=False)
+            )
+            position += 1
+        conn.executemany(
+            _INSERT_SONG,
+            [_song_params(queuename, song["position"], song) for song in added],
+        )
+        conn.execute(
+            "UPDATE queues SET maxpos = ? WHERE name = ?;", (position, queuename)
+        )
+    return added
+
+
+def swap_song(conn: sqlite3.Connection, queuename: str, position: int, song: dict):
+    """Replaces the song at a position, keeping its place in the queue"""
+    with conn:
+        conn.execute(
+            "UPDATE songs SET url = ?, title = ?, duration = ?, lyrics_url = ?, notes = ?, collaborators = ?, is_revoked = ?, discord_user_id = ?, discord_guild_id = ?, song_key = ?, source_plan = NULL, stream_height = NULL WHERE queue = ? AND position = ?;",
+            (
+                song["url"],
+                song["title"],
+                song["duration"],
+                song["lyrics_url"],
+                song["notes"],
+                song["collaborators"],
+                False,
+                song["discord_user_id"],
+                song["discord_guild_id"],
+                song["song_key"],
+                queuename,
+                position,
+            ),
+        )
+
+
+def set_source_plan(
+    conn: sqlite3.Connection,
+    queuename: str,
+    position: int,
+    url: str,
+    source_plan: str,
+    stream_height: Optional[int],
+):
+    """Records how the song at a position will be played, unless it was swapped for another url"""
+    with conn:
+        conn.execute(
+            "UPDATE songs SET source_plan = ?, stream_height = ? WHERE queue = ? AND position = ? AND url = ?;",
+            (source_plan, stream_height, queuename, position, url),
+        )
+
+
+def last_sung(
+    conn: sqlite3.Connection, guild_id: int, song_key: str, since: datetime.datetime
+) -> Optional[str]:
+    """Finds when a song was last sung in a guild, if it was sung after since"""
+    return conn.execute(
+        "SELECT MAX(completed_time) FROM songs WHERE song_key = ? AND completed_time > ? AND discord_guild_id = ?;",
+        (song_key, since, guild_id),
+    ).fetchone()[0]
+
+
+def revoke_song(conn: sqlite3.Connection, queuename: str, position: int):
+    """Marks the song at a position as revoked"""
+    with conn:
+        conn.execute(
+            "UPDATE songs SET is_revoked = TRUE WHERE queue = ? AND position = ?;",
+            (queuename, position),
+        )
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+A stand-in for mpv which speaks enough of its JSON IPC protocol to run the bot headless.
+Point the mpv_path config option at this script to run the bot without mpv or a display.
+Every file "plays" for FAKE_MPV_DURATION seconds (default 2), and files whose name
+contains "fail" end with an error instead.
+"""
+import os
+import sys
+import json
+import asyncio
+
+
+class FakeMpv:
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.playlist: list[dict] = []
+        self.current: dict = None
+        self.next_entry_id = 1
+        self.paused = True
+        self.observed: dict[str, int] = {}
+        self.clients: list[asyncio.StreamWriter] = []
+        self.playing_task: asyncio.Task = None
+        self.quit = asyncio.Event()
+
+    def emit(self, message: dict):
+        line = json.dumps(message).encode("utf8") + b"\n"
+        for writer in self.clients:
+            writer.write(line)
+
+    def start_next(self):
+        if self.playing_task:
+            self.playing_task.cancel()
+            self.playing_task = None
+        self.current = self.playlist.pop(0) if self.playlist else None
+        if self.current:
+            self.playing_task = asyncio.create_task(self.play(self.current))
+        else:
+            self.emit({"event": "idle"})
+
+    async def play(self, entry: dict):
+        entry_id = entry["id"]
+        self.emit({"event": "start-file", "playlist_entry_id": entry_id})
+        await asyncio.sleep(0.01)
+        if "fail" in entry["filename"]:
+            self.emit(
+                {
+                    "event": "end-file",
+                    "reason": "error",
+                    "file_error": "loading failed",
+                    "playlist_entry_id": entry_id,
+                }
+            )
+            self.start_next()
+            return
+        self.emit({"event": "file-loaded"})
+        self.emit({"event": "playback-restart"})
+        elapsed = 0.0
+        while elapsed < self.duration:
+            await asyncio.sleep(0.1)
+            elapsed += 0.1
+            if "time-pos" in self.observed:
+                self.emit(
+                    {
+                        "event": "property-change",
+                        "id": self.observed["time-pos"],
+                        "name": "time-pos",
+                        "data": round(elapsed, 1),
+                    }
+                )
+        self.emit({"event": "end-file", "reason": "eof", "playlist_entry_id": entry_id})
+        self.playing_task = None
+        self.start_next()
+
+    def handle(self, command):
+        if isinstance(command, dict):
+            # named arguments, in the order of the positional ones
+            command = list(command.values())
+        name = command[0]
+        if name == "loadfile":
+            entry = {"id": self.next_entry_id, "filename": command[1]}
+            self.next_entry_id += 1
+            mode = command[2] if len(command) > 2 else "replace"
+            if mode == "replace":
+                if self.current:
+                    self.emit(
+                        {
+                            "event": "end-file",
+                            "reason": "stop",
+                            "playlist_entry_id": self.current["id"],
+                        }
+                    )
+                self.playlist = [entry]
+                self.start_next()
+            else:
+                self.playlist.append(entry)
+                if self.current is None:
+                    self.start_next()
+            return {"playlist_entry_id": entry["id"]}
+        if name == "playlist-clear":
+            self.playlist = []
+            return None
+        if name == "stop":
+            self.playlist = []
+            if self.current:
+                self.emit(
+                    {
+                        "event": "end-file",
+                        "reason": "stop",
+                        "playlist_entry_id": self.current["id"],
+                    }
+                )
+            self.start_next()
+            return None
+        if name == "observe_property":
+            self.observed[command[2]] = command[1]
+            return None
+        if name == "set_property":
+            if command[1] == "pause":
+                self.paused = bool(command[2])
+            return None
+        if name == "get_property":
+            if command[1] == "pause":
+                return self.paused
+            if command[1] == "path":
+                return self.current["filename"] if self.current else None
+            raise KeyError(command[1])
+        if name == "quit":
+            self.quit.set()
+            return None
+        raise KeyError(name)
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.append(writer)
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                reply = {"request_id": request.get("request_id", 0)}
+                try:
+                    reply["data"] = self.handle(request["command"])
+                    reply["error"] = "success"
+                except (KeyError, IndexError):
+                    reply["error"] = "invalid parameter"
+                writer.write(json.dumps(reply).encode("utf8") + b"\n")
+                await writer.drain()
+                if self.quit.is_set():
+                    break
+        finally:
+            self.clients.remove(writer)
+            writer.close()
+
+
+async def main():
+    socket_path = None
+    files = []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--input-ipc-server="):
+            socket_path = arg.split("=", 1)[1]
+        elif not arg.startswith("-"):
+            files.append(arg)
+    fake = FakeMpv(float(os.environ.get("FAKE_MPV_DURATION", "2")))
+    if socket_path is None:
+        # launched like the old one-process-per-song player, so just "play" the file and exit
+        await asyncio.sleep(fake.duration)
+        return
+    server = await asyncio.start_unix_server(fake.serve, socket_path)
+    for filename in files:
+        fake.handle(["loadfile", filename, "append"])
+    await fake.quit.wait()
+    while fake.clients:
+        await asyncio.sleep(0.01)
+    server.close()
+    await server.wait_closed()
+    os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
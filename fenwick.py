@@ -0,0 +1,41 @@
+class FenwickTree:
+    """
+    A binary indexed tree over a growable list of numbers.
+    Updating one value, appending a value, and summing any prefix all take O(log n).
+    """
+
+    def __init__(self):
+        # 1-based, so tree[i] holds the sum of the values in (i - lowbit(i), i]
+        self._tree = [0]
+
+    def __len__(self) -> int:
+        return len(self._tree) - 1
+
+    def prefix_sum(self, end: int) -> int:
+        """The sum of the values at indices [0, end)"""
+        total = 0
+        i = min(end, len(self))
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def range_sum(self, start: int, end: int) -> int:
+        """The sum of the values at indices [start, end)"""
+        if end <= start:
+            return 0
+        return self.prefix_sum(end) - self.prefix_sum(max(start, 0))
+
+    def append(self, value: int):
+        i = len(self._tree)
+        # the new node covers (i - lowbit(i), i], of which only the last value is new
+        self._tree.append(value + self.prefix_sum(i - 1) - self.prefix_sum(i - (i & -i)))
+
+    def add(self, index: int, delta: int):
+        """Adds delta to the value at index, growing the tree with zeros if needed"""
+        while len(self) <= index:
+            self.append(0)
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
@@ -0,0 +1,54 @@
+import io
+import csv
+import json
+import asyncio
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import db
+from store import Store
+
+
+def csv_lines(rows: Iterable[tuple]) -> Iterator[str]:
+    """Formats history rows as CSV lines"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def jsonl_lines(rows: Iterable[tuple]) -> Iterator[str]:
+    """Formats history rows as one JSON object per line"""
+    for row in rows:
+        yield json.dumps(dict(zip(db.HISTORY_COLUMNS, row)), default=str) + "\n"
+
+
+async def write_export(
+    store: Store, guild_id: int, export_format: str, path: Path, batch_size: int = 1000
+) -> int:
+    """
+    Writes every song sung in a guild to a CSV or JSONL file. Songs are read batch_size at a time,
+    each batch in its own Store.run so other database work isn't held up behind a long history,
+    and written out on another thread, so the export is never held in memory.
+    Returns the number of songs written.
+    """
+    count = 0
+    after_rowid = 0
+    lines = csv_lines if export_format == "csv" else jsonl_lines
+    export_file = await asyncio.to_thread(open, path, "w", encoding="utf8", newline="")
+    try:
+        if export_format == "csv":
+            await asyncio.to_thread(export_file.writelines, csv_lines([db.HISTORY_COLUMNS]))
+        while True:
+            batch = await store.run(db.get_history_batch, guild_id, after_rowid, batch_size)
+            if not batch:
+                break
+            await asyncio.to_thread(export_file.writelines, lines(row[1:] for row in batch))
+            count += len(batch)
+            after_rowid = batch[-1][0]
+    finally:
+        await asyncio.to_thread(export_file.close)
+    return count
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import asyncio
+from pathlib import Path
+from typing import Optional
+
+import db
+from store import Store
+from resolver import MEDIA_EXTENSIONS, run_subprocess
+from metrics import metrics
+
+_SCAN_SECONDS = metrics.histogram(
+    "karaoke_library_scan_seconds", "Time taken to rescan the song library"
+)
+_SEARCH_SECONDS = metrics.histogram(
+    "karaoke_library_search_seconds", "Time taken to search the song library, by caller"
+)
+
+# playlists of curated links (and files), with #EXTINF lines giving each entry's duration and title
+PLAYLIST_EXTENSIONS = {".m3u"}
+# HLS playlists are streams, not files worth listing
+LIBRARY_EXTENSIONS = (MEDIA_EXTENSIONS - {".m3u8"}) | PLAYLIST_EXTENSIONS
+# autocomplete choices can't be longer than this, so longer urls are passed by library id
+CHOICE_VALUE_LIMIT = 100
+LIBRARY_ID_PREFIX = "library:"
+
+
+def fts_query(text: str) -> Optional[str]:
+    """
+    Turns what a user typed into an FTS5 query matching entries which contain every word,
+    the last one possibly unfinished. Returns None if there is nothing worth searching for.
+    """
+    words = text.replace('"', " ").split()
+    if not words or sum(len(word) for word in words) < 2:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def parse_playlist(path: Path, text: str) -> list[dict]:
+    """Lists the entries of an m3u playlist, with relative paths resolved against its directory"""
+    entries = []
+    duration = title = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            length, _, title = line[len("#EXTINF:") :].partition(",")
+            try:
+                duration = int(float(length)) if float(length) >= 0 else None
+            except ValueError:
+                duration = None
+        elif line and not line.startswith("#"):
+            url = line if "://" in line else str(path.parent.joinpath(line))
+            entries.append(
+                {
+                    "url": url,
+                    "title": title.strip() if title else Path(line).stem,
+                    "artist": None,
+                    "duration": duration,
+                }
+            )
+            duration = title = None
+    return entries
+
+
+def parse_probe(path: Path, output: str) -> dict:
+    """Builds a library entry from ffprobe's json, falling back to the file name for the title"""
+    probe = json.loads(output)
+    tags = {
+        tag.lower(): value
+        for block in [probe.get("format", {}), *probe.get("streams", [])[:1]]
+        for tag, value in block.get("tags", {}).items()
+    }
+    duration = probe.get("format", {}).get("duration")
+    return {
+        "url": str(path),
+        "title": tags.get("title") or path.stem,
+        "artist": tags.get("artist"),
+        "duration": int(float(duration)) if duration else None,
+    }
+
+
+class Library:
+    """
+    An index of the songs in the library directories, searched through sqlite's FTS5.
+    Rescans only probe files whose modification time or size changed since they were last seen,
+    at most max_concurrent at a time, and write what they found in batches so searches from
+    autocomplete aren't held up behind one long transaction. Playlist (.m3u) files add the links
+    listed in them, so curated links are searchable too.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        directories: list[Path],
+        max_concurrent: int = 4,
+        timeout: float = 30.0,
+        batch_size: int = 500,
+    ):
+        self.store = store
+        self.directories = directories
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self._scan_lock = asyncio.Lock()
+
+    def _walk(self) -> dict[str, tuple[float, int]]:
+        """Finds every library file and its modification time and size"""
+        files = {}
+        pending = [str(directory) for directory in self.directories]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif os.path.splitext(entry.name)[1].lower() in LIBRARY_EXTENSIONS:
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_mtime, stat.st_size)
+            except OSError as walk_error:
+                print("Unable to scan library directory", walk_error)
+        return files
+
+    async def _read(self, source: str) -> list[dict]:
+        path = Path(source)
+        if path.suffix.lower() in PLAYLIST_EXTENSIONS:
+            text = await asyncio.to_thread(path.read_text, encoding="utf8", errors="replace")
+            return parse_playlist(path, text)
+        output = await run_subprocess(
+            [
+                "ffprobe",
+                "-v",
+                "quiet",
+                "-print_format",
+                "json",
+                "-show_format",
+                "-show_streams",
+                source,
+            ],
+            self.timeout,
+        )
+        return [parse_probe(path, output)]
+
+    async def scan(self) -> dict:
+        """Brings the index up to date with the library directories, returning what changed"""
+        async with self._scan_lock:
+            started = time.perf_counter()
+            files = await asyncio.to_thread(self._walk)
+            stored = await self.store.run(db.get_library_sources)
+            removed = [source for source in stored if source not in files]
+            changed = [source for source, stat in files.items() if stored.get(source) != stat]
+            if removed:
+                await self.store.run(db.remove_library_sources, removed)
+
+            batch = []
+            failed = 0
+
+            async def flush():
+                if batch:
+                    await self.store.run(db.replace_library_sources, batch.copy())
+                    batch.clear()
+
+            async def probe_files(sources):
+                nonlocal failed
+                for source in sources:
+                    try:
+                        entries = await self._read(source)
+                    except Exception as probe_error:
+                        # remembered without entries, so it isn't probed again until it changes
+                        print(f"Unable to read library file {source}", probe_error)
+                        entries = []
+                        failed += 1
+                    batch.append((source, *files[source], entries))
+                    if len(batch) >= self.batch_size:
+                        await flush()
+
+            remaining = iter(changed)
+            await asyncio.gather(*(probe_files(remaining) for _ in range(self.max_concurrent)))
+            await flush()
+            _SCAN_SECONDS.observe(time.perf_counter() - started)
+            return {
+                "files": len(files),
+                "changed": len(changed),
+                "removed": len(removed),
+                "failed": failed,
+            }
+
+    async def run(self, interval: float):
+        """Rescans the library every interval seconds"""
+        while True:
+            try:
+                result = await self.scan()
+                if result["changed"] or result["removed"]:
+                    print(
+                        "Rescanned song library: {files} files, {changed} changed, {removed} removed, {failed} unreadable".format(
+                            **result
+                        )
+                    )
+            except Exception as scan_error:
+                print("Error scanning song library", scan_error)
+            await asyncio.sleep(interval)
+
+    async def search(self, text: str, limit: int, caller: str = "search") -> list[dict]:
+        """The best matching library entries for what a user typed"""
+        query = fts_query(text)
+        if query is None:
+            return []
+        with _SEARCH_SECONDS.timer(caller=caller):
+            return await self.store.run(db.search_library, query, limit)
+
+    async def expand(self, song_url: str) -> str:
+        """The url behind a library id handed out by autocomplete, or song_url itself"""
+        if not song_url.startswith(LIBRARY_ID_PREFIX):
+            return song_url
+        try:
+            entry = await self.store.run(
+                db.get_library_entry_by_id, int(song_url[len(LIBRARY_ID_PREFIX) :])
+            )
+        except ValueError:
+            entry = None
+        return entry["url"] if entry else song_url
+
+    async def metadata(self, song_url: str) -> Optional[dict]:
+        """The title and duration of a song in the library, so it doesn't need resolving"""
+        entry = await self.store.run(db.get_library_entry, song_url)
+        if entry is None or entry["duration"] is None:
+            return None
+        return {"title": entry["title"], "duration": entry["duration"]}
+
+
+def choice_value(entry: dict) -> str:
+    """What an autocomplete choice for a library entry puts in the song_url option"""
+    if len(entry["url"]) <= CHOICE_VALUE_LIMIT:
+        return entry["url"]
+    return f"{LIBRARY_ID_PREFIX}{entry['id']}"
@@ -0,0 +1,149 @@
+import re
+import time
+import asyncio
+from pathlib import Path
+from typing import Optional
+
+import db
+from store import Store
+from metadata_cache import normalize_url
+from resolver import run_subprocess
+from metrics import metrics
+
+_ANALYSIS_SECONDS = metrics.histogram(
+    "karaoke_loudness_analysis_seconds", "Time taken to measure the loudness of a song, by outcome"
+)
+
+# the integrated loudness line of the summary ffmpeg's ebur128 filter prints when it finishes
+_INTEGRATED = re.compile(r"^\s*I:\s*(-?[\d.]+|-inf)\s*LUFS", re.MULTILINE)
+
+
+def volume_for_gain(gain: float) -> float:
+    """Converts a gain in dB to mpv's volume percentage, which scales amplitude cubically"""
+    return round(100 * 10 ** (gain / 60), 1)
+
+
+class LoudnessAnalyzer:
+    """
+    Measures the EBU R128 integrated loudness of downloaded songs with ffmpeg, in the background
+    and at most max_concurrent at a time, and stores it in the loudness table so each song is
+    only measured once. The gain needed to bring a song to target_lufs is then applied as mpv's
+    volume when it is loaded, so playback doesn't run any extra audio filters.
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        target_lufs: float,
+        max_gain: float,
+        max_concurrent: int = 1,
+        timeout: float = 600.0,
+    ):
+        self.store = store
+        self.target_lufs = target_lufs
+        self.max_gain = max_gain
+        self.timeout = timeout
+        self._workers = asyncio.Semaphore(max_concurrent)
+        # normalized url -> measured loudness, or None if it couldn't be measured
+        self._loudness: dict[str, Optional[float]] = {}
+        self._analyses: dict[str, asyncio.Task] = {}
+        # normalized url -> the queues (owners) whose songs are being measured
+        self._owners: dict[str, set[str]] = {}
+
+    async def _stored(self, key: str) -> tuple[bool, Optional[float]]:
+        """Whether a url has been analyzed, and its loudness if it could be measured"""
+        if key not in self._loudness:
+            row = await self.store.run(db.get_loudness, key)
+            if row is None:
+                return False, None
+            self._loudness[key] = row[0]
+        return True, self._loudness[key]
+
+    async def gain(self, song_url: str) -> Optional[float]:
+        """The gain in dB to play a song at, or None if it hasn't been measured"""
+        _, loudness = await self._stored(normalize_url(song_url))
+        if loudness is None:
+            return None
+        return min(self.target_lufs - loudness, self.max_gain)
+
+    async def volume(self, song_url: str) -> Optional[float]:
+        """The mpv volume to play a song at, or None if it hasn't been measured"""
+        gain = await self.gain(song_url)
+        return volume_for_gain(gain) if gain is not None else None
+
+    def analyze(self, owner: str, song_url: str, path: Path):
+        """Measures a song of owner from its local file in the background, unless it was already measured"""
+        key = normalize_url(song_url)
+        if key in self._loudness:
+            return
+        self._owners.setdefault(key, set()).add(owner)
+        if key in self._analyses:
+            return
+        task = asyncio.create_task(self._analyze(key, path))
+        task.add_done_callback(lambda _, t=task: self._forget(key, t))
+        self._analyses[key] = task
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._analyses.get(key) is task:
+            del self._analyses[key]
+            self._owners.pop(key, None)
+
+    def cancel_all(self, owner: Optional[str] = None):
+        """
+        Cancels the analyses in progress that only owner's songs are waiting on,
+        or every analysis if owner is None
+        """
+        for key, task in list(self._analyses.items()):
+            owners = self._owners.get(key, set())
+            owners.discard(owner)
+            if owner is None or not owners:
+                task.cancel()
+                del self._analyses[key]
+                self._owners.pop(key, None)
+
+    async def _analyze(self, key: str, path: Path):
+        analyzed, _ = await self._stored(key)
+        if analyzed:
+            return
+        async with self._workers:
+            start = time.perf_counter()
+            try:
+                loudness = await self.measure(path)
+            except asyncio.CancelledError:
+                _ANALYSIS_SECONDS.observe(time.perf_counter() - start, outcome="cancelled")
+                raise
+            except Exception as analysis_error:
+                _ANALYSIS_SECONDS.observe(time.perf_counter() - start, outcome="error")
+                print(f"Unable to measure the loudness of {path}", analysis_error)
+                # the file is probably missing or truncated, so try again next time it is fetched
+                return
+            _ANALYSIS_SECONDS.observe(time.perf_counter() - start, outcome="ok")
+        self._loudness[key] = loudness
+        await self.store.run(db.set_loudness, key, loudness, time.time())
+
+    async def measure(self, path: Path) -> Optional[float]:
+        """Returns the integrated loudness of a file in LUFS, or None if it has no audio to measure"""
+        output = await run_subprocess(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-nostats",
+                "-threads",
+                "1",
+                "-i",
+                str(path),
+                "-map",
+                "0:a:0?",
+                "-af",
+                "ebur128=framelog=quiet",
+                "-f",
+                "null",
+                "-",
+            ],
+            self.timeout,
+            want_stderr=True,
+        )
+        matches = _INTEGRATED.findall(output)
+        if not matches or matches[-1] == "-inf":
+            return None
+        return float(matches[-1])
@@ -0,0 +1,109 @@
+import time
+import sqlite3
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# query parameters which don't change which media a url points to
+_IGNORED_QUERY_PARAMS = {"t", "si", "feature", "pp", "ref", "from"}
+
+
+def normalize_url(song_url: str) -> str:
+    """
+    Normalizes a url so trivially different links to the same media share a cache entry.
+    The scheme and host are lowercased, the fragment is dropped, and tracking or timestamp
+    query parameters are removed. Anything that isn't an http(s) url is returned unchanged.
+    """
+    parts = urlsplit(song_url.strip())
+    if parts.scheme.lower() not in ("http", "https"):
+        return song_url.strip()
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = sorted(
+        (k, v)
+        for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in _IGNORED_QUERY_PARAMS and not k.startswith("utm_")
+    )
+    return urlunsplit(("https", host, parts.path.rstrip("/"), urlencode(query), ""))
+
+
+def song_key(song_url: str, video_metadata: dict) -> str:
+    """
+    Identifies a song across the different urls it can be linked by: its extractor and id if
+    yt-dlp resolved it, like Youtube:dQw4w9WgXcQ for both youtu.be and youtube.com links,
+    and its normalized url otherwise
+    """
+    return video_metadata.get("extractor_id") or normalize_url(song_url)
+
+
+class MetadataCache:
+    """
+    A persistent cache of resolved song metadata stored in the metadata_cache table.
+    Entries expire after ttl seconds, and the least recently used entries are evicted
+    once there are more than max_entries. Methods take the connection so they can be
+    run on the database thread with Store.run.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn: sqlite3.Connection, song_url: str) -> Optional[dict]:
+        """Returns the cached metadata for a url, or None if it isn't cached or has expired"""
+        key = normalize_url(song_url)
+        now = time.time()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT title, duration, extractor_id, resolved_time FROM metadata_cache WHERE normalized_url = ?;",
+                (key,),
+            )
+            row = cursor.fetchone()
+            if row is None or now - row[3] > self.ttl:
+                if row is not None:
+                    cursor.execute(
+                        "DELETE FROM metadata_cache WHERE normalized_url = ?;", (key,)
+                    )
+                cursor.close()
+                self.misses += 1
+                return None
+            cursor.execute(
+                "UPDATE metadata_cache SET last_used_time = ? WHERE normalized_url = ?;",
+                (now, key),
+            )
+            cursor.close()
+        self.hits += 1
+        return {"title": row[0], "duration": row[1], "extractor_id": row[2]}
+
+    def put(self, conn: sqlite3.Connection, song_url: str, video_metadata: dict):
+        """Stores resolved metadata for a url, evicting the least recently used entries if the cache is full"""
+        now = time.time()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO metadata_cache (normalized_url, title, duration, extractor_id, resolved_time, last_used_time) VALUES (?,?,?,?,?,?);",
+                (
+                    normalize_url(song_url),
+                    video_metadata["title"],
+                    int(video_metadata["duration"]),
+                    video_metadata.get("extractor_id"),
+                    now,
+                    now,
+                ),
+            )
+            cursor.execute(
+                "DELETE FROM metadata_cache WHERE normalized_url IN (SELECT normalized_url FROM metadata_cache ORDER BY last_used_time DESC LIMIT -1 OFFSET ?);",
+                (self.max_entries,),
+            )
+            cursor.close()
+
+    def stats(self, conn: sqlite3.Connection) -> dict:
+        """Returns the hit and miss counters along with the number of cached entries"""
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM metadata_cache;")
+            entries = cursor.fetchone()[0]
+            cursor.close()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
@@ -0,0 +1,214 @@
+import time
+import bisect
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional, Union
+
+from aiohttp import web
+
+# upper bounds in seconds, from a fast sqlite query up to a slow yt-dlp lookup
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """A monotonically increasing count, kept separately for every combination of labels"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+    def summary(self) -> list[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(labels)}: {value:g}"
+                for labels, value in sorted(self._values.items())
+            ]
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, kept separately for every combination of labels.
+    Observations may come from any thread, since database queries are timed on the database thread.
+    """
+
+    def __init__(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # labels -> [count in each bucket (the last one unbounded), sum, count]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def timer(self, **labels):
+        """Observes how long the body of a with statement took, even if it raised"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _quantile(self, bucket_counts: list[int], count: int, fraction: float) -> str:
+        rank = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return f"<{bound * 1000:g}ms"
+        return f">{self.buckets[-1]:g}s"
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    bucket_labels = _format_labels(labels + (("le", f"{bound:g}"),))
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                bucket_labels = _format_labels(labels + (("le", "+Inf"),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+    def summary(self) -> list[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(labels)}: n={count} "
+                f"mean={total / count * 1000:.1f}ms "
+                f"p50{self._quantile(bucket_counts, count, 0.5)} "
+                f"p99{self._quantile(bucket_counts, count, 0.99)}"
+                for labels, (bucket_counts, total, count) in sorted(self._series.items())
+            ]
+
+
+class Metrics:
+    """
+    A registry of counters and histograms which can be rendered in the Prometheus text format,
+    served over HTTP, or summarized for the /stats command.
+    """
+
+    def __init__(self):
+        self._instruments: dict[str, Union[Counter, Histogram]] = {}
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._instruments.setdefault(name, Counter(name, description))
+
+    def histogram(
+        self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._instruments.setdefault(name, Histogram(name, description, buckets))
+
+    def render(self) -> str:
+        """All instruments in the Prometheus text exposition format"""
+        lines = []
+        for instrument in self._instruments.values():
+            lines.extend(instrument.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list[str]:
+        """One human readable line for every labelled series that has been recorded"""
+        lines = []
+        for instrument in self._instruments.values():
+            lines.extend(instrument.summary())
+        return lines
+
+    async def start_http_server(self, host: str, port: int) -> web.AppRunner:
+        """Serves the metrics at http://host:port/metrics"""
+
+        async def handle_metrics(request: web.Request) -> web.Response:
+            return web.Response(text=self.render(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+class LoopLagMonitor:
+    """
+    Wakes up every interval seconds and measures how late it was, which is how long some callback
+    kept the event loop busy. Lag past threshold seconds is logged, and every lag measured is
+    passed to on_lag if it is given.
+    """
+
+    def __init__(
+        self,
+        registry: Metrics,
+        threshold: float,
+        interval: float = 0.1,
+        on_lag: Optional[Callable[[float], None]] = None,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.on_lag = on_lag
+        self._lag = registry.histogram(
+            "karaoke_event_loop_lag_seconds", "How late the event loop ran a timer"
+        )
+        self._stalls = registry.counter(
+            "karaoke_event_loop_stalls_total", "Times the event loop was blocked past the threshold"
+        )
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self._lag.observe(lag)
+            if self.on_lag:
+                self.on_lag(lag)
+            if lag > self.threshold:
+                self._stalls.inc()
+                print(f"Event loop was blocked for {lag * 1000:.0f}ms")
+
+
+# the registry shared by every module
+metrics = Metrics()
+# Discord API calls are made by the commands and by the nickname cache
+discord_api_seconds = metrics.histogram(
+    "karaoke_discord_api_seconds", "Time taken by calls to the Discord API"
+)
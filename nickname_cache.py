@@ -0,0 +1,111 @@
+import time
+from typing import Optional
+
+import discord
+
+import db
+from store import Store
+from metrics import metrics, discord_api_seconds
+
+# the most user ids Discord accepts in one query_members request
+QUERY_MEMBERS_LIMIT = 100
+
+_LOOKUPS = metrics.counter(
+    "karaoke_nickname_lookups_total", "Display name lookups, by where the name was found"
+)
+
+
+def display_name(member: discord.Member) -> str:
+    return member.nick if member.nick is not None else member.name
+
+
+class NicknameCache:
+    """
+    Display names of guild members, cached in memory and in the member_names table.
+    Names are looked up in memory, then in discord.py's member cache, then in the database,
+    and only the users missing from all three are fetched from Discord, in as few requests as
+    possible. Entries older than ttl seconds are fetched again.
+    """
+
+    def __init__(self, store: Store, ttl: float):
+        self.store = store
+        self.ttl = ttl
+        # (guild id, user id) -> (display name, time it was stored),
+        # with no name for users who left the guild
+        self._names: dict[tuple[int, int], tuple[Optional[str], float]] = {}
+
+    def _fresh(self, guild_id: int, user_id: int, now: float) -> bool:
+        entry = self._names.get((guild_id, user_id))
+        return entry is not None and now - entry[1] <= self.ttl
+
+    async def remember(self, members: list[discord.Member]):
+        """Stores the current display names of members"""
+        now = time.time()
+        # guild id -> user id -> name
+        usernames: dict[int, dict[int, str]] = {}
+        for member in members:
+            name = display_name(member)
+            key = (member.guild.id, member.id)
+            entry = self._names.get(key)
+            self._names[key] = (name, now)
+            # only write to the database if the name changed or is getting old
+            if entry is None or entry[0] != name or now - entry[1] > self.ttl / 2:
+                usernames.setdefault(member.guild.id, {})[member.id] = name
+        for guild_id, guild_usernames in usernames.items():
+            await self.store.run(db.set_usernames, guild_id, guild_usernames, now)
+
+    async def lookup(
+        self, guild: discord.Guild, user_ids: set[int], also: set[int] = frozenset()
+    ) -> dict[int, str]:
+        """
+        Returns the display names of users, leaving out those who aren't in the guild.
+        If Discord has to be asked anyway, the users in also (who are likely to be looked up next)
+        are fetched in the same request while there is room in it.
+        """
+        now = time.time()
+        guild_id = guild.id
+        missing = [user_id for user_id in user_ids if not self._fresh(guild_id, user_id, now)]
+        _LOOKUPS.inc(len(user_ids) - len(missing), source="memory")
+
+        if missing:
+            # members discord.py already knows about cost nothing to look up
+            members = [guild.get_member(user_id) for user_id in missing]
+            members = [member for member in members if member is not None]
+            _LOOKUPS.inc(len(members), source="member_cache")
+            await self.remember(members)
+            missing = [user_id for user_id in missing if not self._fresh(guild_id, user_id, now)]
+
+        if missing:
+            stored = await self.store.run(db.get_usernames, guild_id, missing)
+            for user_id, (name, updated_time) in stored.items():
+                if updated_time is not None and now - updated_time <= self.ttl:
+                    self._names[guild_id, user_id] = (name, updated_time)
+            fresh = [user_id for user_id in missing if self._fresh(guild_id, user_id, now)]
+            _LOOKUPS.inc(len(fresh), source="database")
+            missing = [user_id for user_id in missing if not self._fresh(guild_id, user_id, now)]
+
+        if missing:
+            spare = QUERY_MEMBERS_LIMIT - len(missing) % QUERY_MEMBERS_LIMIT
+            extra = [
+                user_id
+                for user_id in also - user_ids
+                if not self._fresh(guild_id, user_id, now) and guild.get_member(user_id) is None
+            ]
+            missing += extra[:spare] if spare < QUERY_MEMBERS_LIMIT else []
+        for first in range(0, len(missing), QUERY_MEMBERS_LIMIT):
+            chunk = missing[first : first + QUERY_MEMBERS_LIMIT]
+            with discord_api_seconds.timer(call="query_members"):
+                members = await guild.query_members(user_ids=chunk, limit=len(chunk))
+            _LOOKUPS.inc(len(members), source="api")
+            await self.remember(members)
+            # don't ask again for users who aren't in the guild until the entry expires
+            for user_id in chunk:
+                if not self._fresh(guild_id, user_id, now):
+                    self._names[guild_id, user_id] = (None, now)
+
+        names = {}
+        for user_id in user_ids:
+            name = self._names.get((guild_id, user_id), (None, 0))[0]
+            if name is not None:
+                names[user_id] = name
+        return names
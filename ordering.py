@@ -0,0 +1,237 @@
+import abc
+import bisect
+import heapq
+from typing import TYPE_CHECKING, Iterator, Optional
+
+if TYPE_CHECKING:
+    from queue_state import QueueState, Song
+
+
+class Ordering(abc.ABC):
+    """
+    Decides the order a queue's songs are played in. Positions in the database never change;
+    an ordering only picks which pending song at or after the queue's current position is next.
+    QueueState calls the hooks below as songs change, so orderings can keep their own indexes.
+    """
+
+    name = ""
+
+    def __init__(self, state: "QueueState"):
+        self.state = state
+
+    def song_added(self, song: "Song"):
+        """A pending song was added"""
+
+    def song_removed(self, song: "Song"):
+        """A pending song was revoked, completed or swapped out"""
+
+    def song_completed(self, song: "Song"):
+        """A song finished playing"""
+
+    def position_set(self):
+        """The current position was set by an operator"""
+
+    @abc.abstractmethod
+    def next_position(self) -> Optional[int]:
+        """The position of the song which is playing, or should be played next"""
+
+    def position_after_song(self) -> Optional[int]:
+        """Where to move the current position once a song has finished, if it has to be moved"""
+        return None
+
+    def should_skip(self, song: "Song") -> bool:
+        """Whether the song at the next position should be passed over instead of played"""
+        return song.is_revoked
+
+    @abc.abstractmethod
+    def play_order(self) -> Iterator["Song"]:
+        """The pending songs in the order they will be played, starting with the one playing"""
+
+    def upcoming(self, count: int) -> list["Song"]:
+        """The next count songs to be played after the one currently playing"""
+        upcoming = []
+        for song in self.play_order():
+            if len(upcoming) >= count:
+                break
+            if song.position != self.state.playing_position:
+                upcoming.append(song)
+        return upcoming
+
+    def wait_before(self, song: "Song") -> tuple[int, int]:
+        """The total duration and number of the pending songs played before song"""
+        wait = 0
+        ahead = 0
+        for other in self.play_order():
+            if other is song:
+                break
+            wait += other.duration or 0
+            ahead += 1
+        return wait, ahead
+
+
+class FifoOrdering(Ordering):
+    """Plays songs in the order they were added, moving the current position along"""
+
+    name = "fifo"
+
+    def __init__(self, state: "QueueState"):
+        super().__init__(state)
+        # a finished song is only played again if an operator moved the position back to it
+        self._replay_position: Optional[int] = None
+
+    def position_set(self):
+        self._replay_position = self.state.currentpos
+
+    def should_skip(self, song: "Song") -> bool:
+        # songs already sung while another ordering was in use are passed over as well
+        return song.is_revoked or (
+            song.completed_time is not None and song.position != self._replay_position
+        )
+
+    def next_position(self) -> Optional[int]:
+        state = self.state
+        return state.currentpos if state.currentpos < state.maxpos else None
+
+    def play_order(self) -> Iterator["Song"]:
+        state = self.state
+        first = state.currentpos
+        while songs := state.upcoming(first, 50):
+            yield from songs
+            first = songs[-1].position + 1
+
+    def upcoming(self, count: int) -> list["Song"]:
+        state = self.state
+        first = state.currentpos
+        if state.playing_position == first:
+            first += 1
+        return state.upcoming(first, count)
+
+    def wait_before(self, song: "Song") -> tuple[int, int]:
+        state = self.state
+        return (
+            state.pending_duration(state.currentpos, song.position),
+            state.pending_count(state.currentpos, song.position),
+        )
+
+
+class RoundRobinOrdering(Ordering):
+    """
+    Gives every user a turn before anyone sings again. The next singer is whoever has waited
+    longest since their last song (users who haven't sung yet first, in the order they queued),
+    and each user's songs play in the order they were added.
+    A heap of users keyed by (last turn, first pending position) makes picking the next song
+    O(log users). Entries go stale as users' songs change, and are corrected when they reach the top.
+    """
+
+    name = "round_robin"
+
+    def __init__(self, state: "QueueState"):
+        super().__init__(state)
+        # user id -> sorted positions of their pending songs
+        self._pending: dict[int, list[int]] = {}
+        # user id -> when they last sang, as a count of songs completed
+        self._last_turn: dict[int, int] = {}
+        self._turns = 0
+        self._heap: list[tuple[int, int, int]] = []
+
+        completed = {}
+        for song in state.songs():
+            if song.is_pending:
+                self._pending.setdefault(song.discord_user_id, []).append(song.position)
+            elif song.completed_time is not None and not song.is_revoked:
+                last = completed.get(song.discord_user_id)
+                if last is None or str(song.completed_time) > last:
+                    completed[song.discord_user_id] = str(song.completed_time)
+        for user_id in sorted(completed, key=completed.get):
+            self._turns += 1
+            self._last_turn[user_id] = self._turns
+        self._rebuild_heap()
+
+    def _key(self, user_id: int) -> Optional[tuple[int, int, int]]:
+        positions = self._pending.get(user_id, ())
+        index = bisect.bisect_left(positions, self.state.currentpos)
+        if index == len(positions):
+            return None
+        return (self._last_turn.get(user_id, 0), positions[index], user_id)
+
+    def _push(self, user_id: int):
+        key = self._key(user_id)
+        if key is not None:
+            heapq.heappush(self._heap, key)
+        # stale entries are only dropped when they reach the top, so don't let them pile up
+        if len(self._heap) > 4 * len(self._pending) + 16:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [key for key in map(self._key, self._pending) if key is not None]
+        heapq.heapify(self._heap)
+
+    def song_added(self, song: "Song"):
+        bisect.insort(self._pending.setdefault(song.discord_user_id, []), song.position)
+        self._push(song.discord_user_id)
+
+    def song_removed(self, song: "Song"):
+        positions = self._pending.get(song.discord_user_id)
+        if positions is None:
+            return
+        index = bisect.bisect_left(positions, song.position)
+        if index < len(positions) and positions[index] == song.position:
+            del positions[index]
+        if not positions:
+            del self._pending[song.discord_user_id]
+        self._push(song.discord_user_id)
+
+    def song_completed(self, song: "Song"):
+        self._turns += 1
+        self._last_turn[song.discord_user_id] = self._turns
+        self._push(song.discord_user_id)
+
+    def position_set(self):
+        # moving the position back can make keys smaller, which lazy correction can't handle
+        self._rebuild_heap()
+
+    def next_position(self) -> Optional[int]:
+        state = self.state
+        if state.playing_position is not None:
+            return state.playing_position
+        while self._heap:
+            key = self._heap[0]
+            if self._key(key[2]) == key:
+                return key[1]
+            heapq.heappop(self._heap)
+            self._push(key[2])
+        return None
+
+    def position_after_song(self) -> Optional[int]:
+        # songs are played out of position order, so move past everything already done
+        state = self.state
+        upcoming = state.upcoming(state.currentpos, 1)
+        position = upcoming[0].position if upcoming else state.maxpos
+        return position if position != state.currentpos else None
+
+    def play_order(self) -> Iterator["Song"]:
+        state = self.state
+        playing = state.playing_position
+        playing_song = state.get_song(playing) if playing is not None else None
+        playing_user = None
+        if playing_song is not None:
+            yield playing_song
+            playing_user = playing_song.discord_user_id
+        turns = []
+        for user_id, positions in self._pending.items():
+            index = bisect.bisect_left(positions, state.currentpos)
+            remaining = [position for position in positions[index:] if position != playing]
+            if remaining:
+                # whoever is singing now goes to the back once they finish
+                last_turn = self._turns + 1 if user_id == playing_user else self._last_turn.get(user_id, 0)
+                turns.append((last_turn, remaining[0], remaining))
+        turns.sort()
+        round_number = 0
+        while turns:
+            for _, _, remaining in turns:
+                yield state.get_song(remaining[round_number])
+            round_number += 1
+            turns = [turn for turn in turns if len(turn[2]) > round_number]
+
+
+ORDERINGS = {ordering.name: ordering for ordering in (FifoOrdering, RoundRobinOrdering)}
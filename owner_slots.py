@@ -0,0 +1,15 @@
+import asyncio
+
+
+class OwnerSlots:
+    """A semaphore of max_concurrent slots for each owner (a queue), created on first use"""
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def __call__(self, owner: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(owner)
+        if semaphore is None:
+            semaphore = self._semaphores[owner] = asyncio.Semaphore(self.max_concurrent)
+        return semaphore
@@ -0,0 +1,264 @@
+import json
+import time
+import asyncio
+from pathlib import Path
+from typing import Callable, Optional
+
+from metrics import metrics
+
+_START_SECONDS = metrics.histogram(
+    "karaoke_mpv_start_seconds", "Time from launching mpv until its IPC socket is connected"
+)
+_FIRST_FRAME_SECONDS = metrics.histogram(
+    "karaoke_mpv_first_frame_seconds", "Time from asking mpv to play a song until playback starts"
+)
+
+
+class PlayerError(Exception):
+    """Raised when mpv rejects a command or the IPC connection is lost"""
+
+
+class MpvPlayer:
+    """
+    A single long-lived mpv instance controlled over its JSON IPC socket.
+    Songs are loaded with loadfile, the next song is appended to mpv's playlist so it can be
+    opened ahead of time, and events from mpv are forwarded to registered listeners.
+    """
+
+    def __init__(
+        self, mpv_path: str, socket_path: Path, extra_args: Optional[list[str]] = None
+    ):
+        self.mpv_path = mpv_path
+        self.socket_path = socket_path
+        self.extra_args = extra_args or []
+        self.time_pos: Optional[float] = None
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._start_lock = asyncio.Lock()
+        self._request_id = 0
+        self._pending: dict[int, asyncio.Future] = {}
+        # playlist entry id -> future resolved with its end-file event
+        self._end_waiters: dict[int, asyncio.Future] = {}
+        self._ended: dict[int, dict] = {}
+        # (playlist entry id, source, volume, ytdl format) of the song queued after the current one
+        self._preloaded: Optional[tuple[int, str, Optional[float], Optional[str]]] = None
+        self._listeners: list[Callable[[dict], None]] = []
+        # when play() was last called, until mpv reports that playback started
+        self._play_requested: Optional[float] = None
+        self._playing_entry: Optional[int] = None
+        self._playing_started = False
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        """Registers a callback which receives every event mpv sends"""
+        self._listeners.append(listener)
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    async def start(self):
+        """Launches mpv and connects to its IPC socket if it isn't already running"""
+        async with self._start_lock:
+            if self.running and self._writer is not None:
+                return
+            self.socket_path.unlink(missing_ok=True)
+            launched_at = time.perf_counter()
+            self._process = await asyncio.create_subprocess_exec(
+                self.mpv_path,
+                "--idle=yes",
+                "--force-window=yes",
+                "--pause",
+                "--reset-on-next-file=pause",
+                "--prefetch-playlist=yes",
+                f"--input-ipc-server={self.socket_path}",
+                *self.extra_args,
+            )
+            for _ in range(100):
+                if self.socket_path.exists():
+                    break
+                if self._process.returncode is not None:
+                    raise PlayerError(f"mpv exited with code {self._process.returncode}")
+                await asyncio.sleep(0.05)
+            reader, self._writer = await asyncio.open_unix_connection(
+                str(self.socket_path)
+            )
+            self._reader_task = asyncio.create_task(self._read_events(reader))
+            await self.command("observe_property", 1, "time-pos")
+            _START_SECONDS.observe(time.perf_counter() - launched_at)
+
+    async def stop(self):
+        """Stops playback and clears the playlist, leaving mpv idle"""
+        self._preloaded = None
+        await self.command("stop")
+
+    async def quit(self):
+        """Shuts down the mpv instance"""
+        process = self._process
+        if self.running:
+            try:
+                await self.command("quit")
+            except PlayerError:
+                process.terminate()
+            await process.wait()
+
+    async def play(
+        self,
+        source: str,
+        volume: Optional[float] = None,
+        start: Optional[float] = None,
+        ytdl_format: Optional[str] = None,
+    ) -> int:
+        """
+        Starts playing a source at a volume (mpv's default if None), start seconds in,
+        and returns its playlist entry id. ytdl_format picks the format yt-dlp streams, if set.
+        If the source was already preloaded, mpv has advanced (or will advance) to it on its own.
+        """
+        self._play_requested = time.perf_counter()
+        await self.start()
+        if self._preloaded and self._preloaded[1:] == (source, volume, ytdl_format) and not start:
+            entry_id = self._preloaded[0]
+            self._preloaded = None
+            if self._playing_entry == entry_id and self._playing_started:
+                # mpv got to the preloaded song before it was asked to
+                _FIRST_FRAME_SECONDS.observe(0)
+                self._play_requested = None
+            return entry_id
+        self._preloaded = None
+        response = await self._loadfile(source, "replace", volume, start, ytdl_format)
+        return response["playlist_entry_id"]
+
+    async def preload(
+        self,
+        source: Optional[str],
+        volume: Optional[float] = None,
+        ytdl_format: Optional[str] = None,
+    ):
+        """Replaces whatever follows the current entry in mpv's playlist with the next source"""
+        if not self.running or self._writer is None:
+            return
+        if self._preloaded and self._preloaded[1:] == (source, volume, ytdl_format):
+            return
+        await self.command("playlist-clear")
+        self._preloaded = None
+        if source:
+            response = await self._loadfile(source, "append", volume, ytdl_format=ytdl_format)
+            self._preloaded = (response["playlist_entry_id"], source, volume, ytdl_format)
+
+    async def _loadfile(
+        self,
+        source: str,
+        flags: str,
+        volume: Optional[float],
+        start: Optional[float] = None,
+        ytdl_format: Optional[str] = None,
+    ) -> dict:
+        options = []
+        if volume is not None:
+            options.append(f"volume={volume:g}")
+        if start:
+            options.append(f"start={start:g}")
+        if ytdl_format:
+            # quoted, since format selectors contain commas and slashes
+            options.append(f"ytdl-format=%{len(ytdl_format)}%{ytdl_format}")
+        if not options:
+            return await self.command("loadfile", source, flags)
+        # per-file options only last until the entry ends, and named arguments keep working
+        # across mpv versions which added positional arguments to loadfile
+        return await self.command(
+            "loadfile", url=source, flags=flags, options=",".join(options)
+        )
+
+    async def wait_for_end(self, entry_id: int) -> dict:
+        """Waits for a playlist entry to finish and returns mpv's end-file event for it"""
+        if entry_id in self._ended:
+            return self._ended.pop(entry_id)
+        future = asyncio.get_running_loop().create_future()
+        self._end_waiters[entry_id] = future
+        try:
+            return await future
+        finally:
+            self._end_waiters.pop(entry_id, None)
+
+    async def command(self, *args, **named) -> Optional[dict]:
+        """
+        Sends a command to mpv and returns the data of its reply.
+        Arguments are passed by name instead of position if any are given as keywords.
+        """
+        if self._writer is None:
+            raise PlayerError("mpv is not connected")
+        self._request_id += 1
+        request_id = self._request_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(
+                json.dumps(
+                    {
+                        "command": {"name": args[0], **named} if named else list(args),
+                        "request_id": request_id,
+                    }
+                ).encode("utf8")
+                + b"\n"
+            )
+            await self._writer.drain()
+            reply = await asyncio.wait_for(future, 10)
+        except (OSError, asyncio.TimeoutError) as ipc_error:
+            raise PlayerError(f"mpv command {args[0]} failed", ipc_error)
+        finally:
+            self._pending.pop(request_id, None)
+        if reply.get("error") != "success":
+            raise PlayerError(f"mpv command {args[0]} failed", reply.get("error"))
+        return reply.get("data")
+
+    async def _read_events(self, reader: asyncio.StreamReader):
+        try:
+            while line := await reader.readline():
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if "request_id" in message and "event" not in message:
+                    future = self._pending.get(message["request_id"])
+                    if future and not future.done():
+                        future.set_result(message)
+                    continue
+                self._handle_event(message)
+        finally:
+            # mpv went away, so fail everything that is still waiting on it
+            self._writer = None
+            self._preloaded = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(PlayerError("mpv connection closed"))
+            for future in self._end_waiters.values():
+                if not future.done():
+                    future.set_result({"event": "end-file", "reason": "quit"})
+
+    def _handle_event(self, event: dict):
+        if event.get("event") == "property-change" and event.get("name") == "time-pos":
+            self.time_pos = event.get("data")
+        elif event.get("event") == "start-file":
+            self._playing_entry = event.get("playlist_entry_id")
+            self._playing_started = False
+        elif event.get("event") == "playback-restart" and not self._playing_started:
+            # the first frame of the song is up (mpv also sends this after every seek)
+            self._playing_started = True
+            if self._play_requested is not None:
+                _FIRST_FRAME_SECONDS.observe(time.perf_counter() - self._play_requested)
+                self._play_requested = None
+        elif event.get("event") == "end-file":
+            entry_id = event.get("playlist_entry_id")
+            future = self._end_waiters.get(entry_id)
+            if future and not future.done():
+                future.set_result(event)
+            else:
+                self._ended[entry_id] = event
+                # only the most recent few entries can still be waited on
+                while len(self._ended) > 8:
+                    del self._ended[next(iter(self._ended))]
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as listener_error:
+                print("Error in mpv event listener", listener_error)
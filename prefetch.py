@@ -0,0 +1,204 @@
+import os
+import shutil
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import Callable, Optional
+
+from metadata_cache import normalize_url
+from resolver import run_subprocess, classify_url, MEDIA
+from owner_slots import OwnerSlots
+
+
+def cache_key(song_url: str) -> str:
+    """The file name stem used for a downloaded song"""
+    return hashlib.sha1(normalize_url(song_url).encode("utf8")).hexdigest()
+
+
+class _Download:
+    """An in-progress download and the (owner, position) pairs waiting on it"""
+
+    __slots__ = ("task", "wanted_by")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.wanted_by: set[tuple[str, int]] = set()
+
+
+class Prefetcher:
+    """
+    Downloads upcoming songs into a local cache directory while the current song plays.
+    Each queue (owner) syncs its own downloads and runs at most max_concurrent of them at once.
+    The least recently used files are evicted once the directory grows past max_bytes.
+    Videos are downloaded at up to max_height lines.
+    on_downloaded is called with the owner, url and file of every song once it has been downloaded.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_bytes: int,
+        max_concurrent: int = 2,
+        timeout: float = 1800.0,
+        on_downloaded: Optional[Callable[[str, str, Path], None]] = None,
+        max_height: int = 1080,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_height = max_height
+        self.timeout = timeout
+        self.on_downloaded = on_downloaded
+        self._workers = OwnerSlots(max_concurrent)
+        # url -> the download of each song currently being fetched
+        self._downloads: dict[str, _Download] = {}
+        # owner -> cache keys of the files it is about to play
+        self._pinned: dict[str, set[str]] = {}
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # leftovers from downloads interrupted by a restart
+        for leftover in self.cache_dir.glob("*.tmp"):
+            shutil.rmtree(leftover, ignore_errors=True)
+
+    def local_path(self, song_url: str) -> Optional[Path]:
+        """Returns the downloaded file for a url if it is complete, marking it as recently used"""
+        for path in self.cache_dir.glob(cache_key(song_url) + ".*"):
+            if path.is_file():
+                os.utime(path)
+                return path
+        return None
+
+    def local_source(self, song_url: str) -> Optional[Path]:
+        """The downloaded copy of a song, or the song itself if it is a local file"""
+        local_file = self.local_path(song_url)
+        if local_file is None and classify_url(song_url) == MEDIA and Path(song_url).is_file():
+            local_file = Path(song_url)
+        return local_file
+
+    def sync(
+        self, owner: str, upcoming: list[tuple[int, str]], playing_url: Optional[str] = None
+    ):
+        """
+        Makes an owner's in-progress downloads match its upcoming (position, url) pairs.
+        Downloads for positions that were revoked, swapped to another url or are no longer
+        upcoming are dropped, and downloads for new upcoming songs are started.
+        """
+        wanted = dict(upcoming)
+        self._pinned[owner] = {cache_key(url) for url in wanted.values()}
+        if playing_url:
+            self._pinned[owner].add(cache_key(playing_url))
+        for url, download in list(self._downloads.items()):
+            # the playing song may still be downloading, if it has to be played from a file
+            if url == playing_url:
+                continue
+            unwanted = {
+                (download_owner, position)
+                for download_owner, position in download.wanted_by
+                if download_owner == owner and wanted.get(position) != url
+            }
+            self._drop(url, download, unwanted)
+        for position, url in upcoming:
+            if url in self._downloads:
+                # another queue may already be fetching the same song
+                self._downloads[url].wanted_by.add((owner, position))
+            elif not self.local_path(url):
+                self._start(owner, position, url)
+
+    async def fetch(self, owner: str, position: int, song_url: str) -> Optional[Path]:
+        """
+        Downloads a song right away, or waits for its download if one is already underway.
+        Returns the downloaded file, or None if the download failed or was cancelled.
+        """
+        local_file = self.local_path(song_url)
+        if local_file:
+            return local_file
+        self._pinned.setdefault(owner, set()).add(cache_key(song_url))
+        download = self._downloads.get(song_url)
+        if download is None:
+            download = self._start(owner, position, song_url)
+        else:
+            download.wanted_by.add((owner, position))
+        # the download may be shared with another queue, so waiting mustn't cancel it
+        await asyncio.wait({download.task})
+        return self.local_path(song_url)
+
+    def cancel_all(self, owner: Optional[str] = None):
+        """
+        Drops every in-progress download of an owner, or of every owner if None.
+        Downloads another owner still wants carry on.
+        """
+        for url, download in list(self._downloads.items()):
+            unwanted = {
+                wanted for wanted in download.wanted_by if owner is None or wanted[0] == owner
+            }
+            self._drop(url, download, unwanted)
+        if owner is None:
+            self._pinned.clear()
+        else:
+            self._pinned.pop(owner, None)
+
+    def _start(self, owner: str, position: int, song_url: str) -> "_Download":
+        download = _Download(asyncio.create_task(self._download(owner, song_url)))
+        download.wanted_by.add((owner, position))
+        download.task.add_done_callback(lambda _: self._forget(song_url, download))
+        self._downloads[song_url] = download
+        return download
+
+    def _drop(self, song_url: str, download: "_Download", unwanted: set[tuple[str, int]]):
+        """Stops (owner, position) pairs waiting on a download, cancelling it once nobody is"""
+        if not unwanted:
+            return
+        download.wanted_by -= unwanted
+        if not download.wanted_by:
+            download.task.cancel()
+            del self._downloads[song_url]
+
+    def _forget(self, song_url: str, download: "_Download"):
+        if self._downloads.get(song_url) is download:
+            del self._downloads[song_url]
+
+    async def _download(self, owner: str, song_url: str):
+        key = cache_key(song_url)
+        staging = self.cache_dir.joinpath(key + ".tmp")
+        async with self._workers(owner):
+            try:
+                staging.mkdir(exist_ok=True)
+                await run_subprocess(
+                    [
+                        "yt-dlp",
+                        "--no-playlist",
+                        "--quiet",
+                        "-S",
+                        f"res:{self.max_height}",
+                        "-o",
+                        str(staging.joinpath(key + ".%(ext)s")),
+                        song_url,
+                    ],
+                    self.timeout,
+                )
+                for path in staging.iterdir():
+                    if path.is_file() and path.name.startswith(key + "."):
+                        downloaded = self.cache_dir.joinpath(path.name)
+                        path.rename(downloaded)
+                        if self.on_downloaded:
+                            self.on_downloaded(owner, song_url, downloaded)
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception as download_error:
+                print(f"Unable to prefetch song {song_url}", download_error)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used downloads until the cache fits in max_bytes"""
+        files = [
+            (path.stat(), path) for path in self.cache_dir.iterdir() if path.is_file()
+        ]
+        total = sum(stat.st_size for stat, _ in files)
+        for stat, path in sorted(files, key=lambda f: f[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            if any(path.name.split(".")[0] in pinned for pinned in self._pinned.values()):
+                continue
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
@@ -0,0 +1,256 @@
+import bisect
+import datetime
+import sqlite3
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import db
+from fenwick import FenwickTree
+from ordering import ORDERINGS, FifoOrdering, Ordering
+
+
+@dataclass
+class Song:
+    """A compact in-memory record of one row of the songs table"""
+
+    __slots__ = (
+        "position",
+        "url",
+        "title",
+        "duration",
+        "added_time",
+        "lyrics_url",
+        "notes",
+        "collaborators",
+        "completed_time",
+        "is_revoked",
+        "discord_user_id",
+        "song_key",
+        "source_plan",
+        "stream_height",
+    )
+    position: int
+    url: str
+    title: str
+    duration: int
+    added_time: Optional[datetime.datetime]
+    lyrics_url: Optional[str]
+    notes: Optional[str]
+    collaborators: Optional[str]
+    completed_time: Optional[datetime.datetime]
+    is_revoked: bool
+    discord_user_id: int
+    song_key: Optional[str]
+    source_plan: Optional[str]
+    stream_height: Optional[int]
+
+    @classmethod
+    def from_row(cls, row: dict) -> "Song":
+        """Builds a song from a dictionary keyed by column name, ignoring other columns"""
+        return cls(**{field: row.get(field) for field in cls.__slots__})
+
+    @property
+    def is_pending(self) -> bool:
+        """Whether the song is still waiting to be sung"""
+        return not self.is_revoked and self.completed_time is None
+
+
+class QueueState:
+    """
+    The active queue held in memory, indexed by position and by user.
+    SQLite remains the durable record: callers write to the database first and then apply
+    the same change here, and the state is rebuilt from the database when a queue is loaded.
+    Reads never touch the database. The durations of the songs still waiting to be sung are
+    kept in a Fenwick tree by position, so wait times are answered without scanning the queue.
+    Which song plays next is up to the queue's ordering (see ordering.py).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        currentpos: int,
+        maxpos: int,
+        songs: list[Song],
+        ordering: str = FifoOrdering.name,
+    ):
+        self.name = name
+        self.currentpos = currentpos
+        self.maxpos = maxpos
+        # the position of the song mpv is playing, if any
+        self.playing_position: Optional[int] = None
+        self.order: Ordering = FifoOrdering(self)
+        self._songs: dict[int, Song] = {}
+        self._positions: list[int] = []
+        self._pending_by_user: dict[int, set[int]] = {}
+        # positions of the pending songs by song key, to find songs that are already queued
+        self._pending_by_key: dict[str, set[int]] = {}
+        # by position: the duration of each pending song, and 1 for each pending song
+        self._pending_durations = FenwickTree()
+        self._pending_counts = FenwickTree()
+        for song in songs:
+            self._add(song)
+        self.set_ordering(ordering)
+
+    @classmethod
+    def load(cls, conn: sqlite3.Connection, name: str) -> "QueueState":
+        """Rebuilds a queue's state from the database"""
+        currentpos, maxpos = db.get_queue_positions(conn, name)
+        songs = [Song.from_row(row) for row in db.get_queue_songs(conn, name)]
+        return cls(name, currentpos, maxpos, songs, db.get_queue_ordering(conn, name))
+
+    def set_ordering(self, ordering: str):
+        """Applies an ordering set with db.set_queue_ordering"""
+        if self.order.name != ordering:
+            self.order = ORDERINGS[ordering](self)
+
+    def _add(self, song: Song):
+        before = self._pending_weight(song.position)
+        if song.position not in self._songs:
+            bisect.insort(self._positions, song.position)
+        self._songs[song.position] = song
+        if song.is_pending:
+            self._pending_by_user.setdefault(song.discord_user_id, set()).add(song.position)
+            self._pending_by_key.setdefault(song.song_key, set()).add(song.position)
+            self.order.song_added(song)
+        self._reindex(song.position, before)
+
+    def _pending_weight(self, position: int) -> tuple[int, int]:
+        song = self._songs.get(position)
+        if song is None or not song.is_pending:
+            return 0, 0
+        return song.duration or 0, 1
+
+    def _reindex(self, position: int, before: tuple[int, int]):
+        """Updates the wait time index after the song at position changed from weighing before"""
+        after = self._pending_weight(position)
+        if after != before:
+            self._pending_durations.add(position, after[0] - before[0])
+            self._pending_counts.add(position, after[1] - before[1])
+
+    def _unmark_pending(self, song: Song):
+        positions = self._pending_by_user.get(song.discord_user_id)
+        if positions is not None and song.position in positions:
+            positions.discard(song.position)
+            if not positions:
+                del self._pending_by_user[song.discord_user_id]
+            positions = self._pending_by_key[song.song_key]
+            positions.discard(song.position)
+            if not positions:
+                del self._pending_by_key[song.song_key]
+            self.order.song_removed(song)
+
+    def get_song(self, position: int) -> Optional[Song]:
+        return self._songs.get(position)
+
+    def songs(self) -> Iterator[Song]:
+        """Every song of the queue in position order, including revoked and completed ones"""
+        for position in self._positions:
+            yield self._songs[position]
+
+    def next_position(self) -> Optional[int]:
+        """The position of the song that is playing, or should play next"""
+        return self.order.next_position()
+
+    def queued_count(self, user_id: int) -> int:
+        """The number of songs a user has waiting in the queue"""
+        return len(self._pending_by_user.get(user_id, ()))
+
+    def queued_with_key(self, song_key: str) -> list[Song]:
+        """The songs waiting in the queue which are the same song as song_key"""
+        return [self._songs[position] for position in sorted(self._pending_by_key.get(song_key, ()))]
+
+    def songs_page(
+        self, first_position: int, count: int, include_sung: bool = False
+    ) -> list[Song]:
+        """
+        Lists up to count songs still waiting to be sung from first_position onwards, along with
+        the ones already sung if include_sung, without walking the rest of the queue.
+        Orderings like round robin sing songs out of position order, so songs after the current
+        position may already have been sung.
+        """
+        page = []
+        start = bisect.bisect_left(self._positions, first_position)
+        for index in range(start, len(self._positions)):
+            if len(page) >= count:
+                break
+            song = self._songs[self._positions[index]]
+            if song.is_pending or (include_sung and not song.is_revoked):
+                page.append(song)
+        return page
+
+    def pending_duration(self, start: int, end: int) -> int:
+        """The total duration of the songs waiting to be sung at positions [start, end)"""
+        return self._pending_durations.range_sum(start, end)
+
+    def pending_count(self, start: int, end: int) -> int:
+        """The number of songs waiting to be sung at positions [start, end)"""
+        return self._pending_counts.range_sum(start, end)
+
+    def next_song_of(self, user_id: int) -> Optional[Song]:
+        """The user's first song still waiting to be sung at or after the current position"""
+        positions = [
+            position
+            for position in self._pending_by_user.get(user_id, ())
+            if position >= self.currentpos
+        ]
+        return self._songs[min(positions)] if positions else None
+
+    def upcoming(self, first_position: int, count: int) -> list[Song]:
+        """Finds the next count songs still waiting to be sung from first_position onwards"""
+        upcoming = []
+        start = bisect.bisect_left(self._positions, first_position)
+        for position in self._positions[start:]:
+            if len(upcoming) >= count:
+                break
+            if self._songs[position].is_pending:
+                upcoming.append(self._songs[position])
+        return upcoming
+
+    def append(self, song: Song):
+        """Applies a song appended with db.append_song"""
+        self._add(song)
+        self.maxpos = max(self.maxpos, song.position + 1)
+
+    def swap(self, position: int, song: Song):
+        """Applies a song swapped with db.swap_song"""
+        old_song = self._songs.get(position)
+        if old_song is not None:
+            self._unmark_pending(old_song)
+            song.added_time = old_song.added_time
+            song.completed_time = old_song.completed_time
+        self._add(song)
+
+    def set_source_plan(
+        self, position: int, url: str, source_plan: str, stream_height: Optional[int]
+    ):
+        """Applies a plan recorded with db.set_source_plan"""
+        song = self._songs.get(position)
+        if song is not None and song.url == url:
+            song.source_plan = source_plan
+            song.stream_height = stream_height
+
+    def revoke(self, position: int):
+        """Applies a song revoked with db.revoke_song"""
+        song = self._songs.get(position)
+        if song is not None:
+            before = self._pending_weight(position)
+            self._unmark_pending(song)
+            song.is_revoked = True
+            self._reindex(position, before)
+
+    def set_position(self, position: int):
+        """Applies a position set with db.set_position"""
+        self.currentpos = position
+        self.order.position_set()
+
+    def advance(self, position: int, completed_time: Optional[datetime.datetime] = None):
+        """Applies a position advanced with db.advance_position"""
+        song = self._songs.get(position)
+        if song is not None and completed_time is not None:
+            before = self._pending_weight(position)
+            self._unmark_pending(song)
+            song.completed_time = completed_time
+            self._reindex(position, before)
+            self.order.song_completed(song)
+        if self.currentpos == position:
+            self.currentpos = position + 1
@@ -0,0 +1,453 @@
+import json
+import time
+import asyncio
+import datetime
+from typing import Optional
+
+import discord
+
+import db
+from store import Store
+from queue_state import QueueState, Song
+from prefetch import Prefetcher
+from player import MpvPlayer
+from loudness import LoudnessAnalyzer
+from source_planner import SourcePlanner, DOWNLOAD, stream_format
+
+# how playing a song ended: it played to the end, /setposition stopped it, or mpv couldn't play it
+PLAYED = "played"
+INTERRUPTED = "interrupted"
+FAILED = "failed"
+
+
+class QueueWorker:
+    """
+    Plays one active queue: its in-memory state, its own mpv instance and the task which plays
+    its songs one after another, announcing each turn in the queue's channel.
+    Every active queue gets a worker, so a slow download or a stuck player only holds up its own queue.
+    How each song is played is planned when it is queued (see source_planner.py): songs which can't
+    be streamed reliably start downloading download_lookahead songs ahead, and their turn only
+    starts once the download is done.
+    """
+
+    def __init__(
+        self,
+        state: QueueState,
+        guild_id: int,
+        channel: discord.abc.Messageable,
+        player: MpvPlayer,
+        store: Store,
+        prefetcher: Prefetcher,
+        loudness: Optional[LoudnessAnalyzer],
+        planner: SourcePlanner,
+        prefetch_lookahead: int,
+        download_lookahead: int,
+        download_wait: float,
+        checkpoint_interval: float,
+        resume_rewind: float,
+    ):
+        self.state = state
+        self.guild_id = guild_id
+        self.channel = channel
+        self.player = player
+        self.store = store
+        self.prefetcher = prefetcher
+        self.loudness = loudness
+        self.planner = planner
+        self.prefetch_lookahead = prefetch_lookahead
+        self.download_lookahead = download_lookahead
+        self.download_wait = download_wait
+        self.checkpoint_interval = checkpoint_interval
+        self.resume_rewind = resume_rewind
+        self.now_playing_url: Optional[str] = None
+        # the song whose turn is waiting on its download
+        self.fetching_url: Optional[str] = None
+        # (position, seconds into the song) to pick playback back up from after a restart
+        self.resume_from: Optional[tuple[int, float]] = None
+        # set whenever the queue may have a new song to play
+        self.queue_changed = asyncio.Event()
+        # set to stop the song that is currently playing without marking it completed
+        self.playback_interrupted = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # position -> (url, task) planning how the song there will be played
+        self._plans: dict[int, tuple[str, asyncio.Task]] = {}
+        self._checkpoint_task: Optional[asyncio.Task] = None
+        self._last_checkpoint = 0.0
+        player.add_listener(self._on_player_event)
+
+    @property
+    def name(self) -> str:
+        return self.state.name
+
+    @property
+    def checkpoint_key(self) -> str:
+        return f"playback_checkpoint:{self.name}"
+
+    def start(self):
+        """Starts the playback loop if it isn't already running"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._playback_loop())
+        self.notify()
+
+    def notify(self, interrupt: bool = False):
+        """Wakes up the playback loop, optionally stopping the current song"""
+        if interrupt and self.now_playing_url:
+            self.playback_interrupted.set()
+        self.queue_changed.set()
+
+    async def stop(self):
+        """Stops playback for good, cancelling the queue's downloads and analyses and closing its mpv"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for _, task in self._plans.values():
+            task.cancel()
+        self.prefetcher.cancel_all(self.name)
+        if self.loudness:
+            self.loudness.cancel_all(self.name)
+        try:
+            await self.player.quit()
+        except Exception as mpv_error:
+            print(f"Unable to shut down mpv for queue {self.name}", mpv_error)
+
+    async def resume(self):
+        """Picks the song that was playing before a restart back up where it was checkpointed"""
+        checkpoint = await self.store.run(db.get_bot_state, self.checkpoint_key)
+        if checkpoint:
+            checkpoint = json.loads(checkpoint)
+            self.resume_from = (checkpoint["position"], checkpoint["time_pos"])
+
+    def _on_player_event(self, event: dict):
+        """Reports playback errors coming back from mpv, and checkpoints playback progress"""
+        if event.get("event") == "end-file" and event.get("reason") == "error":
+            print(f"mpv failed to play song in queue {self.name}", event.get("file_error"))
+        elif event.get("event") == "property-change" and event.get("name") == "time-pos":
+            self._checkpoint(event.get("data"))
+
+    def _checkpoint(self, time_pos: Optional[float]):
+        """Saves how far into the current song playback is, at most every checkpoint_interval"""
+        if time_pos is None or self.state.playing_position is None:
+            return
+        now = time.monotonic()
+        if now - self._last_checkpoint < self.checkpoint_interval:
+            return
+        if self._checkpoint_task is not None and not self._checkpoint_task.done():
+            return
+        self._last_checkpoint = now
+        checkpoint = json.dumps({"position": self.state.playing_position, "time_pos": time_pos})
+        self._checkpoint_task = asyncio.create_task(
+            self.store.run(db.set_bot_state, self.checkpoint_key, checkpoint)
+        )
+
+    async def song_volume(self, song_url: str) -> Optional[float]:
+        """The mpv volume which brings a song to the target loudness, if it has been measured"""
+        if self.loudness is None:
+            return None
+        return await self.loudness.volume(song_url)
+
+    def plan(self, song: Song):
+        """Works out how a song will be played in the background, unless it already has been"""
+        planning = self._plans.get(song.position)
+        if song.source_plan is not None or (planning and planning[0] == song.url):
+            return
+        task = asyncio.create_task(self._plan(song.position, song.url, song.duration))
+        task.add_done_callback(
+            lambda _, position=song.position, t=task: self._forget_plan(position, t)
+        )
+        self._plans[song.position] = (song.url, task)
+
+    def _forget_plan(self, position: int, task: asyncio.Task):
+        if position in self._plans and self._plans[position][1] is task:
+            del self._plans[position]
+
+    async def _plan(
+        self, position: int, song_url: str, duration: Optional[int], urgent: bool = False
+    ):
+        try:
+            source_plan, stream_height = await self.planner.plan(self.name, song_url, duration, urgent)
+        except Exception as plan_error:
+            print(f"Unable to plan how to play {song_url}", plan_error)
+            return
+        await self.store.run(
+            db.set_source_plan, self.name, position, song_url, source_plan, stream_height
+        )
+        self.state.set_source_plan(position, song_url, source_plan, stream_height)
+        if source_plan == DOWNLOAD:
+            await self.refresh_prefetch()
+
+    async def refresh_prefetch(self):
+        """
+        Points the prefetcher at the songs following the one currently playing, further ahead
+        for songs that have to be downloaded, and queues the next of them in mpv so it can be
+        opened ahead of time
+        """
+        ahead = self.state.order.upcoming(max(self.prefetch_lookahead, self.download_lookahead))
+        for song in ahead:
+            # songs queued before a restart haven't been planned yet
+            self.plan(song)
+        upcoming = [
+            (song.position, song.url)
+            for index, song in enumerate(ahead)
+            if index < self.prefetch_lookahead or song.source_plan == DOWNLOAD
+        ]
+        self.prefetcher.sync(self.name, upcoming, self.now_playing_url or self.fetching_url)
+        if self.loudness:
+            # songs downloaded before a restart, and local files, are never announced by the prefetcher
+            for _, song_url in upcoming[: self.prefetch_lookahead]:
+                local_file = self.prefetcher.local_source(song_url)
+                if local_file:
+                    self.loudness.analyze(self.name, song_url, local_file)
+        if self.now_playing_url:
+            await self._preload_next(ahead[0] if ahead else None)
+
+    async def _preload_next(self, song: Optional[Song]):
+        """
+        Appends the next song to mpv's playlist, preferring a prefetched copy.
+        Songs which have to be downloaded first aren't preloaded until they have been.
+        """
+        source = ytdl_format = None
+        if song is not None:
+            local_file = self.prefetcher.local_path(song.url)
+            if local_file:
+                source = str(local_file)
+            elif song.source_plan != DOWNLOAD:
+                source, ytdl_format = song.url, stream_format(song.stream_height)
+        try:
+            await self.player.preload(
+                source,
+                await self.song_volume(song.url) if source else None,
+                ytdl_format,
+            )
+        except Exception as mpv_error:
+            print(f"Unable to preload the next song of queue {self.name} in mpv", mpv_error)
+
+    async def _song_source(self, song: Song) -> Optional[tuple[str, Optional[str]]]:
+        """
+        What mpv should play for a song: its prefetched copy if there is one, otherwise its url and
+        the format to stream it in. Songs planned to be downloaded are waited for, for at most
+        download_wait seconds. Returns None if the song can't be played.
+        """
+        planning = self._plans.get(song.position)
+        if planning is not None:
+            # the plan may be waiting behind the rest of the queue's, so plan the song again right
+            # away, without a worker, and keep whichever finishes first
+            urgent = asyncio.create_task(
+                self._plan(song.position, song.url, song.duration, urgent=True)
+            )
+            try:
+                planned = {planning[1], urgent}
+                if not await self._wait_while_next(song, planned, self.planner.timeout):
+                    return None
+            finally:
+                planning[1].cancel()
+                urgent.cancel()
+        local_file = self.prefetcher.local_path(song.url)
+        if local_file:
+            return str(local_file), None
+        if song.source_plan != DOWNLOAD:
+            return song.url, stream_format(song.stream_height)
+        self.fetching_url = song.url
+        fetching = asyncio.create_task(self.prefetcher.fetch(self.name, song.position, song.url))
+        try:
+            await self._wait_while_next(song, {fetching}, self.download_wait)
+        finally:
+            self.fetching_url = None
+            fetching.cancel()
+        local_file = fetching.result() if fetching.done() and not fetching.cancelled() else None
+        return (str(local_file), None) if local_file else None
+
+    def _is_next(self, song: Song) -> bool:
+        """Whether a song is still the one the queue should play next"""
+        state = self.state
+        return state.next_position() == song.position and not state.order.should_skip(song)
+
+    async def _wait_while_next(self, song: Song, tasks: set, timeout: float) -> bool:
+        """
+        Waits up to timeout seconds for one of tasks to finish, giving up early if the queue moves
+        past the song (a /setposition or /removesong). Returns whether the song is still next.
+        """
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self._is_next(song):
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0 or any(task.done() for task in tasks):
+                return True
+            self.queue_changed.clear()
+            changed = asyncio.create_task(self.queue_changed.wait())
+            try:
+                await asyncio.wait(
+                    tasks | {changed}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                changed.cancel()
+        return False
+
+    def estimate_wait(self, song: Song) -> tuple[int, int]:
+        """
+        Estimates the seconds until a song comes up from the durations of the songs played before it.
+        Returns the estimate along with the number of songs before it.
+        """
+        state = self.state
+        wait, songs_ahead = state.order.wait_before(song)
+        if state.playing_position is not None and state.playing_position != song.position:
+            playing_song = state.get_song(state.playing_position)
+            if playing_song and self.player.time_pos:
+                # the current song is already partway through
+                wait -= min(int(self.player.time_pos), playing_song.duration or 0)
+        return max(wait, 0), songs_ahead
+
+    async def _play_song(
+        self,
+        song_source: str,
+        volume: Optional[float] = None,
+        start: Optional[float] = None,
+        ytdl_format: Optional[str] = None,
+    ) -> str:
+        """
+        Plays a song in the queue's mpv instance until it ends or playback is interrupted.
+        Returns PLAYED, INTERRUPTED or FAILED.
+        """
+        try:
+            entry_id = await self.player.play(song_source, volume, start, ytdl_format)
+        except Exception as mpv_error:
+            print(f"Unable to launch mpv and play the current song of queue {self.name}", mpv_error)
+            return FAILED
+        # only queue up the next song once this one has taken its preloaded place in mpv's playlist
+        await self.refresh_prefetch()
+        ended = asyncio.create_task(self.player.wait_for_end(entry_id))
+        interrupted = asyncio.create_task(self.playback_interrupted.wait())
+        try:
+            await asyncio.wait({ended, interrupted}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            interrupted.cancel()
+            ended.cancel()
+        if self.playback_interrupted.is_set():
+            try:
+                await self.player.stop()
+            except Exception as mpv_error:
+                print(f"Unable to stop mpv for queue {self.name}", mpv_error)
+            return INTERRUPTED
+        end = ended.result()
+        if end.get("reason") == "error":
+            print(f"mpv couldn't play the current song of queue {self.name}", end.get("file_error"))
+            return FAILED
+        return PLAYED
+
+    async def _announce(self, song: Song):
+        notification_message = f"<@{str(song.discord_user_id)}>, it is now your turn to sing {song.title}"
+        if song.collaborators:
+            notification_message += f" with {song.collaborators}"
+        if song.lyrics_url:
+            notification_message += f"\nLyrics: {song.lyrics_url}"
+        try:
+            await self.channel.send(notification_message)
+        except Exception as discord_error:
+            # the song plays whether or not Discord could be told about it
+            print(f"Unable to announce the next song of queue {self.name}", discord_error)
+
+    async def _announce_unplayable(self, song: Song):
+        try:
+            await self.channel.send(
+                f"<@{str(song.discord_user_id)}>, {song.title} couldn't be downloaded in time, so it was skipped"
+            )
+        except Exception as discord_error:
+            print(f"Unable to announce a skipped song of queue {self.name}", discord_error)
+
+    async def _pass_over(self, song: Song):
+        """
+        Drops a song that couldn't be played from the queue and moves on, without counting it
+        as sung. It is revoked rather than left pending, since an ordering which doesn't follow
+        the current position (like round robin) would otherwise pick it again right away.
+        """
+        state = self.state
+        await self.store.run(db.revoke_song, state.name, song.position)
+        state.revoke(song.position)
+        await self.store.run(db.advance_position, state.name, song.position)
+        state.advance(song.position)
+        new_position = state.order.position_after_song()
+        if new_position is not None:
+            await self.store.run(db.set_position, state.name, new_position)
+            state.set_position(new_position)
+
+    async def _playback_loop(self):
+        """The main loop which waits for a new song and plays it"""
+        state = self.state
+        while True:
+            self.queue_changed.clear()
+            try:
+                # There are no more songs in the queue
+                curr_index = state.next_position()
+                if curr_index is None:
+                    await self.queue_changed.wait()
+                    continue
+
+                # Fetch the current song and play it
+                current_song = state.get_song(curr_index)
+                if not current_song:
+                    print(f"Some kind of error ocurred fetching the next song of queue {self.name}")
+                    await self.store.run(db.advance_position, state.name, curr_index)
+                    state.advance(curr_index)
+                    continue
+
+                # If the song was revoked (or the ordering passes over it), skip it
+                if state.order.should_skip(current_song):
+                    await self.store.run(db.advance_position, state.name, curr_index)
+                    state.advance(curr_index)
+                    continue
+
+                # Play the prefetched copy if it finished downloading, otherwise stream the url,
+                # unless the song has to be downloaded first
+                source = await self._song_source(current_song)
+                if not self._is_next(current_song):
+                    # the queue moved on, or the song was removed, while it was planned or downloaded
+                    continue
+                if source is None:
+                    await self._announce_unplayable(current_song)
+                    await self._pass_over(current_song)
+                    continue
+                # from here on /setposition interrupts the song, including while it is announced
+                self.playback_interrupted.clear()
+                self.now_playing_url = current_song.url
+                state.playing_position = curr_index
+                # after a restart, continue the song that was interrupted a little before where it was
+                start = None
+                if self.resume_from and self.resume_from[0] == curr_index:
+                    start = max(0.0, self.resume_from[1] - self.resume_rewind)
+                self.resume_from = None
+                try:
+                    await self._announce(current_song)
+                    if self.playback_interrupted.is_set():
+                        # the queue moved on while the song was being announced
+                        continue
+                    outcome = await self._play_song(
+                        source[0],
+                        await self.song_volume(current_song.url),
+                        start,
+                        source[1],
+                    )
+                finally:
+                    self.now_playing_url = None
+                    state.playing_position = None
+                finished_at = datetime.datetime.now()
+
+                # /setposition already moved the queue, so leave this song as not completed
+                if outcome == INTERRUPTED:
+                    continue
+                if outcome == FAILED:
+                    await self._pass_over(current_song)
+                    continue
+
+                # Now update the db such that the song is completed and the queue moves on
+                await self.store.run(
+                    db.advance_position, state.name, current_song.position, finished_at
+                )
+                state.advance(current_song.position, finished_at)
+                new_position = state.order.position_after_song()
+                if new_position is not None:
+                    await self.store.run(db.set_position, state.name, new_position)
+                    state.set_position(new_position)
+            except Exception as playback_error:
+                print(f"Error in playback loop of queue {self.name}", playback_error)
+                await self.queue_changed.wait()
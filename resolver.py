@@ -0,0 +1,395 @@
+import json
+import time
+import asyncio
+import threading
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from metrics import metrics
+from owner_slots import OwnerSlots
+
+_RESOLVE_SECONDS = metrics.histogram(
+    "karaoke_resolve_seconds", "Time taken to resolve song metadata, by path and outcome"
+)
+_ROUTES = metrics.counter(
+    "karaoke_resolve_routes_total", "Metadata lookups by how the url was classified"
+)
+
+# extensions of files ffprobe can read directly
+MEDIA_EXTENSIONS = {
+    ".mp4", ".mkv", ".webm", ".mov", ".avi", ".m4v", ".mp3", ".m4a", ".aac",
+    ".ogg", ".opus", ".flac", ".wav", ".m3u8",
+}
+# sites only yt-dlp knows how to get media out of (subdomains included)
+YTDLP_SITES = {
+    "youtube.com", "youtu.be", "nicovideo.jp", "nico.ms", "soundcloud.com", "bilibili.com",
+    "b23.tv", "vimeo.com", "twitch.tv", "dailymotion.com", "bandcamp.com", "twitter.com",
+    "x.com", "tiktok.com",
+}
+
+MEDIA = "media"
+SITE = "site"
+UNKNOWN = "unknown"
+
+
+def classify_url(song_url: str) -> str:
+    """
+    Guesses from the url alone whether it points straight at a media file (MEDIA),
+    at a page yt-dlp has to extract the media from (SITE), or can't tell (UNKNOWN)
+    """
+    parts = urlsplit(song_url)
+    if parts.scheme in ("", "file"):
+        return MEDIA if parts.scheme == "file" or Path(song_url).is_file() else UNKNOWN
+    host = (parts.hostname or "").lower()
+    if any(host == site or host.endswith("." + site) for site in YTDLP_SITES):
+        return SITE
+    if PurePosixPath(parts.path).suffix.lower() in MEDIA_EXTENSIONS:
+        return MEDIA
+    return UNKNOWN
+
+
+class ResolverError(Exception):
+    """Raised when a metadata lookup subprocess fails or produces unusable output"""
+
+
+async def run_subprocess(args: list[str], timeout: float, want_stderr: bool = False) -> str:
+    """
+    Runs a command without blocking the event loop and returns its stdout, or its stderr
+    if want_stderr is set (ffmpeg reports what its filters measured there).
+    The process is killed if it exceeds the timeout or the awaiting task is cancelled.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise ResolverError(
+            f"{args[0]} exited with code {process.returncode}",
+            stderr.decode("utf8", errors="replace"),
+        )
+    return (stderr if want_stderr else stdout).decode("utf8", errors="replace")
+
+
+def parse_ytdlp_output(output: str) -> dict:
+    """Parses the metadata line printed by yt-dlp"""
+    return parse_ytdlp_entry(json.loads(output))
+
+
+def parse_ytdlp_entry(video_metadata: dict) -> dict:
+    """Checks and normalizes the fields yt-dlp printed for one video"""
+    if video_metadata["duration"] == "NA" or video_metadata["title"] == "NA":
+        raise ResolverError("yt-dlp failure", video_metadata)
+    # some sites like niconico return decimal durations
+    video_metadata["duration"] = int(float(video_metadata["duration"]))
+    extractor = video_metadata.pop("extractor", None)
+    video_id = video_metadata.pop("id", None)
+    if extractor and video_id and "NA" not in (extractor, video_id):
+        video_metadata["extractor_id"] = f"{extractor}:{video_id}"
+    return video_metadata
+
+
+def parse_ffprobe_output(output: str) -> dict:
+    """Parses the json printed by ffprobe into a metadata dict"""
+    ffprobe_output = json.loads(output)
+    # sometimes, the tags are part of the stream block and sometimes part of the format block. Here we check both and merge the result
+    tags = {
+        tag.lower(): v
+        for d in [
+            ffprobe_output.get("format", {}).get("tags", {}),
+            ffprobe_output.get("streams", [{}])[0].get("tags", {}),
+        ]
+        for tag, v in d.items()
+    }
+    return {
+        "title": tags["title"],
+        "duration": int(float(ffprobe_output.get("format", {})["duration"])),
+    }
+
+
+class _Lookup:
+    """An in-flight resolution and the number of callers awaiting it"""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class YtdlpApi:
+    """
+    Runs yt-dlp's Python API on a pool of threads, each holding one long-lived YoutubeDL instance.
+    This avoids paying for an interpreter startup and extractor import on every lookup.
+    """
+
+    def __init__(self, max_workers: int, timeout: float):
+        import yt_dlp
+
+        self._yt_dlp = yt_dlp
+        self._options = {
+            "quiet": True,
+            "no_warnings": True,
+            "noplaylist": True,
+            "skip_download": True,
+            "socket_timeout": timeout,
+        }
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="karaoke-ytdlp"
+        )
+
+    def _extract(self, song_url: str) -> dict:
+        # YoutubeDL instances aren't safe to share between threads, so each worker keeps its own
+        ydl = getattr(self._local, "ydl", None)
+        if ydl is None:
+            ydl = self._local.ydl = self._yt_dlp.YoutubeDL(self._options)
+        info = ydl.extract_info(song_url, download=False)
+        return {
+            "title": info.get("title") or "NA",
+            "duration": "NA" if info.get("duration") is None else info["duration"],
+            "extractor": info.get("extractor_key") or "NA",
+            "id": info.get("id") or "NA",
+        }
+
+    async def extract(self, song_url: str) -> dict:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._extract, song_url
+        )
+
+
+class MetadataResolver:
+    """
+    Resolves song metadata with yt-dlp and ffprobe without blocking the event loop.
+    yt-dlp runs either as a subprocess ("cli" backend) or in-process through its Python API
+    ("api" backend), which falls back to the cli if yt_dlp can't be imported.
+    Each queue (owner) runs at most max_workers lookups at once, and concurrent lookups of the
+    same url share one result.
+    """
+
+    def __init__(self, max_workers: int = 4, timeout: float = 30.0, backend: str = "cli"):
+        self.timeout = timeout
+        self._workers = OwnerSlots(max_workers)
+        self._in_flight: dict[str, _Lookup] = {}
+        self.api: Optional[YtdlpApi] = None
+        if backend == "api":
+            try:
+                self.api = YtdlpApi(max_workers, timeout)
+            except ImportError:
+                print("yt_dlp is not installed, falling back to the yt-dlp command line")
+
+    async def resolve(self, song_url: str, owner: str = "") -> Optional[dict]:
+        """
+        Returns a dict with the title and duration of the song, or None if it could not be resolved.
+        The lookup takes one of owner's slots. Cancelling the caller only cancels the lookup once
+        no other caller is waiting on it.
+        """
+        lookup = self._in_flight.get(song_url)
+        if lookup is None:
+            lookup = _Lookup(asyncio.create_task(self._resolve(song_url, owner)))
+            self._in_flight[song_url] = lookup
+            lookup.task.add_done_callback(lambda _: self._forget(song_url, lookup))
+        lookup.waiters += 1
+        try:
+            return await asyncio.shield(lookup.task)
+        except asyncio.CancelledError:
+            if lookup.waiters == 1:
+                lookup.task.cancel()
+            raise
+        finally:
+            lookup.waiters -= 1
+
+    def _forget(self, song_url: str, lookup: "_Lookup"):
+        if self._in_flight.get(song_url) is lookup:
+            del self._in_flight[song_url]
+
+    async def _resolve(self, song_url: str, owner: str) -> Optional[dict]:
+        """
+        Sends direct links to media files to ffprobe and pages of known sites to yt-dlp, falling
+        back to the other if that fails. When the url doesn't give it away, both run at once and
+        the first to succeed wins.
+        """
+        async with self._workers(owner):
+            route = classify_url(song_url)
+            if route == UNKNOWN:
+                route = await self.probe_content_type(song_url)
+            _ROUTES.inc(route=route)
+            ytdlp = (
+                "ytdlp_api" if self.api else "ytdlp",
+                self.resolve_ytdlp_api if self.api else self.resolve_ytdlp,
+            )
+            ffprobe = ("ffprobe", self.resolve_ffprobe)
+            try:
+                if route == MEDIA:
+                    video_metadata = await self._first_in_order(song_url, [ffprobe, ytdlp])
+                elif route == SITE:
+                    video_metadata = await self._first_in_order(song_url, [ytdlp, ffprobe])
+                else:
+                    video_metadata = await self._first_to_finish(song_url, [ytdlp, ffprobe])
+            except ResolverError as failure:
+                print(
+                    f"Error fetching metadata of song {song_url}:",
+                    *(repr(path_failure) for path_failure in failure.args[1]),
+                )
+                return None
+            print(video_metadata)
+            return video_metadata
+
+    async def _timed(
+        self, path: str, resolve: Callable[[str], Awaitable[dict]], song_url: str
+    ) -> dict:
+        """Runs one resolution path, recording its latency and outcome"""
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            video_metadata = await resolve(song_url)
+            outcome = "ok"
+            return video_metadata
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            _RESOLVE_SECONDS.observe(time.perf_counter() - start, path=path, outcome=outcome)
+
+    async def _first_in_order(self, song_url: str, paths: list) -> dict:
+        """Tries each path in turn, raising a ResolverError with every failure if all of them fail"""
+        failures = []
+        for path, resolve in paths:
+            try:
+                return await self._timed(path, resolve, song_url)
+            except Exception as failure:
+                failures.append(failure)
+        raise ResolverError("every resolution path failed", failures)
+
+    async def _first_to_finish(self, song_url: str, paths: list) -> dict:
+        """
+        Runs every path at once and returns the first successful result, cancelling the rest
+        (which kills their subprocesses). Raises a ResolverError with every failure if all of them fail.
+        """
+        pending = {
+            asyncio.create_task(self._timed(path, resolve, song_url)) for path, resolve in paths
+        }
+        failures = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    failures.append(task.exception())
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        raise ResolverError("every resolution path failed", failures)
+
+    async def probe_content_type(self, song_url: str) -> str:
+        """
+        Classifies a url from the Content-Type of a HEAD request: media types go to ffprobe and
+        web pages to yt-dlp. Anything else (including a failed request) is left UNKNOWN.
+        """
+        if urlsplit(song_url).scheme not in ("http", "https"):
+            return UNKNOWN
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.head(
+                    song_url,
+                    allow_redirects=True,
+                    timeout=aiohttp.ClientTimeout(total=min(self.timeout, 5)),
+                ) as response:
+                    if response.status >= 400:
+                        return UNKNOWN
+                    content_type = response.content_type
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return UNKNOWN
+        if content_type.startswith(("audio/", "video/")) or content_type in (
+            "application/ogg",
+            "application/vnd.apple.mpegurl",
+            "application/x-mpegurl",
+        ):
+            return MEDIA
+        if content_type in ("text/html", "application/xhtml+xml"):
+            return SITE
+        return UNKNOWN
+
+    async def resolve_playlist(
+        self, playlist_url: str, limit: int, owner: str = ""
+    ) -> list[tuple[str, Optional[dict]]]:
+        """
+        Lists up to limit (url, metadata) entries of a playlist with a single flat yt-dlp run,
+        without extracting each video. A url which isn't a playlist gives a single entry.
+        Entries whose title or duration the flat listing didn't include get None as metadata.
+        """
+        async with self._workers(owner):
+            output = await run_subprocess(
+                [
+                    "yt-dlp",
+                    "--flat-playlist",
+                    "--playlist-end",
+                    str(limit),
+                    "--print",
+                    '{"url":%(webpage_url,url)j,"title":%(title)j,"duration":"%(duration)j","extractor":%(extractor_key,ie_key)j,"id":%(id)j}',
+                    playlist_url,
+                ],
+                self.timeout,
+            )
+        entries = []
+        for line in output.splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            song_url = entry.pop("url")
+            if not song_url or song_url == "NA":
+                continue
+            try:
+                entries.append((song_url, parse_ytdlp_entry(entry)))
+            except (ResolverError, ValueError):
+                entries.append((song_url, None))
+        return entries[:limit]
+
+    async def resolve_ytdlp(self, song_url: str) -> dict:
+        output = await run_subprocess(
+            [
+                "yt-dlp",
+                "--no-playlist",
+                "--print",
+                '{"title":%(title)j,"duration":"%(duration)j","extractor":%(extractor_key)j,"id":%(id)j}',
+                song_url,
+            ],
+            self.timeout,
+        )
+        return parse_ytdlp_output(output)
+
+    async def resolve_ytdlp_api(self, song_url: str) -> dict:
+        video_metadata = await asyncio.wait_for(self.api.extract(song_url), self.timeout)
+        return parse_ytdlp_entry(video_metadata)
+
+    async def resolve_ffprobe(self, song_url: str) -> dict:
+        output = await run_subprocess(
+            [
+                "ffprobe",
+                "-v",
+                "quiet",
+                "-print_format",
+                "json",
+                "-show_format",
+                "-show_streams",
+                song_url,
+            ],
+            self.timeout,
+        )
+        return parse_ffprobe_output(output)
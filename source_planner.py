@@ -0,0 +1,209 @@
+import json
+import time
+import asyncio
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from resolver import run_subprocess, classify_url, MEDIA
+from metrics import metrics
+from owner_slots import OwnerSlots
+
+_PLAN_SECONDS = metrics.histogram(
+    "karaoke_source_plan_seconds", "Time taken to plan how to play a song, by decision"
+)
+
+# how a song is played: from a file on this machine, streamed by mpv, or downloaded beforehand
+LOCAL = "local"
+STREAM = "stream"
+DOWNLOAD = "download"
+
+# protocols mpv (through yt-dlp) can play straight off the network. Formats only served
+# some other way, like niconico's dmc, have to be downloaded first
+STREAMABLE_PROTOCOLS = {"http", "https", "m3u8", "m3u8_native", "http_dash_segments"}
+# a probe which read less than this only shows the source is up, not how fast it is
+_MIN_MEASURED_BYTES = 256 * 1024
+
+
+def stream_format(height: Optional[int]) -> Optional[str]:
+    """The format selector mpv passes to yt-dlp to stream a song at up to height lines"""
+    if height is None:
+        return None
+    return f"bv*[height<={height}]+ba/b[height<={height}]"
+
+
+def choose_height(
+    formats: list[dict], throughput: Optional[float], max_height: int, headroom: float
+) -> tuple[bool, Optional[int]]:
+    """
+    Picks the highest resolution up to max_height whose streamable formats need no more than
+    throughput / headroom bytes per second. Video only formats are counted along with the best
+    audio they'd be paired with. Returns whether the song can be streamed, and at what height
+    (None for songs without video). An unknown throughput is assumed to be enough.
+    """
+    streamable = [f for f in formats if f.get("protocol") in STREAMABLE_PROTOCOLS]
+    audio = max(
+        (f.get("tbr") or 0 for f in streamable if f.get("vcodec") == "none"), default=0
+    )
+    # height -> the lowest bitrate in kbps any format of that height needs
+    needed: dict[Optional[int], float] = {}
+    for f in streamable:
+        height = f.get("height")
+        if f.get("vcodec") == "none" or (height and height > max_height):
+            continue
+        kbps = (f.get("tbr") or 0) + (audio if f.get("acodec") == "none" else 0)
+        needed[height] = min(needed.get(height, kbps), kbps)
+    if not needed and audio:
+        needed[None] = audio
+    fits = [
+        height
+        for height, kbps in needed.items()
+        if throughput is None or kbps * 1000 / 8 * headroom <= throughput
+    ]
+    if not fits:
+        return False, None
+    return True, max(fits, key=lambda height: height or 0) or None
+
+
+class SourcePlanner:
+    """
+    Decides at queue time how each song should be played, so its turn never starts with a
+    source that stalls or fails. yt-dlp lists the song's formats, and the best one that fits
+    is fetched for a few seconds to check that it is up and how fast it comes in. Songs with
+    nothing mpv can stream, or which can't be streamed fast enough at any resolution, are
+    downloaded ahead of time instead. Songs that fit are streamed at the highest resolution
+    up to max_height that the measured throughput, divided by headroom, can carry.
+    The fastest throughput measured so far stands in for the host's bandwidth when a source
+    (like an HLS playlist) can't be measured directly.
+    Each queue (owner) plans at most max_concurrent songs at once.
+    """
+
+    def __init__(
+        self,
+        max_height: int,
+        headroom: float,
+        max_concurrent: int = 2,
+        timeout: float = 30.0,
+        probe_bytes: int = 4 * 1024 * 1024,
+        probe_seconds: float = 4.0,
+    ):
+        self.max_height = max_height
+        self.headroom = headroom
+        self.timeout = timeout
+        self.probe_bytes = probe_bytes
+        self.probe_seconds = probe_seconds
+        self.bandwidth: Optional[float] = None
+        self._workers = OwnerSlots(max_concurrent)
+
+    async def plan(
+        self, owner: str, song_url: str, duration: Optional[int], urgent: bool = False
+    ) -> tuple[str, Optional[int]]:
+        """
+        Returns how to play a song (LOCAL, STREAM or DOWNLOAD), and the height to stream it at.
+        Urgent plans, for a song whose turn has come, don't wait for a free worker.
+        """
+        if classify_url(song_url) == MEDIA and Path(song_url).is_file():
+            return LOCAL, None
+        if urgent:
+            return await self._timed_plan(song_url, duration)
+        async with self._workers(owner):
+            return await self._timed_plan(song_url, duration)
+
+    async def _timed_plan(
+        self, song_url: str, duration: Optional[int]
+    ) -> tuple[str, Optional[int]]:
+        start = time.perf_counter()
+        decision = await self._plan(song_url, duration)
+        _PLAN_SECONDS.observe(time.perf_counter() - start, decision=decision[0])
+        return decision
+
+    async def _plan(self, song_url: str, duration: Optional[int]) -> tuple[str, Optional[int]]:
+        try:
+            info = json.loads(
+                await run_subprocess(
+                    ["yt-dlp", "-J", "--no-playlist", "--no-warnings", song_url], self.timeout
+                )
+            )
+        except Exception as listing_error:
+            print(f"Unable to list the formats of {song_url}", listing_error)
+            info = {}
+        formats = info.get("formats") or ([info] if info.get("url") else [])
+        if not formats:
+            # a direct link to a file, which mpv plays as it is
+            return await self._plan_direct(song_url, duration)
+
+        # check the largest streamable format that could be picked, to see how fast it comes in
+        candidates = [
+            f
+            for f in formats
+            if f.get("protocol") in STREAMABLE_PROTOCOLS
+            and f.get("url")
+            and (f.get("height") or 0) <= self.max_height
+        ]
+        if not candidates:
+            return DOWNLOAD, None
+        probed = max(
+            candidates,
+            key=lambda f: (f.get("protocol") in ("http", "https"), f.get("tbr") or 0),
+        )
+        measured = await self.measure(probed["url"], probed.get("http_headers") or {})
+        if measured is None:
+            return DOWNLOAD, None
+        streamable, height = choose_height(formats, measured[0], self.max_height, self.headroom)
+        return (STREAM, height) if streamable else (DOWNLOAD, None)
+
+    async def _plan_direct(
+        self, song_url: str, duration: Optional[int]
+    ) -> tuple[str, Optional[int]]:
+        if urlsplit(song_url).scheme not in ("http", "https"):
+            return STREAM, None
+        measured = await self.measure(song_url, {})
+        if measured is None:
+            return DOWNLOAD, None
+        throughput, size = measured
+        if size and duration and throughput is not None:
+            if size / duration * self.headroom > throughput:
+                return DOWNLOAD, None
+        return STREAM, None
+
+    async def measure(
+        self, url: str, headers: dict
+    ) -> Optional[tuple[Optional[float], Optional[int]]]:
+        """
+        Fetches the start of a url for up to probe_seconds. Returns the throughput in bytes per
+        second (the host's bandwidth if too little came in to tell) and the full size if it was
+        given, or None if the source couldn't be fetched.
+        """
+        received = 0
+        try:
+            async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=10)
+            ) as session:
+                start = time.perf_counter()
+                async with session.get(
+                    url, headers={**headers, "Range": f"bytes=0-{self.probe_bytes - 1}"}
+                ) as response:
+                    if response.status >= 400:
+                        return None
+                    size = response.content_length
+                    content_range = response.headers.get("Content-Range", "")
+                    if "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+                        size = int(content_range.rsplit("/", 1)[1])
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        received += len(chunk)
+                        if (
+                            received >= self.probe_bytes
+                            or time.perf_counter() - start > self.probe_seconds
+                        ):
+                            break
+                elapsed = time.perf_counter() - start
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as probe_error:
+            print(f"Unable to fetch {url}", probe_error)
+            return None
+        if received < _MIN_MEASURED_BYTES and (size is None or received < size):
+            return self.bandwidth, size
+        throughput = received / max(elapsed, 1e-3)
+        self.bandwidth = max(self.bandwidth or 0, throughput)
+        return throughput, size
@@ -0,0 +1,45 @@
+import asyncio
+import functools
+import sqlite3
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+import db
+from metrics import metrics
+
+_QUERY_SECONDS = metrics.histogram(
+    "karaoke_db_query_seconds", "Time spent running each database operation on the database thread"
+)
+
+T = TypeVar("T")
+
+
+class Store:
+    """
+    Owns the sqlite connection and runs all database work on one dedicated thread.
+    Queries never block the event loop, and since they run one at a time on the same
+    connection, each db.py operation is atomic with respect to every other.
+    """
+
+    def __init__(self, path: Path = Path("karaoke.db")):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="karaoke-db")
+        # sqlite connections may only be used from the thread that created them
+        self.conn: sqlite3.Connection = self._executor.submit(
+            db.set_up_database, path
+        ).result()
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        """Runs fn(conn, *args) on the database thread and returns its result"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(self._timed, fn, *args)
+        )
+
+    def _timed(self, fn: Callable[..., T], *args) -> T:
+        with _QUERY_SECONDS.timer(query=fn.__qualname__):
+            return fn(self.conn, *args)
+
+    def close(self):
+        """Closes the connection once all queued work has finished"""
+        self._executor.submit(self.conn.close).result()
+        self._executor.shutdown()
@@ -0,0 +1,78 @@
+import time
+
+from admission import AdmissionControl, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def install_clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_allows_a_burst_then_refills(monkeypatch):
+    clock = install_clock(monkeypatch)
+    bucket = TokenBucket(rate=0.5, capacity=3)
+
+    assert bucket.take() and bucket.take(2)
+    assert not bucket.take()
+    assert bucket.wait_time() == 2
+    clock.now += 2
+    assert bucket.take()
+    # the bucket never holds more than its capacity
+    clock.now += 100
+    assert bucket.take(3) and not bucket.take()
+
+
+def test_users_are_rate_limited_separately(monkeypatch):
+    clock = install_clock(monkeypatch)
+    admission = AdmissionControl(rate=0.1, burst=2, failure_ttl=60)
+
+    assert admission.admit(1, ["https://example.com/a", "https://example.com/b"]) is None
+    assert admission.admit(1, ["https://example.com/c"]) == (
+        "You are adding songs too quickly, try again in 10 seconds"
+    )
+    assert admission.admit(2, ["https://example.com/c"]) is None
+    assert admission.admit(1, ["https://example.com/c"], exempt=True) is None
+    clock.now += 10
+    assert admission.admit(1, ["https://example.com/c"]) is None
+
+
+def test_a_bulk_request_costs_at_most_the_burst(monkeypatch):
+    install_clock(monkeypatch)
+    admission = AdmissionControl(rate=0.1, burst=5, failure_ttl=60)
+
+    assert admission.admit(1, [f"https://example.com/{i}" for i in range(50)]) is None
+
+
+def test_recent_failures_are_rejected_until_they_expire(monkeypatch):
+    clock = install_clock(monkeypatch)
+    admission = AdmissionControl(rate=1, burst=10, failure_ttl=60)
+
+    admission.record_failure("https://Example.com/broken/")
+    # the url is matched however it is written
+    assert admission.admit(1, ["https://example.com/broken"]) == (
+        "Fetching the metadata of https://example.com/broken failed recently. Check the URL."
+    )
+    # only requests made up entirely of recent failures are turned away
+    assert admission.admit(1, ["https://example.com/broken", "https://example.com/ok"]) is None
+    clock.now += 61
+    assert not admission.recently_failed("https://example.com/broken")
+
+
+def test_only_the_latest_failures_are_remembered(monkeypatch):
+    install_clock(monkeypatch)
+    admission = AdmissionControl(rate=1, burst=10, failure_ttl=60, max_failures=2)
+
+    for song in ("a", "b", "c"):
+        admission.record_failure(f"https://example.com/{song}")
+    assert not admission.recently_failed("https://example.com/a")
+    assert admission.recently_failed("https://example.com/b")
+    assert admission.recently_failed("https://example.com/c")
@@ -0,0 +1,75 @@
+import sqlite3
+import datetime
+
+import db
+from metadata_cache import song_key
+
+
+def make_baseline_db(path):
+    """A karaoke.db as the bot created it before the schema was versioned"""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(db._CREATE_QUEUES_TABLE)
+        conn.execute(db._CREATE_USERS_TABLE)
+        conn.execute(db._CREATE_SONGS_TABLE)
+        conn.execute(db._CREATE_METADATA_CACHE_TABLE)
+        conn.execute(
+            "INSERT INTO queues VALUES ('old', 3, 3, 1, ?), ('new', 0, 0, 1, ?)",
+            (datetime.datetime(2023, 1, 1), datetime.datetime(2023, 6, 1)),
+        )
+        conn.execute("INSERT INTO users VALUES (10, 'alice'), (20, 'bob')")
+        conn.executemany(
+            "INSERT INTO songs VALUES (?,?,?,?,NULL,NULL,?,NULL,?,FALSE,?,1)",
+            [
+                ("https://www.youtube.com/watch?v=abc&t=30", "a", 200, "2023-06-02", 0, "2023-06-02 20:00", 10),
+                ("HTTPS://Example.com/song.mp4/", "b", 100, "2023-06-02", 1, "2023-06-02 20:05", 20),
+                ("https://youtu.be/abc", "a", 200, "2023-06-02", 2, None, 20),
+            ],
+        )
+        conn.execute(
+            "INSERT INTO metadata_cache VALUES ('https://youtube.com/watch?v=abc', 'a', 200, 'Youtube:abc', 0, 0)"
+        )
+    conn.close()
+
+
+def test_migrates_a_baseline_database(tmp_path):
+    path = tmp_path.joinpath("karaoke.db")
+    make_baseline_db(path)
+    conn = db.set_up_database(path)
+
+    assert conn.execute("SELECT version FROM schema_version").fetchone()[0] == len(db._MIGRATIONS)
+    # songs from before queues were tracked belong to the most recently created queue
+    assert [row[0] for row in conn.execute("SELECT DISTINCT queue FROM songs")] == ["new"]
+    assert [song["position"] for song in db.get_queue_songs(conn, "new")] == [0, 1, 2]
+
+    # existing songs are keyed the same way songs added from now on are
+    keys = dict(conn.execute("SELECT position, song_key FROM songs"))
+    assert keys[0] == song_key("https://www.youtube.com/watch?v=abc&t=30", {"extractor_id": "Youtube:abc"})
+    assert keys[1] == song_key("https://example.com/song.mp4", {})
+    assert keys[2] == "https://youtu.be/abc"
+
+    # the history totals are built from the songs already sung
+    assert conn.execute(
+        "SELECT discord_user_id, songs_sung, seconds_sung FROM user_stats ORDER BY discord_user_id"
+    ).fetchall() == [(10, 1, 200), (20, 1, 100)]
+    assert conn.execute(
+        "SELECT song_key, play_count FROM song_stats ORDER BY song_key"
+    ).fetchall() == [("Youtube:abc", 1), ("https://example.com/song.mp4", 1)]
+    assert conn.execute("SELECT queue, songs_sung FROM queue_stats").fetchall() == [("new", 2)]
+    conn.close()
+
+    # migrating again does nothing
+    conn = db.set_up_database(path)
+    assert conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0] == 3
+    conn.close()
+
+
+def test_recently_sung_finds_songs_from_before_the_upgrade(tmp_path):
+    path = tmp_path.joinpath("karaoke.db")
+    make_baseline_db(path)
+    conn = db.set_up_database(path)
+    key = song_key("https://youtube.com/watch?v=abc", {"extractor_id": "Youtube:abc"})
+    assert db.last_sung(conn, 1, key, datetime.datetime(2023, 6, 1)) is not None
+    key = song_key("https://example.com/song.mp4?utm_source=x", {})
+    assert db.last_sung(conn, 1, key, datetime.datetime(2023, 6, 1)) is not None
+    conn.close()
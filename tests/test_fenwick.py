@@ -0,0 +1,19 @@
+import random
+
+from fenwick import FenwickTree
+
+
+def test_sums_match_a_list():
+    rng = random.Random(1)
+    tree = FenwickTree()
+    values = []
+    for _ in range(500):
+        index = rng.randrange(200)
+        delta = rng.randint(-50, 50)
+        tree.add(index, delta)
+        values.extend([0] * (index + 1 - len(values)))
+        values[index] += delta
+        start, end = sorted(rng.randrange(-5, 210) for _ in range(2))
+        assert tree.prefix_sum(end) == sum(values[:max(end, 0)])
+        assert tree.range_sum(start, end) == sum(values[max(start, 0):max(end, 0)])
+    assert len(tree) == len(values)
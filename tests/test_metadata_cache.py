@@ -0,0 +1,62 @@
+import time
+
+import db
+from metadata_cache import MetadataCache, normalize_url
+
+SONG = {"title": "song", "duration": 200, "extractor_id": "Youtube:abc"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def install_clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+def test_normalize_url():
+    assert normalize_url("HTTP://www.YouTube.com/watch?v=abc&t=30&utm_source=x#top") == (
+        "https://youtube.com/watch?v=abc"
+    )
+    assert normalize_url("https://example.com/song.mp4/") == "https://example.com/song.mp4"
+    assert normalize_url(" /srv/karaoke/song.mkv ") == "/srv/karaoke/song.mkv"
+
+
+def test_entries_are_shared_by_equivalent_urls_and_expire(tmp_path, monkeypatch):
+    clock = install_clock(monkeypatch)
+    conn = db.set_up_database(tmp_path.joinpath("karaoke.db"))
+    cache = MetadataCache(ttl=60, max_entries=10)
+
+    cache.put(conn, "https://www.youtube.com/watch?v=abc", SONG)
+    assert cache.get(conn, "https://youtube.com/watch?v=abc&t=5") == SONG
+    clock.now += 61
+    assert cache.get(conn, "https://youtube.com/watch?v=abc") is None
+    # the expired entry is deleted rather than left behind
+    assert cache.stats(conn) == {"hits": 1, "misses": 1, "entries": 0}
+    conn.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    clock = install_clock(monkeypatch)
+    conn = db.set_up_database(tmp_path.joinpath("karaoke.db"))
+    cache = MetadataCache(ttl=3600, max_entries=2)
+
+    cache.put(conn, "https://example.com/a", SONG)
+    clock.now += 1
+    cache.put(conn, "https://example.com/b", SONG)
+    clock.now += 1
+    # reading a makes b the least recently used
+    assert cache.get(conn, "https://example.com/a") == SONG
+    clock.now += 1
+    cache.put(conn, "https://example.com/c", SONG)
+
+    assert cache.get(conn, "https://example.com/b") is None
+    assert cache.get(conn, "https://example.com/a") == SONG
+    assert cache.get(conn, "https://example.com/c") == SONG
+    conn.close()
@@ -0,0 +1,125 @@
+import random
+import datetime
+
+import pytest
+
+from queue_state import QueueState, Song
+from ordering import ORDERINGS
+
+
+def make_song(position: int, user_id: int, duration: int = 60) -> Song:
+    return Song(
+        position=position,
+        url=f"https://example.com/{position}",
+        title=f"song {position}",
+        duration=duration,
+        added_time=None,
+        lyrics_url=None,
+        notes=None,
+        collaborators=None,
+        completed_time=None,
+        is_revoked=False,
+        discord_user_id=user_id,
+        song_key=f"https://example.com/{position}",
+        source_plan=None,
+        stream_height=None,
+    )
+
+
+def make_state(users: list[int], ordering: str) -> QueueState:
+    songs = [make_song(position, user_id, 30 + position) for position, user_id in enumerate(users)]
+    return QueueState("queue", 0, len(songs), songs, ordering)
+
+
+def next_song(state: QueueState):
+    """Finds the next song the way the playback loop does, advancing past skipped songs"""
+    while (position := state.next_position()) is not None:
+        song = state.get_song(position)
+        if not state.order.should_skip(song):
+            return song
+        state.advance(position)
+    return None
+
+
+def sing(state: QueueState, song: Song):
+    """Plays a song to the end the way the playback loop does"""
+    state.playing_position = song.position
+    if song.is_pending:
+        assert next(state.order.play_order()) is song
+    state.playing_position = None
+    state.advance(song.position, datetime.datetime.now())
+    new_position = state.order.position_after_song()
+    if new_position is not None:
+        state.set_position(new_position)
+
+
+def check_consistent(state: QueueState):
+    """next_position plays the first song of play_order, and wait_before agrees with play_order"""
+    order = list(state.order.play_order())
+    song = next_song(state)
+    if song is not None and not song.is_pending:
+        # an operator moved the position back to replay a song, which play_order doesn't list
+        return
+    assert (song.position if song else None) == (order[0].position if order else None)
+    wait = 0
+    for ahead, queued in enumerate(order):
+        assert state.order.wait_before(queued) == (wait, ahead)
+        wait += queued.duration
+    # nothing is playing, so the next song is upcoming too
+    assert [song.position for song in state.order.upcoming(3)] == [
+        song.position for song in order[:3]
+    ]
+
+
+def test_round_robin_takes_turns():
+    state = make_state([1, 1, 1, 2, 3, 2], "round_robin")
+    sung = []
+    while (song := next_song(state)) is not None:
+        sing(state, song)
+        sung.append(song.discord_user_id)
+    assert sung == [1, 2, 3, 1, 2, 1]
+
+
+def test_round_robin_doesnt_list_sung_songs_as_queued():
+    state = make_state([1, 1, 1, 2], "round_robin")
+    for _ in range(2):
+        sing(state, next_song(state))
+    assert [song.position for song in state.songs_page(state.currentpos, 10)] == [1, 2]
+    assert [
+        song.position for song in state.songs_page(0, 10, include_sung=True)
+    ] == [0, 1, 2, 3]
+
+
+def test_fifo_plays_in_position_order():
+    state = make_state([1, 1, 2], "fifo")
+    state.revoke(1)
+    sung = []
+    while (song := next_song(state)) is not None:
+        sing(state, song)
+        sung.append(song.position)
+    assert sung == [0, 2]
+
+
+@pytest.mark.parametrize("ordering", sorted(ORDERINGS))
+def test_next_position_follows_play_order(ordering: str):
+    rng = random.Random(ordering)
+    state = make_state([rng.randrange(4) for _ in range(20)], ordering)
+    for _ in range(200):
+        check_consistent(state)
+        action = rng.random()
+        if action < 0.4:
+            song = next_song(state)
+            if song is not None:
+                sing(state, song)
+        elif action < 0.6:
+            state.append(make_song(state.maxpos, rng.randrange(6), rng.randrange(200)))
+        elif action < 0.75:
+            state.revoke(rng.randrange(state.maxpos))
+        elif action < 0.85:
+            position = rng.randrange(state.maxpos)
+            state.swap(position, make_song(position, rng.randrange(6), rng.randrange(200)))
+        elif action < 0.9:
+            state.set_position(rng.randrange(state.maxpos + 1))
+        else:
+            other = "fifo" if state.order.name == "round_robin" else "round_robin"
+            state.set_ordering(other)
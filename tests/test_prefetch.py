@@ -0,0 +1,52 @@
+import asyncio
+from pathlib import Path
+
+import prefetch
+from prefetch import Prefetcher
+
+SONG = "https://example.com/song"
+
+
+def install_fake_ytdlp(monkeypatch, seconds: float):
+    """Replaces yt-dlp with a download that writes the output file after seconds"""
+
+    async def fake_run_subprocess(args: list[str], timeout: float) -> str:
+        await asyncio.sleep(seconds)
+        Path(args[args.index("-o") + 1].replace("%(ext)s", "mp4")).write_bytes(b"song")
+        return ""
+
+    monkeypatch.setattr(prefetch, "run_subprocess", fake_run_subprocess)
+
+
+def test_shared_download_survives_the_other_queue_dropping_it(tmp_path, monkeypatch):
+    install_fake_ytdlp(monkeypatch, 0.1)
+
+    async def run():
+        prefetcher = Prefetcher(tmp_path, 10**9)
+        prefetcher.sync("a", [(0, SONG)])
+        prefetcher.sync("b", [(3, SONG)])
+        fetched = asyncio.create_task(prefetcher.fetch("b", 3, SONG))
+        await asyncio.sleep(0.01)
+        # queue a revokes the song and then stops, while queue b still waits on the download
+        prefetcher.sync("a", [])
+        prefetcher.cancel_all("a")
+        return await fetched
+
+    assert asyncio.run(run()) is not None
+
+
+def test_download_is_cancelled_once_no_queue_wants_it(tmp_path, monkeypatch):
+    install_fake_ytdlp(monkeypatch, 10)
+
+    async def run():
+        prefetcher = Prefetcher(tmp_path, 10**9)
+        prefetcher.sync("a", [(0, SONG)])
+        prefetcher.sync("b", [(3, SONG)])
+        task = prefetcher._downloads[SONG].task
+        prefetcher.sync("a", [])
+        assert not task.cancelled() and not task.done()
+        prefetcher.cancel_all("b")
+        await asyncio.wait({task})
+        return task.cancelled()
+
+    assert asyncio.run(run())
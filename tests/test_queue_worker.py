@@ -0,0 +1,172 @@
+import asyncio
+import datetime
+from pathlib import Path
+
+import db
+import prefetch
+from store import Store
+from queue_state import QueueState
+from prefetch import Prefetcher
+from player import MpvPlayer
+from source_planner import SourcePlanner, DOWNLOAD, STREAM
+from queue_worker import QueueWorker
+
+FAKE_MPV = str(Path(__file__).parent.parent.joinpath("fake_mpv.py"))
+QUEUE = "test"
+
+
+class FakeChannel:
+    """Records what the worker announces, and can hold announcements back until released"""
+
+    def __init__(self):
+        self.messages: list[str] = []
+        self.released = asyncio.Event()
+        self.released.set()
+
+    async def send(self, content: str = None, **kwargs):
+        self.messages.append(content)
+        await self.released.wait()
+
+
+def add_song(conn, url: str, user_id: int, source_plan: str = None) -> int:
+    song = {
+        "url": url,
+        "title": url.rsplit("/", 1)[-1],
+        "duration": 1,
+        "added_time": datetime.datetime.now(),
+        "lyrics_url": None,
+        "notes": None,
+        "collaborators": None,
+        "discord_user_id": user_id,
+        "discord_guild_id": 1,
+        "song_key": url,
+    }
+    position = db.append_song(conn, QUEUE, song)
+    if source_plan:
+        db.set_source_plan(conn, QUEUE, position, url, source_plan, None)
+    return position
+
+
+async def make_worker(tmp_path, monkeypatch, songs: list[tuple], download_seconds: float = 0):
+    """A worker for a queue of (url, user id, source plan) songs, playing each for 0.2 seconds"""
+    monkeypatch.setenv("FAKE_MPV_DURATION", "0.2")
+
+    async def fake_run_subprocess(args: list[str], timeout: float) -> str:
+        await asyncio.sleep(download_seconds)
+        Path(args[args.index("-o") + 1].replace("%(ext)s", "mp4")).write_bytes(b"song")
+        return ""
+
+    monkeypatch.setattr(prefetch, "run_subprocess", fake_run_subprocess)
+    store = Store(tmp_path.joinpath("karaoke.db"))
+    await store.run(db.create_queue, QUEUE, 1, datetime.datetime.now())
+    for song in songs:
+        await store.run(add_song, *song)
+    return QueueWorker(
+        await store.run(QueueState.load, QUEUE),
+        1,
+        FakeChannel(),
+        MpvPlayer(FAKE_MPV, tmp_path.joinpath("mpv.sock")),
+        store,
+        Prefetcher(tmp_path.joinpath("prefetch"), 10**9),
+        None,
+        SourcePlanner(1080, 1.5),
+        prefetch_lookahead=1,
+        download_lookahead=2,
+        download_wait=30,
+        checkpoint_interval=60,
+        resume_rewind=0,
+    )
+
+
+async def wait_until(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_removing_a_song_while_it_downloads_moves_on(tmp_path, monkeypatch):
+    async def run():
+        worker = await make_worker(
+            tmp_path,
+            monkeypatch,
+            [("https://example.com/slow", 10, DOWNLOAD), ("https://example.com/next", 20, STREAM)],
+            download_seconds=10,
+        )
+        worker.start()
+        try:
+            await wait_until(lambda: worker.fetching_url == "https://example.com/slow")
+            # /removesong
+            await worker.store.run(db.revoke_song, QUEUE, 0)
+            worker.state.revoke(0)
+            worker.notify()
+            await worker.refresh_prefetch()
+            await wait_until(lambda: worker.state.get_song(1).completed_time is not None)
+        finally:
+            await worker.stop()
+            worker.store.close()
+        return worker
+
+    worker = asyncio.run(run())
+    assert worker.channel.messages == ["<@20>, it is now your turn to sing next"]
+    assert worker.state.get_song(0).completed_time is None
+
+
+def test_song_mpv_cannot_play_is_passed_over(tmp_path, monkeypatch):
+    async def run():
+        worker = await make_worker(
+            tmp_path,
+            monkeypatch,
+            [("https://example.com/fail", 10, STREAM), ("https://example.com/next", 20, STREAM)],
+        )
+        worker.start()
+        try:
+            await wait_until(lambda: worker.state.get_song(1).completed_time is not None)
+        finally:
+            await worker.stop()
+            worker.store.close()
+        return worker
+
+    worker = asyncio.run(run())
+    failed = worker.state.get_song(0)
+    assert failed.is_revoked and failed.completed_time is None
+
+
+def test_setposition_while_announcing_skips_the_song(tmp_path, monkeypatch):
+    async def run():
+        worker = await make_worker(
+            tmp_path,
+            monkeypatch,
+            [
+                ("https://example.com/first", 10, STREAM),
+                ("https://example.com/second", 20, STREAM),
+                ("https://example.com/third", 30, STREAM),
+            ],
+        )
+        played = []
+        play = worker.player.play
+        worker.player.play = lambda source, *args: played.append(source) or play(source, *args)
+        worker.channel.released.clear()
+        worker.start()
+        try:
+            await wait_until(lambda: worker.channel.messages)
+            # /setposition
+            await worker.store.run(db.set_position, QUEUE, 2)
+            worker.state.set_position(2)
+            worker.notify(interrupt=True)
+            worker.channel.released.set()
+            await wait_until(lambda: worker.state.get_song(2).completed_time is not None)
+        finally:
+            await worker.stop()
+            worker.store.close()
+        return worker, played
+
+    worker, played = asyncio.run(run())
+    # mpv never started the song that was skipped
+    assert played == ["https://example.com/third"]
+    assert worker.channel.messages == [
+        "<@10>, it is now your turn to sing first",
+        "<@30>, it is now your turn to sing third",
+    ]
+    assert worker.state.get_song(0).completed_time is None
+    assert worker.state.get_song(1).is_pending
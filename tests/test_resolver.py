@@ -0,0 +1,114 @@
+import asyncio
+
+from resolver import MetadataResolver, ResolverError, classify_url, MEDIA, SITE, UNKNOWN
+
+SONG = "https://example.com/song"
+
+
+def fake_path(calls: list, name: str, seconds: float, fails: bool = False):
+    """A resolution path which records its calls and cancellation, and finishes after seconds"""
+
+    async def resolve(song_url: str) -> dict:
+        calls.append(name)
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            calls.append(f"{name} cancelled")
+            raise
+        if fails:
+            raise ResolverError(f"{name} failed", "")
+        return {"title": name, "duration": 100}
+
+    return resolve
+
+
+def make_resolver(calls: list, ytdlp: tuple, ffprobe: tuple) -> MetadataResolver:
+    """A resolver whose yt-dlp and ffprobe are fake_path(calls, name, *args)"""
+    async def unknown_content_type(song_url: str) -> str:
+        return UNKNOWN
+
+    resolver = MetadataResolver()
+    resolver.resolve_ytdlp = fake_path(calls, "ytdlp", *ytdlp)
+    resolver.resolve_ffprobe = fake_path(calls, "ffprobe", *ffprobe)
+    resolver.probe_content_type = unknown_content_type
+    return resolver
+
+
+def test_concurrent_lookups_of_a_url_share_one_resolution():
+    calls = []
+    resolver = make_resolver(calls, ytdlp=(0.1,), ffprobe=(0.1, True))
+
+    async def run():
+        return await asyncio.gather(*(resolver.resolve(SONG, owner) for owner in ("a", "a", "b")))
+
+    results = asyncio.run(run())
+    assert results == [{"title": "ytdlp", "duration": 100}] * 3
+    assert calls.count("ytdlp") == 1
+
+
+def test_cancelling_one_caller_leaves_the_lookup_to_the_others():
+    calls = []
+    resolver = make_resolver(calls, ytdlp=(0.1,), ffprobe=(0.1, True))
+
+    async def run():
+        first = asyncio.create_task(resolver.resolve(SONG))
+        second = asyncio.create_task(resolver.resolve(SONG))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == {"title": "ytdlp", "duration": 100}
+    assert "ytdlp cancelled" not in calls
+
+
+def test_cancelling_the_last_caller_cancels_the_lookup():
+    calls = []
+    resolver = make_resolver(calls, ytdlp=(10,), ffprobe=(10,))
+
+    async def run():
+        lookup = asyncio.create_task(resolver.resolve(SONG))
+        await asyncio.sleep(0.01)
+        lookup.cancel()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert sorted(calls) == ["ffprobe", "ffprobe cancelled", "ytdlp", "ytdlp cancelled"]
+
+
+def test_classify_url():
+    assert classify_url("https://music.youtube.com/watch?v=abc") == SITE
+    assert classify_url("https://youtu.be/abc") == SITE
+    assert classify_url("https://example.com/videos/song.MP4?token=1") == MEDIA
+    assert classify_url("https://example.com/watch/song") == UNKNOWN
+    assert classify_url("file:///srv/karaoke/song.mkv") == MEDIA
+
+
+def test_media_url_falls_back_to_ytdlp_when_ffprobe_fails():
+    calls = []
+    resolver = make_resolver(calls, ytdlp=(0.01,), ffprobe=(0.01, True))
+
+    assert asyncio.run(resolver.resolve(SONG + ".mp4")) == {"title": "ytdlp", "duration": 100}
+    assert calls == ["ffprobe", "ytdlp"]
+
+
+def test_unknown_url_takes_the_first_path_to_finish():
+    calls = []
+    resolver = make_resolver(calls, ytdlp=(10,), ffprobe=(0.01,))
+
+    assert asyncio.run(resolver.resolve(SONG)) == {"title": "ffprobe", "duration": 100}
+    # the slower yt-dlp is cancelled once ffprobe has the answer
+    assert sorted(calls) == ["ffprobe", "ytdlp", "ytdlp cancelled"]
+
+
+def test_unknown_url_waits_for_the_other_path_when_one_fails():
+    calls = []
+    resolver = make_resolver(calls, ytdlp=(0.1,), ffprobe=(0.01, True))
+
+    assert asyncio.run(resolver.resolve(SONG)) == {"title": "ytdlp", "duration": 100}
+
+
+def test_lookup_fails_when_every_path_fails():
+    calls = []
+    resolver = make_resolver(calls, ytdlp=(0.01, True), ffprobe=(0.01, True))
+
+    assert asyncio.run(resolver.resolve(SONG)) is None